@@ -2,4 +2,6 @@
 set -e
 rm -rf dataset-gen/datasets
 rm -rf simulations/__*
-rm -rf simulations/acc_*.txt
\ No newline at end of file
+rm -rf simulations/acc_*
+rm -rf simulations/noise_*
+rm -rf simulations/params_*
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@description: benchmarks of the simulation hot paths (plates, transfers, network planning and
+              evaluation) on synthetic images and weights. Reports per-call latency, throughput
+              and peak memory, and compares them with a stored baseline
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+dirname = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(dirname, '..'))
+sys.path.insert(0, os.path.join(dirname, '..', 'simulation'))
+
+import chemcpupy
+from acidbase_network import AcidBaseNetwork
+
+default_baseline = os.path.join(dirname, 'baseline.json')
+platesheet_file = os.path.join(dirname, '..', 'simulation', 'platesheet.csv')
+img_sizes = [8, 12, 16, 28]
+num_neurons = 2
+num_batch_images = 1000
+vol1536_data = 2000 # nL, as in the accuracy simulation
+vol1536_write = 25 # nL per well for the full-plate TransferTask
+
+
+def synthetic_image(imgsize, seed=0):
+    return np.random.default_rng(seed).integers(0, 2, imgsize * imgsize).tolist()
+
+
+def synthetic_weights(imgsize, seed=1):
+    return np.random.default_rng(seed).choice([-1, 1], size=(num_neurons, imgsize * imgsize)).tolist()
+
+
+def load_source_plate():
+    source_plate = chemcpupy.WellPlate384PP(description='source')
+    source_plate.load_platesheet(platesheet_file, fill_from_csv=True, grid='letter')
+    return source_plate
+
+
+def new_network(imgsize):
+    network = AcidBaseNetwork(num_neurons=num_neurons, weights_per_neuron=imgsize * imgsize, img_width=imgsize, img_height=imgsize)
+    network.neurons = synthetic_weights(imgsize)
+    network.weights_loaded = True
+    network.img = synthetic_image(imgsize)
+    network.image_loaded = True
+    return network
+
+
+def get_source_positions(source_plate):
+    return {compound_type: source_plate.get_positions_by_compound_type(compound_type, grid='letter') for compound_type in ('acid', 'base', 'water')}
+
+
+def plan_data_plate(network, source_positions):
+    return network.generate_weighted_data_plate(acid_positions=source_positions['acid'],
+                                                base_positions=source_positions['base'],
+                                                water_positions=source_positions['water'],
+                                                source_max_transfers=float('inf'),
+                                                starting_letter='A',
+                                                starting_index=1,
+                                                max_row=float('inf'),
+                                                max_col=float('inf'),
+                                                transfer_unit_vol=(vol1536_data * 1e-9),
+                                                acid_conc=0.1,
+                                                base_conc=0.1)
+
+
+# Every benchmark takes the image size (None for the size-independent ones) and returns
+# (setup, run, items, unit): run(*setup()) is timed, setup is not, and items is the amount
+# of work of one call, for the throughput.
+
+def bench_load_platesheet(imgsize):
+    def run():
+        load_source_plate()
+    items = load_source_plate().count_filled()
+    return (lambda: ()), run, items, 'wells'
+
+
+def bench_wellplate1536_construction(imgsize):
+    def run():
+        chemcpupy.WellPlate1536LDV(description='data')
+    return (lambda: ()), run, 32 * 48, 'wells'
+
+
+def bench_transfer_task_full_plate(imgsize):
+    source_plate = load_source_plate()
+    acid_positions = source_plate.get_positions_by_compound_type('acid', grid='letter')
+    base_positions = source_plate.get_positions_by_compound_type('base', grid='letter')
+    pattern = np.random.default_rng(0).integers(0, 2, 32 * 48)
+    from_positions = [acid_positions[i % len(acid_positions)] if bit else base_positions[i % len(base_positions)] for i, bit in enumerate(pattern)]
+    to_positions = [(r, c) for r in range(32) for c in range(48)]
+
+    def setup():
+        return copy.deepcopy(source_plate), chemcpupy.WellPlate1536LDV(description='data')
+
+    def run(from_plate, to_plate):
+        task = chemcpupy.TransferTask(from_plate=from_plate, from_positions=from_positions, to_plate=to_plate,
+                                      to_positions=to_positions, transfer_volumes=[vol1536_write] * len(to_positions))
+        task.run(verbose=False, enforce_volume_limits=False)
+    return setup, run, len(to_positions), 'transfers'
+
+
+def bench_container_restore(imgsize):
+    source_plate = load_source_plate()
+    data_plate = chemcpupy.WellPlate1536LDV(description='data')
+    acid_positions = source_plate.get_positions_by_compound_type('acid', grid='letter')
+    from_positions = [acid_positions[i % len(acid_positions)] for i in range(48)]
+    to_positions = [(0, c) for c in range(48)]
+    snapshots = source_plate.snapshot(), data_plate.snapshot()
+
+    def setup():
+        # one row of transfers, as a plan search tries before it backs out
+        task = chemcpupy.TransferTask(from_plate=source_plate, from_positions=from_positions, to_plate=data_plate,
+                                      to_positions=to_positions, transfer_volumes=[vol1536_write] * len(to_positions))
+        task.run(verbose=False, enforce_volume_limits=False)
+        return ()
+
+    def run():
+        source_plate.restore(snapshots[0])
+        data_plate.restore(snapshots[1])
+    return setup, run, len(to_positions), 'wells'
+
+
+def bench_generate_weighted_data_plate(imgsize):
+    source_positions = get_source_positions(load_source_plate())
+
+    def setup():
+        return (new_network(imgsize),)
+
+    def run(network):
+        plan_data_plate(network, source_positions)
+    return setup, run, 2 * num_neurons * imgsize * imgsize, 'transfers'
+
+
+def bench_get_expected_outputs(imgsize):
+    network = new_network(imgsize)
+    plan_data_plate(network, get_source_positions(load_source_plate()))
+
+    def run():
+        network.get_expected_outputs()
+    return (lambda: ()), run, num_neurons, 'neurons'
+
+
+def bench_evaluate_batch(imgsize):
+    network = new_network(imgsize)
+    images = np.random.default_rng(2).integers(0, 2, (num_batch_images, imgsize * imgsize))
+    weights = network.get_weight_matrix()
+
+    def run():
+        network.evaluate_batch(images, weights=weights, transfer_unit_vol=(vol1536_data * 1e-9))
+    return (lambda: ()), run, num_batch_images, 'images'
+
+
+def bench_write_echo_csv_picklist(imgsize):
+    source_plate = load_source_plate()
+    data_plate = chemcpupy.WellPlate1536LDV(description='data')
+    pos_list_data_source, pos_list_data_destin = plan_data_plate(new_network(imgsize), get_source_positions(source_plate))
+    tasklist = chemcpupy.TaskList(description='Write Data')
+    tasklist.add(chemcpupy.TransferTask(from_plate=source_plate, from_positions=pos_list_data_source, to_plate=data_plate,
+                                        to_positions=pos_list_data_destin, transfer_volumes=[vol1536_data] * len(pos_list_data_destin)))
+
+    def run():
+        # the rows are formatted and written, but not stored
+        with contextlib.redirect_stdout(io.StringIO()):
+            chemcpupy.Echo.write_Echo_csv_picklist(tasklist, os.devnull)
+    return (lambda: ()), run, len(pos_list_data_destin), 'transfers'
+
+
+benchmarks = [
+    ('load_platesheet', bench_load_platesheet, [None]),
+    ('WellPlate1536LDV', bench_wellplate1536_construction, [None]),
+    ('TransferTask.run', bench_transfer_task_full_plate, [None]),
+    ('Container.restore', bench_container_restore, [None]),
+    ('generate_weighted_data_plate', bench_generate_weighted_data_plate, img_sizes),
+    ('get_expected_outputs', bench_get_expected_outputs, img_sizes),
+    ('evaluate_batch', bench_evaluate_batch, img_sizes),
+    ('write_Echo_csv_picklist', bench_write_echo_csv_picklist, img_sizes),
+]
+
+
+def measure(setup, run, min_time=0.2, repeat=5):
+    """ Times run(*setup()) and returns (median, min) seconds per call and the peak memory
+    traced during one call. Calls are repeated until every repeat lasts at least min_time.
+    """
+    timings = []
+    for _ in range(repeat):
+        elapsed = 0.0
+        calls = 0
+        while elapsed < min_time or calls == 0:
+            args = setup()
+            start = time.perf_counter()
+            run(*args)
+            elapsed += time.perf_counter() - start
+            calls += 1
+        timings.append(elapsed / calls)
+
+    args = setup()
+    tracemalloc.start()
+    run(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return float(np.median(timings)), min(timings), peak
+
+
+def run_benchmarks(names=None, sizes=None, min_time=0.2, repeat=5, silent=False):
+    """ Runs the benchmarks (all of them by default) and returns a dict of results keyed by
+    'name' or 'name[imgsize]'
+    """
+    results = {}
+    for name, bench, bench_sizes in benchmarks:
+        if names is not None and name not in names:
+            continue
+        for imgsize in bench_sizes:
+            if imgsize is not None and sizes is not None and imgsize not in sizes:
+                continue
+            key = name if imgsize is None else '{}[{}]'.format(name, imgsize)
+            setup, run, items, unit = bench(imgsize)
+            latency, best, peak = measure(setup, run, min_time=min_time, repeat=repeat)
+            results[key] = {
+                'latency_ms': round(latency * 1e3, 4),
+                'best_ms': round(best * 1e3, 4),
+                'throughput': round(items / latency, 2),
+                'unit': unit + '/s',
+                'peak_kib': round(peak / 1024, 1),
+            }
+            if not silent:
+                print('{:40s} {:12.4f} ms {:16.2f} {:14s} {:12.1f} KiB'.format(key, latency * 1e3, items / latency, unit + '/s', peak / 1024))
+    return results
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """ Prints the latency and peak memory of every result relative to the baseline.
+    Returns the keys whose latency grew by more than threshold (e.g. 0.25 for 25%).
+    """
+    regressions = []
+    print('\n{:40s} {:>12s} {:>12s}'.format('benchmark', 'latency', 'peak memory'))
+    for key, result in results.items():
+        if key not in baseline:
+            print('{:40s} {:>12s}'.format(key, 'new'))
+            continue
+        latency_ratio = result['latency_ms'] / baseline[key]['latency_ms']
+        memory_ratio = result['peak_kib'] / baseline[key]['peak_kib'] if baseline[key]['peak_kib'] > 0 else 1.0
+        flag = ''
+        if latency_ratio > 1 + threshold:
+            regressions.append(key)
+            flag = '  <-- slower'
+        print('{:40s} {:11.2f}x {:11.2f}x{}'.format(key, latency_ratio, memory_ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the simulation hot paths on synthetic data.')
+    parser.add_argument('--benchmark', nargs='+', default=None, choices=[name for name, _, _ in benchmarks])
+    parser.add_argument('--imgsize', nargs='+', type=int, default=None, choices=img_sizes)
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum duration of a repeat [s]')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=default_baseline)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative latency increase reported as a regression')
+    parser.add_argument('--output', default=None, help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(names=args.benchmark, sizes=args.imgsize, min_time=args.min_time, repeat=args.repeat)
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        if os.path.isfile(args.baseline):
+            # keep the baseline of the benchmarks that were not run
+            with open(args.baseline) as f:
+                stored = json.load(f)
+            stored['results'].update(results)
+            results = stored['results']
+        report['results'] = dict(sorted(results.items()))
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Saved baseline', args.baseline)
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print('No baseline at', args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    if regressions:
+        print('\n%d benchmark(s) slower than the baseline by more than %d%%' % (len(regressions), round(args.threshold * 100)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
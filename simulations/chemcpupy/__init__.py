@@ -24,6 +24,7 @@ from .tools.Task import Task,TransferTask,TaskList,\
 from .tools import Containers
 from .tools import Plating
 from .tools import Path
+from .optimize import TransferOptimizer
 from .synthesis.UgiLibrary import UgiLibrary
 from .synthesis.PasseriniLibrary import PasseriniLibrary
 from .analysis import MassAnalysis
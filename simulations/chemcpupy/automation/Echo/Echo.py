@@ -55,6 +55,21 @@ def _TransferTask_to_fields(mytask):
     return myfields
 
 
+def read_Echo_transfer_report(CSVfilename):
+    # Returns the rows of the [DETAILS] section of an Echo transfer report as a list of dictionaries.
+    with open(CSVfilename, 'r', newline='') as csvfile:
+        lines = csvfile.read().splitlines()
+
+    if '[DETAILS]' not in lines:
+        raise Exception('Not an Echo transfer report: %s' % (CSVfilename,))
+    details = []
+    for line in lines[lines.index('[DETAILS]')+1:]:
+        if line.strip() == '' or line.startswith('['):
+            break
+        details.append(line)
+    return list(csv.DictReader(details))
+
+
 def position_to_lettergrid(position):
     # Returns a string corresponding to the given (zero indexed) numerical position. Rows are letters and columns are numbers, such that (1,3) returns 'B4'.
     rowletters = [chr(x) for x in range(ord('A'),ord('Z')+1)] + ['A' + chr(x) for x in range(ord('A'),ord('Z')+1)];    
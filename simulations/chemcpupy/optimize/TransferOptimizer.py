@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Merges the transfers of a TaskList that go from the same source well to the
+same destination well, and estimates how long the Echo takes to run a TaskList.
+"""
+
+import math
+
+import chemcpupy.tools.Task as Task
+
+
+echo_max_transfer_volume = 10000   # largest single transfer [nL]
+echo_volume_increment = 2.5        # droplet size [nL]
+echo_transfer_rate = 660.5         # Echo's empirical average transfer rate [nL/s], as in TaskList.summarize
+echo_transfer_overhead = 0.4       # approximate stage movement and well survey time per transfer [s]
+
+
+def estimate_Echo_runtime(mytasklist,
+                          transfer_rate=echo_transfer_rate,
+                          transfer_overhead=echo_transfer_overhead):
+    """ Estimated time to run the transfers of a TaskList [s]: a fixed overhead per
+    transfer plus the time to dispense the total volume.
+    """
+    total_transfers = 0
+    total_volume = 0
+    for mytask in mytasklist._task_list:
+        if not isinstance(mytask, Task.TransferTask):
+            continue
+        num_transfers,from_plate,from_positions,to_plate,to_positions,transfer_volumes,pre_transfer_delays = mytask.unpack_transfers()
+        total_transfers += num_transfers
+        total_volume += sum(transfer_volumes[:num_transfers])
+    return total_transfers*transfer_overhead + total_volume/transfer_rate
+
+
+def _split_volume(num_increments, max_increments):
+    # full transfers first, then the remainder
+    volumes = [max_increments]*(num_increments//max_increments)
+    if num_increments % max_increments > 0:
+        volumes.append(num_increments % max_increments)
+    return volumes
+
+
+class _TransferGroup:
+    """ Transfers that can be merged and reordered freely: none of them reads from a
+    plate that another task writes to, nor from a well that another transfer writes to.
+    """
+    def __init__(self):
+        self.read_plates = set()
+        self.written_plates = set()
+        self.read_wells = set()     # (id(plate), position), for tasks within one plate
+        self.written_wells = set()
+        self.tasks = {}     # (from_plate, to_plate, label) -> {(from_pos, to_pos): increments}
+        self.delayed = []   # transfers with a pre-transfer delay are kept as they are
+
+    def conflicts(self, from_plate, to_plate):
+        return id(from_plate) in self.written_plates or id(to_plate) in self.read_plates
+
+    def add(self, mytask, volume_increment, start=0):
+        """ Adds the transfers of mytask from start on. Returns the index of the first
+        transfer that reads a well written by the group (or writes a well read by it), which
+        must go into a new group, or None when all transfers were added.
+        """
+        num_transfers,from_plate,from_positions,to_plate,to_positions,transfer_volumes,pre_transfer_delays = mytask.unpack_transfers()
+        self.read_plates.add(id(from_plate))
+        self.written_plates.add(id(to_plate))
+        label = mytask.get_param('transfer_group_label')
+        pairs = self.tasks.setdefault((from_plate, to_plate, label), {})
+        delays = list(pre_transfer_delays) + [0]*(num_transfers - len(pre_transfer_delays))
+        for i in range(start, num_transfers):
+            from_pos,to_pos,transfer_vol,delay = from_positions[i],to_positions[i],transfer_volumes[i],delays[i]
+            if from_plate is to_plate:
+                from_well = (id(from_plate), from_pos)
+                to_well = (id(to_plate), to_pos)
+                if i > start and (from_well in self.written_wells or to_well in self.read_wells):
+                    return i
+                self.read_wells.add(from_well)
+                self.written_wells.add(to_well)
+            # TransferTask.run rounds every transfer down to the volume increment
+            num_increments = int(math.floor(transfer_vol/volume_increment + 1e-9))
+            if delay != 0:
+                self.delayed.append((from_plate, to_plate, label, from_pos, to_pos, num_increments, delay))
+            else:
+                pairs[(from_pos, to_pos)] = pairs.get((from_pos, to_pos), 0) + num_increments
+
+    def to_tasks(self, max_increments, volume_increment):
+        tasks = []
+        for (from_plate, to_plate, label), pairs in self.tasks.items():
+            from_positions = []
+            to_positions = []
+            transfer_volumes = []
+            for (from_pos, to_pos), num_increments in pairs.items():
+                for increments in _split_volume(num_increments, max_increments):
+                    from_positions.append(from_pos)
+                    to_positions.append(to_pos)
+                    transfer_volumes.append(increments*volume_increment)
+            if len(from_positions) > 0:
+                tasks.append(Task.TransferTask(from_plate=from_plate,
+                                               from_positions=from_positions,
+                                               to_plate=to_plate,
+                                               to_positions=to_positions,
+                                               transfer_volumes=transfer_volumes,
+                                               transfer_group_label=label))
+        for from_plate, to_plate, label, from_pos, to_pos, num_increments, delay in self.delayed:
+            volumes = _split_volume(num_increments, max_increments)
+            if len(volumes) > 0:
+                tasks.append(Task.TransferTask(from_plate=from_plate,
+                                               from_positions=[from_pos]*len(volumes),
+                                               to_plate=to_plate,
+                                               to_positions=[to_pos]*len(volumes),
+                                               transfer_volumes=[v*volume_increment for v in volumes],
+                                               pre_transfer_delays=[delay]+[0]*(len(volumes)-1),
+                                               transfer_group_label=label))
+        return tasks
+
+
+def coalesce_transfers(mytasklist,
+                       max_transfer_volume=echo_max_transfer_volume,
+                       volume_increment=echo_volume_increment,
+                       transfer_rate=echo_transfer_rate,
+                       transfer_overhead=echo_transfer_overhead,
+                       verbose=True):
+    """ Merges the transfers of a TaskList that go from the same source well to the same
+    destination well into one transfer of the summed volume.
+
+    Transfers are only merged across tasks until a task reads from a plate that an earlier
+    task of the group writes to (or writes to a plate it reads from), so the contents of
+    every well are the same as when the original TaskList runs. Within a task that moves
+    liquid inside one plate, a transfer that reads a well written by an earlier transfer (or
+    writes a well read by one) also starts a new group. Every transfer is rounded
+    down to volume_increment first, as TransferTask.run does, and merged volumes above
+    max_transfer_volume are split into several transfers. Transfers that round to zero are
+    dropped. Transfers with a pre-transfer delay are not merged. Tasks that are not
+    transfers are kept in place.
+
+    Returns:
+        (TaskList, dict). The new TaskList and a report with the number of transfers and
+        the estimated runtime [s] (see estimate_Echo_runtime) before and after.
+    """
+    max_increments = int(math.floor(max_transfer_volume/volume_increment + 1e-9))
+    if max_increments < 1:
+        raise Exception('The maximum transfer volume %g nL is below the volume increment %g nL' % (max_transfer_volume, volume_increment))
+
+    newtasklist = Task.TaskList(description=mytasklist._description)
+    group = _TransferGroup()
+    for mytask in mytasklist._task_list:
+        if not isinstance(mytask, Task.TransferTask):
+            for t in group.to_tasks(max_increments, volume_increment):
+                newtasklist.add(t)
+            group = _TransferGroup()
+            newtasklist.add(mytask)
+            continue
+        if group.conflicts(mytask.get_param('from_plate'), mytask.get_param('to_plate')):
+            for t in group.to_tasks(max_increments, volume_increment):
+                newtasklist.add(t)
+            group = _TransferGroup()
+        start = group.add(mytask, volume_increment)
+        while start is not None:
+            # the task moves liquid within one plate and reads what it wrote before
+            for t in group.to_tasks(max_increments, volume_increment):
+                newtasklist.add(t)
+            group = _TransferGroup()
+            start = group.add(mytask, volume_increment, start)
+    for t in group.to_tasks(max_increments, volume_increment):
+        newtasklist.add(t)
+
+    def count_transfers(tasklist):
+        return sum(t.unpack_transfers()[0] for t in tasklist._task_list if isinstance(t, Task.TransferTask))
+
+    report = {
+        'transfers_before': count_transfers(mytasklist),
+        'transfers_after': count_transfers(newtasklist),
+        'runtime_before': estimate_Echo_runtime(mytasklist, transfer_rate, transfer_overhead),
+        'runtime_after': estimate_Echo_runtime(newtasklist, transfer_rate, transfer_overhead),
+    }
+    if verbose:
+        print('\nCoalesced transfers:  %s' % (mytasklist._description))
+        print('  %u -> %u transfers, est. %.1f -> %.1f min.' \
+              % (report['transfers_before'],
+                 report['transfers_after'],
+                 report['runtime_before']/60,
+                 report['runtime_after']/60))
+    return newtasklist, report
@@ -15,6 +15,9 @@ import json
 import csv
 from datetime import datetime
 import os
+import copy
+import numbers
+import weakref
 
 import pubchempy as pcp
 from pyteomics import mass
@@ -22,8 +25,176 @@ from pyteomics import mass
 from pprint import pprint
 
 
+class _CompoundRecord(dict):
+    """ The properties of a compound, shared by every SharedCompound that holds 
+    it. A record is never changed once it is made. _order is the order of all 
+    keys of the compound it came from, including the ones kept per well.
+    """
+    _order = ()
+
+# one record per distinct set of properties, for as long as a well uses it
+_compound_records = weakref.WeakValueDictionary()
+_empty_record = _CompoundRecord()
+
+def _is_immutable(value):
+    if isinstance(value,(str,bytes,numbers.Number,type(None))):
+        return True
+    if type(value) is tuple:
+        return all(_is_immutable(v) for v in value)
+    return False
+
+def _intern_record(properties,order):
+    key = tuple(sorted(properties.items(),key=lambda item: item[0]))
+    try:
+        record = _compound_records.get(key)
+    except TypeError:
+        key = None
+        record = None
+    if record is None:
+        record = _CompoundRecord(properties)
+        record._order = tuple(order)
+        if key is not None:
+            _compound_records[key] = record
+    return record
+
+
+class SharedCompound(dict):
+    """ A compound in a CompoundList that shares its properties with the same 
+    compound in other lists. The dict itself only holds what belongs to this 
+    list (the 'volume', and any property changed since), and everything else 
+    is read from a shared _CompoundRecord. Writes never reach the record, so 
+    changing a SharedCompound is copy-on-write and does not change any other.
+    It reads, compares, copies and saves like a plain dict.
+    """
+    __slots__ = ('_record',)
+
+    def __init__(self,record=_empty_record,own=()):
+        dict.__init__(self,own)
+        self._record = record
+
+    @classmethod
+    def share(cls,compound):
+        """ Returns a new SharedCompound with the contents of compound (a dict or 
+        a SharedCompound). Immutable properties are interned in a shared record, 
+        the volume and any mutable property are copied.
+        """
+        if type(compound) is SharedCompound:
+            if dict.__len__(compound)==0 or (dict.__len__(compound)==1 and dict.__contains__(compound,'volume')):
+                return cls(compound._record,dict.items(compound))
+            # fold the changed properties into a record, for this compound too
+            compound._compact()
+            return cls(compound._record,copy.deepcopy(dict(dict.items(compound))))
+        record,own = _split_compound(compound)
+        return cls(record,copy.deepcopy(own))
+
+    def _compact(self):
+        record,own = _split_compound(self)
+        dict.clear(self)
+        dict.update(self,own)
+        self._record = record
+
+    def _materialize(self):
+        # copy the record into the dict, before a key of the record is removed
+        merged = dict(self.items())
+        dict.clear(self)
+        dict.update(self,merged)
+        self._record = _empty_record
+
+    def __getitem__(self,key):
+        try:
+            return dict.__getitem__(self,key)
+        except KeyError:
+            return self._record[key]
+
+    def get(self,key,default=None):
+        if dict.__contains__(self,key):
+            return dict.__getitem__(self,key)
+        return self._record.get(key,default)
+
+    def __contains__(self,key):
+        return dict.__contains__(self,key) or key in self._record
+
+    def keys(self):
+        record = self._record
+        keys = [k for k in record._order if k in record or dict.__contains__(self,k)]
+        if len(keys) < len(record) + dict.__len__(self):
+            seen = set(keys)
+            keys.extend(k for k in record if k not in seen)
+            keys.extend(k for k in dict.keys(self) if k not in seen and k not in record)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k,self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def copy(self):
+        return dict(self.items())
+
+    def setdefault(self,key,default=None):
+        if key in self:
+            return self[key]
+        dict.__setitem__(self,key,default)
+        return default
+
+    def __delitem__(self,key):
+        self._materialize()
+        dict.__delitem__(self,key)
+
+    def pop(self,key,*default):
+        self._materialize()
+        return dict.pop(self,key,*default)
+
+    def popitem(self):
+        self._materialize()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._record = _empty_record
+
+    def __eq__(self,other):
+        return dict(self.items())==other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        return (SharedCompound,(self._record,dict(dict.items(self))))
+
+    def __deepcopy__(self,memo):
+        # records are never changed, so copies share them too
+        return SharedCompound(self._record,copy.deepcopy(dict(dict.items(self)),memo))
+
+def _split_compound(compound):
+    # (record, own): the interned immutable properties, and the rest
+    properties = {}
+    own = {}
+    for k,v in compound.items():
+        if k!='volume' and _is_immutable(v):
+            properties[k] = v
+        else:
+            own[k] = v
+    return _intern_record(properties,compound.keys()),own
+
+
 class CompoundList:
     
+    # a weak reference to the Container of the well that holds this list, if any, 
+    # and the position of the well. The weak reference lets plates be freed without 
+    # waiting for the garbage collector.
+    _container = None
+    _position = None
+
     # ----------------------------------------------
     def __init__(self, *args, **kwargs):
         """A CompoundList stores a list of compounds with their properties
@@ -178,7 +349,32 @@ class CompoundList:
                 self._compound_list[-1]['volume'] = _total_volume
                 for p in _csv_properties:
                     self._compound_list[-1].update( { p[0] : row[p[1]] } )
+
+        self._changed()
         
+    # ----------------------------------------------        
+    def share(self):
+        """Returns a copy of the CompoundList whose compounds share their
+        properties with these ones (see SharedCompound). It is much cheaper
+        than copy.deepcopy, and changing either list does not change the other.
+        """
+        new_compound_list = CompoundList(description=self._description)
+        new_compound_list._compound_list = [SharedCompound.share(c) for c in self._compound_list]
+        return new_compound_list
+
+    def _changed(self):
+        # keep the compound index of the Container that holds this list up to date
+        container = self._container() if self._container is not None else None
+        if container is not None:
+            container._index_compounds(self._position)
+
+    def __getstate__(self):
+        # copies do not belong to the well of the original
+        state = self.__dict__.copy()
+        state.pop('_container',None)
+        state.pop('_position',None)
+        return state
+
     # ----------------------------------------------        
     def add_properties_by_cid(self, cids_and_properties):
         """Adds properties to compounds in a CompoundList. These can be any
@@ -201,6 +397,7 @@ class CompoundList:
             for compound in self._compound_list:
                 if compound.get('cid')==cid:
                     compound.update(cids_and_properties[cid])
+        self._changed()
 
 
     # ----------------------------------------------        
@@ -288,6 +485,8 @@ class CompoundList:
                 if overwrite or ('smiles' not in self._compound_list[i].keys()):
                     self._compound_list[i]['canonical_smiles'] = m.canonical_smiles
 
+        self._changed()
+
 
     # ----------------------------------------------
     def calculate_compositions(self,overwrite=False):
@@ -553,6 +752,7 @@ class CompoundList:
 
     def remove_if_zero_volume(self):
         self._compound_list = [x for x in self._compound_list if x['volume']>0]
+        self._changed()
 
 
 
@@ -8,9 +8,11 @@ Created on Mon Mar  5 19:01:33 2018
 
 
 from chemcpupy import MixtureList,CompoundList
+from chemcpupy.tools.CompoundList import SharedCompound
 #from chemcpupy.tools.misc import *
 import numpy as np
 import copy
+import weakref
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import pandas as pd
@@ -28,6 +30,61 @@ from pyteomics import mass
 
 
 
+class _Well(dict):
+    """ The mixture dict of a Container well. Its 'volume' lives in the volume 
+    array of the Container, so well['volume'] and the array are the same value.
+    """
+    # a plate holds thousands of wells, so they have no instance __dict__. A well 
+    # is bound as soon as it is made, which sets both slots.
+    __slots__ = ('_volumes','_index')
+
+    def __reduce__(self):
+        # the slots must be set before the items, which __setitem__ reads
+        return (_Well,(dict(self.items()),),(None,{'_volumes':self._volumes,'_index':self._index}))
+
+    def bind(self,volumes,index):
+        volume = dict.get(self,'volume',0)
+        self._volumes = volumes
+        self._index = index
+        self['volume'] = volume
+
+    def unbind(self):
+        if self._volumes is not None:
+            dict.__setitem__(self,'volume',self['volume'])
+            self._volumes = None
+
+    def __getitem__(self,key):
+        if key=='volume' and self._volumes is not None:
+            return float(self._volumes[self._index])
+        return dict.__getitem__(self,key)
+
+    def __setitem__(self,key,value):
+        if key=='volume' and self._volumes is not None:
+            self._volumes[self._index] = value
+        dict.__setitem__(self,key,value)
+
+    def get(self,key,default=None):
+        if key=='volume' and self._volumes is not None:
+            return self['volume']
+        return dict.get(self,key,default)
+
+    def items(self):
+        return [(k,self[k]) for k in self]
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self,other):
+        return dict(self.items())==other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+
 class Container(MixtureList):
     
     def __init__(self,*args,**kwargs):        
@@ -42,6 +99,7 @@ class Container(MixtureList):
         self._volume_min = kwargs.get('volume_min',0)
         self._volume_increment = kwargs.get('volume_increment', 1)
         self._autofill = kwargs.get('autofill',True)
+        self._snapshots = []
         
         if kwargs.get('mixture_json_file') is not None:
             self._autofill = False
@@ -50,6 +108,16 @@ class Container(MixtureList):
         self._file_subtype='WellPlate-1.0'
     
         if self._autofill:
+            self._fill_plate()
+
+    def _fill_plate(self):
+        """ Puts an empty mixture, named after its letter grid, at every position. 
+        On an empty Container the wells and their indexes are built in one pass: the 
+        volume array is already zero, and empty compound lists add nothing to the 
+        compound index.
+        """
+        if len(self._mixture_list)>0:
+            # the mixtures given to the Container keep their positions
             for r in range(self._rows):    
                 for c in range(self._cols):
                     self._mixture_list.append(
@@ -58,10 +126,145 @@ class Container(MixtureList):
                              'position':(r,c),
                              'volume':0
                              })
+                    self._index_mixture(len(self._mixture_list)-1)
+            return
+        positions,names = _plate_grid(self._rows,self._cols)
+        volumes = self._volumes
+        wells = []
+        for position,name in zip(positions,names):
+            compound_list = CompoundList()
+            compound_list._container = weakref.ref(self)
+            compound_list._position = position
+            well = _Well(mixture_name=name,compound_list=compound_list,position=position,volume=0)
+            well._volumes = volumes
+            well._index = position
+            wells.append(well)
+        self._mixture_list.extend(wells)
+        self._occupied[...] = True
+        self._position_index = dict(zip(positions,wells))
+        self._name_index = dict(zip(names,wells))
+
+    def _index_mixture(self,i):
+        """ Adds mixture i of self._mixture_list to the name and position indexes,
+        and moves its volume into the volume array.
+        """
+        mixture = self._mixture_list[i]
+        position = mixture.get('position')
+        # the first mixture at a position wins, as with a scan of the list
+        if position is not None and tuple(position) not in self._position_index:
+            row,col = tuple(position)
+            if 0 <= row < self._rows and 0 <= col < self._cols:
+                if type(mixture) is not _Well:
+                    mixture = _Well(mixture)
+                    self._mixture_list[i] = mixture
+                mixture.bind(self._volumes,(row,col))
+                self._occupied[row,col] = True
+                self._position_index[(row,col)] = mixture
+                self._index_compounds((row,col))
+        # a name maps to its mixture, or to a list when several mixtures share it
+        name = mixture['mixture_name']
+        found = self._name_index.get(name)
+        if found is None:
+            self._name_index[name] = mixture
+        elif type(found) is list:
+            found.append(mixture)
+        else:
+            self._name_index[name] = [found,mixture]
+
+    def _reindex(self):
+        """ Rebuilds the name and position indexes and the volume array from 
+        self._mixture_list. Call it after changing self._mixture_list directly.
+        """
+        self._name_index = {}
+        self._position_index = {}
+        self._empty_cursor = 0
+        self._volumes = np.zeros(self.shape)
+        self._occupied = np.zeros(self.shape,dtype=bool)
+        self._compound_index = {}
+        self._compound_keys = {}
+        self._compound_key_sets = {}
+        for m in self._mixture_list:
+            if type(m) is _Well:
+                m.unbind()
+        for i in range(len(self._mixture_list)):
+            self._index_mixture(i)
+
+    def _index_compounds(self,position):
+        """ Updates the (property, value) -> positions index of the well at position, 
+        for the type, name and cid of its compounds. The CompoundList of the well 
+        calls this whenever it changes.
+        """
+        compound_list = self._position_index[position]['compound_list']
+        keys = set()
+        if isinstance(compound_list,CompoundList):
+            compound_list._container = weakref.ref(self)
+            compound_list._position = position
+            if len(compound_list._compound_list)==0 and position not in self._compound_keys:
+                return
+            for c in compound_list._compound_list:
+                for prop in _indexed_properties:
+                    if prop in c:
+                        try:
+                            keys.add((prop,c[prop]))
+                        except TypeError:
+                            pass # unhashable values are not indexed
+        old_keys = self._compound_keys.get(position,frozenset())
+        if keys==old_keys:
+            return
+        # wells with the same compounds share one key set
+        keys = frozenset(keys)
+        keys = self._compound_key_sets.setdefault(keys,keys)
+        for key in old_keys - keys:
+            positions = self._compound_index[key]
+            positions.discard(position)
+            if len(positions)==0:
+                del self._compound_index[key]
+        for key in keys - old_keys:
+            self._compound_index.setdefault(key,set()).add(position)
+        self._compound_keys[position] = keys
+
+    def _find_positions_by_property(self,prop,value,grid=None):
+        try:
+            positions = self._compound_index.get((prop,value),())
+        except TypeError:
+            positions = ()
+        return [position_to_grid(p,grid=grid) for p in sorted(positions)]
+
+    def __setstate__(self,state):
+        # copies of the compound lists have lost their well, see CompoundList.__getstate__
+        self.__dict__.update(state)
+        for position,mixture in self._position_index.items():
+            if isinstance(mixture['compound_list'],CompoundList):
+                mixture['compound_list']._container = weakref.ref(self)
+                mixture['compound_list']._position = position
+
+    def _find_mixtures(self,key):
+        """ Returns the mixtures with the name key, or the mixture at the position key,
+        given as (row,col) or as a letter grid.
+        """
+        if type(key)==tuple or type(key)==list:
+            mixture = self._position_index.get(tuple(key))
+            return [] if mixture is None else [mixture]
+        found = self._name_index.get(key)
+        if found is not None:
+            return found if type(found) is list else [found]
+        position = _as_position(key)
+        if position in self._position_index:
+            return [self._position_index[position]]
+        return []
+
+    def add_mixtures(self,*args,**kwargs):
+        MixtureList.add_mixtures(self,*args,**kwargs)
+        self._reindex()
+
+    def add_mixture(self,mixture_name,compound_list):
+        MixtureList.add_mixture(self,mixture_name,compound_list)
+        self._index_mixture(len(self._mixture_list)-1)
 
     def __getitem__(self,key):
         """ In a Container you can retrieve a mixture either by 
-        myplate['mixturename'] or by myplate[row,col].
+        myplate['mixturename'] or by myplate[row,col]. A letter grid 
+        such as myplate['B4'] also works for wells without that name.
         """
 
         if type(key)==tuple or type(key)==list:
@@ -69,16 +272,18 @@ class Container(MixtureList):
             #print('testing key',key,row,col,self._rows,self._cols)
             assert(row<self._rows)
             assert(col<self._cols)
-            return [x for x in self._mixture_list if tuple(x['position'])==(row,col)][0]
-        else:
-            return MixtureList.__getitem__(self,key) 
+        mixtures = self._find_mixtures(key)
+        if len(mixtures)==0:
+            raise IndexError('Key %s is not found.' % (str(key),))
+        return mixtures[0]
     
     def _find_empty_location(self):
-        filled_positions = [tuple(x['position']) for x in self._mixture_list]        
-        for r in range(self._rows):
-                for c in range(self._cols):
-                    if (r,c) not in filled_positions:
-                        return (r,c)
+        # positions are never freed, so the first empty one only moves forward
+        while self._empty_cursor < self._rows*self._cols:
+            position = divmod(self._empty_cursor,self._cols)
+            if position not in self._position_index:
+                return position
+            self._empty_cursor += 1
         
         raise Exception('No empty WellPlate positions available.')
 
@@ -96,11 +301,13 @@ class Container(MixtureList):
         if type(position) is str:
             position = lettergrid_to_position(position)
             
-        mixture_name = [x['mixture_name'] for x in self._mixture_list \
-                        if tuple(x['position'])==position][0]
-        self.add_compounds_to_mixture(mixture_name,copy.deepcopy(compound_list),\
-                                      volume=volume, position=position)
-        self.add_volume(position,volume)
+        mixture = self._position_index[tuple(position)]
+        if self._snapshots:
+            self._journal_well(tuple(position))
+            self._journal_volumes([mixture._index])
+        mixture['compound_list'].add_compounds(compound_list=_share_compounds(compound_list),
+                                               total_volume=volume)
+        mixture['volume'] += volume
         
     def add_new_mixture(self,mixture_name,compound_list,position=None,volume=0):
         """ Add a mixture to a Container at a specified location.
@@ -119,10 +326,10 @@ class Container(MixtureList):
             assert(row<self._rows)
             assert(col<self._cols)
 
-            if position in [tuple(x['position']) for x in self._mixture_list]:
+            if tuple(position) in self._position_index:
                 raise Exception('there is already a mixture at position %s' % (position,))
 
-            mycompounds = copy.deepcopy(compound_list)
+            mycompounds = _share_compounds(compound_list)
             if volume==0:
                 transfer_volume=0
             else:
@@ -146,6 +353,7 @@ class Container(MixtureList):
                                        'position':tuple(position),
                                        'volume':transfer_volume
                                        })
+            self._index_mixture(len(self._mixture_list)-1)
 
     def add_compounds_from_bounding_box(self,compounds,volume=100e-6):
         for c in compounds:
@@ -293,41 +501,206 @@ class Container(MixtureList):
         """ Changethe volume of a mixture. The key can either be the mixture_name
         or (row,col).
         """
-        found = False
-        volume = 0;
-        for x in self._mixture_list:
-            if (x['mixture_name']==key) or (tuple(x['position'])==tuple(key)):
-                found = True
-                volume = x['volume'];            
-        if (not found):
+        mixtures = self._find_mixtures(key)
+        if len(mixtures)==0:
             raise Exception('Key %s is not found. Task aborted.'
                                     % (str(key)))
-        return volume
+        return mixtures[-1]['volume']
     
     def add_volume(self,key,add_volume):
         """ Changethe volume of a mixture. The key can either be the mixture_name
         or (row,col).
         """
-        found = False
-        for x in self._mixture_list:
-            if (x['mixture_name']==key) or (tuple(x['position'])==tuple(key)):
-                # We already check these in Task.run(). No need to check again.
-                '''
-                current_position = x['position']
-                if (add_volume < 0) and (x['volume'] + add_volume < self._volume_min):
-                    raise Exception('Position %s is depleted. Task aborted.'
-                                    % (current_position,))
-                elif (add_volume > 0) and (x['volume'] + add_volume > self._volume_max):
-                    raise Exception('Position %s is full. Task aborted.'
-                                    % (current_position,))
-                else:
-                '''
-                found = True
-                x['volume'] += add_volume
-        if (not found):
+        mixtures = self._find_mixtures(key)
+        for x in mixtures:
+            # We already check these in Task.run(). No need to check again.
+            '''
+            current_position = x['position']
+            if (add_volume < 0) and (x['volume'] + add_volume < self._volume_min):
+                raise Exception('Position %s is depleted. Task aborted.'
+                                % (current_position,))
+            elif (add_volume > 0) and (x['volume'] + add_volume > self._volume_max):
+                raise Exception('Position %s is full. Task aborted.'
+                                % (current_position,))
+            else:
+            '''
+            if self._snapshots and type(x) is _Well and x._volumes is not None:
+                self._journal_volumes([x._index])
+            x['volume'] += add_volume
+        if len(mixtures)==0:
             raise Exception('Key %s is not found. Task aborted.'
                                     % (str(key)))
 
+    @property
+    def volumes(self):
+        """ The volume of every well as a (rows x cols) array. Wells without a 
+        mixture are 0. Writing to the array changes the volumes of the wells 
+        (but is not undone by restore).
+        """
+        return self._volumes
+
+    def _positions_to_indices(self,positions):
+        positions = np.array(lettergrid_to_position(list(positions)),dtype=int).reshape(-1,2)
+        rows,cols = positions[:,0],positions[:,1]
+        if np.any((rows < 0) | (rows >= self._rows) | (cols < 0) | (cols >= self._cols)):
+            raise Exception('Positions outside of the %u x %u plate. Task aborted.' % self.shape)
+        missing = ~self._occupied[rows,cols]
+        if np.any(missing):
+            raise Exception('Key %s is not found. Task aborted.'
+                                    % (str(tuple(positions[np.argmax(missing)].tolist())),))
+        return rows,cols
+
+    def add_volumes(self,positions,add_volumes):
+        """ Changes the volumes of many wells at once, like add_volume for each 
+        position. add_volumes is one volume per position or one for all of them, 
+        and a position may repeat.
+        """
+        rows,cols = self._positions_to_indices(positions)
+        if self._snapshots:
+            self._journal_volumes(zip(rows.tolist(),cols.tolist()))
+        np.add.at(self._volumes,(rows,cols),np.broadcast_to(np.asarray(add_volumes,dtype=float),rows.shape))
+
+    def total_volume(self):
+        return float(self._volumes.sum())
+
+    def get_volume_limit_violations(self):
+        """ Returns (depleted, overfilled), boolean (rows x cols) arrays of the wells 
+        that hold some liquid but less than volume_min, and of those above volume_max.
+        """
+        depleted = self._occupied & (self._volumes > 0) & (self._volumes < self._volume_min)
+        overfilled = self._occupied & (self._volumes > self._volume_max)
+        return depleted,overfilled
+
+    def list_depleted_positions(self):
+        return [tuple(p) for p in np.argwhere(self.get_volume_limit_violations()[0]).tolist()]
+
+    def list_overfilled_positions(self):
+        return [tuple(p) for p in np.argwhere(self.get_volume_limit_violations()[1]).tolist()]
+
+    def check_volume_limits(self):
+        """ Raises an Exception if any well is depleted or overfilled.
+        """
+        depleted,overfilled = self.get_volume_limit_violations()
+        if np.any(depleted):
+            raise Exception('Plate Exception:   %s, positions %s are depleted.'
+                            % (self._description, position_to_lettergrid(self.list_depleted_positions())))
+        if np.any(overfilled):
+            raise Exception('Plate Exception:   %s, positions %s will overflow.'
+                            % (self._description, position_to_lettergrid(self.list_overfilled_positions())))
+
+    def snapshot(self):
+        """ Starts a snapshot of the Container and returns its id, for restore. 
+        From now on, the first change to a well saves its compounds or its volume, 
+        so a restore only touches the wells changed since the snapshot. Snapshots 
+        can be nested.
+        Changes made through the Container (add_compounds_to_location, add_volume, 
+        add_volumes, add_new_mixture, ... and thus TransferTask.run) are restored; 
+        changing a CompoundList of a well or the volumes array directly is not.
+        """
+        self._snapshots.append({'num_mixtures':len(self._mixture_list),
+                                'wells':{},
+                                'volumes':{}})
+        return len(self._snapshots)-1
+
+    def _journal_volumes(self,indices):
+        # save the volumes of wells before their first change since the latest snapshot
+        saved = self._snapshots[-1]['volumes']
+        for index in indices:
+            if index not in saved:
+                saved[index] = float(self._volumes[index])
+
+    def _journal_well(self,position):
+        # save the well before its first change since the latest snapshot
+        wells = self._snapshots[-1]['wells']
+        if position in wells:
+            return
+        well = self._position_index[position]
+        compound_list = well['compound_list']
+        if isinstance(compound_list,CompoundList):
+            compounds = compound_list.share()._compound_list
+        else:
+            compounds = copy.deepcopy(compound_list)
+        wells[position] = ({k:v for k,v in dict.items(well) if k!='volume'},compounds)
+
+    def _restore_well(self,position,saved):
+        well = self._position_index[position]
+        keys,compounds = saved
+        for k in [k for k in dict.keys(well) if k!='volume' and k not in keys]:
+            dict.__delitem__(well,k)
+        dict.update(well,keys)
+        compound_list = well['compound_list']
+        if isinstance(compound_list,CompoundList):
+            # the saved compounds stay untouched, for the next restore
+            compound_list._compound_list = [SharedCompound.share(c) for c in compounds]
+            self._index_compounds(position)
+        else:
+            well['compound_list'] = copy.deepcopy(compounds)
+
+    def restore(self,snapshot_id):
+        """ Returns the Container to its state at snapshot snapshot_id. The snapshot 
+        stays, so the Container can be restored to it again; later snapshots are 
+        released. Returns the number of wells whose compounds were restored.
+        """
+        if not 0 <= snapshot_id < len(self._snapshots):
+            raise Exception('Unknown snapshot %s' % (snapshot_id,))
+        restored = set()
+        # the oldest saved state of a well is the one of this snapshot
+        for snapshot in reversed(self._snapshots[snapshot_id:]):
+            for position,saved in snapshot['wells'].items():
+                self._restore_well(position,saved)
+                restored.add(position)
+            for index,volume in snapshot['volumes'].items():
+                self._volumes[index] = volume
+        snapshot = self._snapshots[snapshot_id]
+        while len(self._mixture_list) > snapshot['num_mixtures']:
+            self._unindex_mixture(self._mixture_list.pop())
+        snapshot['wells'] = {}
+        snapshot['volumes'] = {}
+        del self._snapshots[snapshot_id+1:]
+        return len(restored)
+
+    def _unindex_mixture(self,mixture):
+        # the reverse of _index_mixture, for a mixture removed from the end of the list
+        name = mixture['mixture_name']
+        found = self._name_index.get(name)
+        if found is mixture:
+            del self._name_index[name]
+        elif type(found) is list and found[-1] is mixture:
+            found.pop()
+            if len(found)==1:
+                self._name_index[name] = found[0]
+        if type(mixture) is _Well and mixture._volumes is not None:
+            index = mixture._index
+            if self._position_index.get(index) is mixture:
+                for key in self._compound_keys.pop(index,()):
+                    positions = self._compound_index[key]
+                    positions.discard(index)
+                    if len(positions)==0:
+                        del self._compound_index[key]
+                if isinstance(mixture['compound_list'],CompoundList):
+                    mixture['compound_list']._container = None
+                del self._position_index[index]
+                self._occupied[index] = False
+                self._volumes[index] = 0
+                self._empty_cursor = min(self._empty_cursor,index[0]*self._cols+index[1])
+            mixture.unbind()
+
+    def release_snapshot(self,snapshot_id):
+        """ Drops snapshot snapshot_id and the ones taken after it, and keeps the 
+        current state.
+        """
+        if not 0 <= snapshot_id < len(self._snapshots):
+            raise Exception('Unknown snapshot %s' % (snapshot_id,))
+        if snapshot_id > 0:
+            # a well that is not saved in the previous snapshot had not changed since
+            previous = self._snapshots[snapshot_id-1]
+            for snapshot in self._snapshots[snapshot_id:]:
+                for position,saved in snapshot['wells'].items():
+                    previous['wells'].setdefault(position,saved)
+                for index,volume in snapshot['volumes'].items():
+                    previous['volumes'].setdefault(index,volume)
+        del self._snapshots[snapshot_id:]
+
     def shape(self):
         return (self._rows, self._cols)
 
@@ -463,6 +836,22 @@ class Container(MixtureList):
                              facecolormap={True:'lightblue'}
                              )
 
+    def graphical_print_volume_heatmap(self,units='nL'):
+        scale = {'nL':1,'uL':1e3,'mL':1e6}
+        if units not in scale:
+            raise Exception('unknown volume units')
+        f = plt.figure(figsize=(0.5*self._cols,0.5*self._rows))
+        plt.imshow(np.where(self._occupied,self._volumes/scale[units],np.nan),cmap='Blues')
+        plt.colorbar(label='volume (%s)' % (units,))
+        plt.gca().xaxis.tick_top()
+        plt.gca().set_xticks(np.arange(self._cols))
+        plt.gca().set_xticklabels(map(str,1+np.arange(self._cols)))
+        plt.gca().set_yticks(np.arange(self._rows))
+        plt.gca().set_yticklabels(rowletters[:self._rows])
+        plt.title(self._description)
+        plt.show()
+        return f
+
     def graphical_print_compounds_per_well(self):        
         max_compounds = max([len(w['compound_list']) for w in self])
         def mytextfunction(w):
@@ -629,23 +1018,23 @@ class Container(MixtureList):
             return list(zip(*[self.get_compounds(location,p) for p in properties]))
                 
     def get_positions_by_compound_type(self,type_filter,grid=None):        
-        positions = [];
-        for row in range(0,self._rows):
-            for col in range(0,self._cols):
-                compound_info = self.get_compounds((row,col),['type']); 
-                compound_types = [item for compound_type in compound_info for item in compound_type]; # flatten list of compound types
-                if compound_types != []:
-                    compound_position = position_to_grid((row,col),grid=grid);  # return position in tuple integer position form
-                    #compound_position = position_to_lettergrid((row,col)); # changed on 2018/11/16 C.Arcadia                                    
-                    if type_filter in compound_types:                        
-                            positions.append(compound_position);
-        return positions;
+        """ Positions (row by row) of the wells that hold a compound of this type.
+        """
+        return self._find_positions_by_property('type',type_filter,grid=grid)
+
+    def get_positions_by_compound_name(self,name,grid=None):
+        return self._find_positions_by_property('name',name,grid=grid)
+
+    def get_positions_by_cid(self,cid,grid=None):
+        return self._find_positions_by_property('cid',cid,grid=grid)
         
     def get_contents(self,locations=[],properties=['mass','name','cid','type'],type_filter=None,grid=None): # ['mass','name','cid','type','volume']
         # formats the contents of a container into a dictionary of lists containing info about the compounds (which can be type filtered) at each of the specified positions in a source plate
         if not isinstance(locations,(list,tuple)):
             locations = [locations];
-        if locations == []: # if not given locations assume we want the entire container
+        if locations == [] and type_filter is not None: # only the wells that hold the type
+            locations = self.get_positions_by_compound_type(type_filter);
+        elif locations == []: # if not given locations assume we want the entire container
             locations = self.list_filled_positions();                   
         contents = dict();
         contents['position'] = [];
@@ -776,6 +1165,23 @@ class tube50(Container):
 
 # position converters 
 
+_indexed_properties = ('type','name','cid') # compound properties of the Container index
+
+_plate_grids = {}
+
+def _plate_grid(rows,cols):
+    # the positions and letter grids of a plate, row by row, shared by all plates of a shape
+    if (rows,cols) not in _plate_grids:
+        positions = [(r,c) for r in range(rows) for c in range(cols)]
+        _plate_grids[(rows,cols)] = (positions,[position_to_lettergrid(p) for p in positions])
+    return _plate_grids[(rows,cols)]
+
+def _share_compounds(compound_list):
+    # the wells get copy-on-write references to the compounds instead of deep copies
+    if isinstance(compound_list,CompoundList):
+        return compound_list.share()
+    return copy.deepcopy(compound_list)
+
 rowletters = [chr(x) for x in range(ord('A'),ord('Z')+1)] + ['A' + chr(x) for x in range(ord('A'),ord('Z')+1)];    
 
 def position_to_lettergrid(position):
@@ -841,6 +1247,19 @@ def position_to_grid(position,grid=None):
         key = position; # assume input is in desired form (which can be in position form)
     return key
 
+def _as_position(key):
+    """ Returns key as a position tuple, or None if it is neither a position
+    nor a letter grid.
+    """
+    if type(key)==tuple or type(key)==list:
+        return tuple(key)
+    if type(key)==str:
+        try:
+            return lettergrid_to_position(key)
+        except ValueError:
+            return None
+    return None
+
 def grid_to_position(key,grid=None):
     if grid=='letter':
         position = lettergrid_to_position(key);                        
@@ -142,6 +142,7 @@ class TransferTask(Task):
         Kwargs:
             uncertainty_type (str). Should be 'gaussian' or 'uniform'.
             percentage_uncertainties (float)
+            random_state (numpy.random.Generator)  (optional, draws the volume errors. Default: numpy.random)
             verbose (bool).  
             enforce_volume_limits (bool)
             volume_increment (float)   (optional. in nL)
@@ -180,15 +181,18 @@ class TransferTask(Task):
         transfer_group_label = self._params.get('transfer_group_label',None)
 
         if uncertainties is not None and percentage_uncertainties is not None:
-            transfer_volumes = np.array(transfer_volumes, dtype='float32')
+            # every transfer gets its own error
+            random_state = kwargs.get('random_state', np.random)
+            transfer_volumes = np.array(transfer_volumes, dtype=float)
             if uncertainties=='gaussian':
-                transfer_volumes *= 1 + np.random.randn()*percentage_uncertainties
+                transfer_volumes *= 1 + random_state.standard_normal(len(transfer_volumes))*percentage_uncertainties
             elif uncertainties=='uniform':
-                transfer_volumes *= 1 + np.random.uniform(-percentage_uncertainties,
-                                                        percentage_uncertainties)
+                transfer_volumes *= 1 + random_state.uniform(-percentage_uncertainties,
+                                                             percentage_uncertainties,
+                                                             len(transfer_volumes))
             else:
                 raise Exception('Unknown distribution: %s' %(uncertainties,))
-            transfer_volumes = list(np.int32(transfer_volumes))
+            transfer_volumes = np.maximum(transfer_volumes, 0).tolist()
 
         if(verbose):
             print('\nRunning transfer. len=%d' % (len(from_positions)) )
@@ -3,9 +3,6 @@ set -e
 source venv/bin/activate
 export PYTHONPATH=$(pwd):$(pwd)/chemcpupy
 
-for sz in 8 12 16 28 
-do
-  python simulation/acidbase_writer_acc.py 3bit ${sz} 2 > acc_3bit_2class_${sz}.txt &
-done
-wait
+# one process pool for all image sizes, writes acc_3bit_2class_<size>.json
+python simulation/acidbase_sweep.py --datatype 3bit --imgsize 8 12 16 28 --num-classes 2
 echo "Done"
\ No newline at end of file
@@ -3,8 +3,5 @@ set -e
 source venv/bin/activate
 export PYTHONPATH=$(pwd):$(pwd)/chemcpupy
 
-for sz in 8 12 16 28 
-do
-  python simulation/acidbase_writer_acc.py bin ${sz} 2 > acc_bin_2class_${sz}.txt &
-done
-wait
\ No newline at end of file
+# one process pool for all image sizes, writes acc_bin_2class_<size>.json
+python simulation/acidbase_sweep.py --datatype bin --imgsize 8 12 16 28 --num-classes 2
\ No newline at end of file
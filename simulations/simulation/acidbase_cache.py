@@ -0,0 +1,64 @@
+import copy
+
+import chemcpupy
+from acidbase_network import AcidBaseNetwork
+
+
+def load_source_concentrations(platesheet_file, grid='letter'):
+    """ Reads the concentrations [mM] of the acid and of the base of a source platesheet """
+    source_plate = chemcpupy.WellPlate384PP(description='source')
+    source_plate.load_platesheet(platesheet_file, fill_from_csv=True, grid=grid)
+    concs = []
+    for compound_type in ('acid', 'base'):
+        positions = source_plate.get_positions_by_compound_type(compound_type, grid=grid)
+        concs.append(source_plate.get_contents(locations=positions, properties=['concentration'])['concentration'][0])
+    return tuple(concs)
+
+class AcidBaseRunCache:
+    """ Parses the source platesheet and the kernel file once per run.
+    The accuracy loop evaluates thousands of images against the same source plate
+    and weights, so each image gets a cheap, independent copy of the cached state
+    instead of re-reading the files and re-scanning the plate.
+    """
+    def __init__(self, platesheet_file, kernel_file, num_neurons=2, img_width=8, img_height=8, grid='letter'):
+        self.num_neurons = num_neurons
+        self.img_width = img_width
+        self.img_height = img_height
+
+        self._source_plate = chemcpupy.WellPlate384PP(description='source')
+        self._source_plate.load_platesheet(platesheet_file, fill_from_csv=True, grid=grid)
+
+        self.acid_positions = self._source_plate.get_positions_by_compound_type('acid', grid=grid)
+        self.base_positions = self._source_plate.get_positions_by_compound_type('base', grid=grid)
+        self.water_positions = self._source_plate.get_positions_by_compound_type('water', grid=grid)
+        self.indicator_positions = self._source_plate.get_positions_by_compound_type('indicator', grid=grid)
+        self.acid_info = self._source_plate.get_contents(locations=self.acid_positions, properties=['mass', 'name', 'cid', 'concentration', 'type', 'volume'])
+        self.base_info = self._source_plate.get_contents(locations=self.base_positions, properties=['mass', 'name', 'cid', 'concentration', 'type', 'volume'])
+        self.acid_conc = self.acid_info['concentration'][0]
+        self.acid_volume = self.acid_info['volume'][0]
+        self.acid_cids = self.acid_info['cid'][0]
+        self.base_conc = self.base_info['concentration'][0]
+        self.base_volume = self.base_info['volume'][0]
+        self.base_cids = self.base_info['cid'][0]
+
+        network = self._make_network()
+        network.load_weights(kernel_file)
+        self._neurons = network.neurons
+
+    def _make_network(self):
+        return AcidBaseNetwork(num_neurons=self.num_neurons, weights_per_neuron=self.img_width*self.img_height, img_width=self.img_width, img_height=self.img_height)
+
+    def new_source_plate(self):
+        """ Returns an independent copy of the loaded source plate """
+        return copy.deepcopy(self._source_plate)
+
+    def new_network(self):
+        """ Returns a fresh AcidBaseNetwork with the cached weights loaded """
+        network = self._make_network()
+        network.neurons = [list(neuron) for neuron in self._neurons]
+        network.weights_loaded = True
+        return network
+
+    def get_weight_matrix(self):
+        """ Returns the cached weights as a (pixels x neurons) array """
+        return self.new_network().get_weight_matrix()
@@ -0,0 +1,129 @@
+import argparse
+import itertools
+import os
+import sys
+
+import numpy as np
+
+from acidbase_network import load_image_batch
+
+num_map = {
+	0: 'zero',
+	1: 'one',
+	2: 'two',
+	3: 'three',
+	4: 'four',
+	5: 'five',
+	6: 'six',
+	7: 'seven',
+	8: 'eight',
+	9: 'nine'
+}
+
+
+def get_dataset_paths(data_path, datatype, imgsize, num_classes):
+    """ Returns the image directory and the kernel/neurons/labels files of a dataset """
+    dataset_dir = os.path.join(data_path, 'dataset_{}'.format(datatype))
+    return {
+        'images': os.path.join(dataset_dir, 'img{}'.format(imgsize)),
+        'kernel': os.path.join(dataset_dir, 'kernel_mem_{}_{}.txt'.format(num_classes, imgsize)),
+        'neurons': os.path.join(dataset_dir, 'neurons_{}_{}.txt'.format(num_classes, imgsize)),
+        'labels': os.path.join(dataset_dir, 'labels_{}_{}.txt'.format(num_classes, imgsize)),
+        'packed': os.path.join(dataset_dir, 'packed_{}_{}.npy'.format(num_classes, imgsize)),
+    }
+
+
+def read_dataset_index(data_path, datatype, imgsize, num_classes):
+    """ Lists the images of a dataset that belong to the first num_classes digits, sorted by
+    filename, together with their TF labels and TF neuron outputs.
+    Returns (filenames, labels, tf_outputs).
+    """
+    paths = get_dataset_paths(data_path, datatype, imgsize, num_classes)
+    img_prefix = ['img_' + num_map[digit] for digit in range(num_classes)]
+    filenames = sorted(img for img in os.listdir(paths['images']) if any(img.startswith(name) for name in img_prefix))
+
+    tf_outputs = {}
+    tf_labels = {}
+    with open(paths['neurons'], mode='r') as neurons_file_f:
+        with open(paths['labels'], mode='r') as labels_file_f:
+            neurons_file_lines = neurons_file_f.read().splitlines()
+            labels_file_lines = labels_file_f.read().splitlines()
+            for i, n_line in enumerate(neurons_file_lines):
+                l_line = labels_file_lines[i]
+                n_parts = n_line.split(',')
+                lbl = l_line.split(',')[1]
+                img_file = n_parts[0]
+                tf_labels[img_file] = int(lbl)
+                tf_outputs[img_file] = [float(outp) for outp in n_parts[1:]]
+
+    labels = np.array([tf_labels[img] for img in filenames], dtype=np.int64)
+    outputs = np.array([tf_outputs[img] for img in filenames], dtype=np.float64).reshape(len(filenames), num_classes)
+    return filenames, labels, outputs
+
+
+def load_dataset_images(data_path, datatype, imgsize, filenames):
+    """ Loads the given image files of a dataset into an (images x pixels) array """
+    image_dir = os.path.join(data_path, 'dataset_{}'.format(datatype), 'img{}'.format(imgsize))
+    return load_image_batch([os.path.join(image_dir, img) for img in filenames])
+
+
+def pack_dataset(data_path, datatype, imgsize, num_classes, filename=None):
+    """ Packs the images, TF labels, filenames and TF outputs of a dataset into one .npy file
+    holding a structured array with one record per image. The file can be opened with
+    load_packed_dataset without reading the per-image text files. Returns the file name.
+    """
+    if filename is None:
+        filename = get_dataset_paths(data_path, datatype, imgsize, num_classes)['packed']
+    filenames, labels, tf_outputs = read_dataset_index(data_path, datatype, imgsize, num_classes)
+    images = load_dataset_images(data_path, datatype, imgsize, filenames).reshape(len(filenames), imgsize * imgsize)
+
+    name_length = max([len(img) for img in filenames] + [1])
+    dtype = np.dtype([('filename', 'S{}'.format(name_length)),
+                      ('label', np.int8),
+                      ('image', np.int8, (imgsize * imgsize,)),
+                      ('tf_outputs', np.float64, (num_classes,))])
+    records = np.zeros(len(filenames), dtype=dtype)
+    records['filename'] = [img.encode('ascii') for img in filenames]
+    records['label'] = labels
+    records['image'] = images
+    records['tf_outputs'] = tf_outputs
+
+    # write next to the target and rename, so that readers never see a partial file
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        np.save(f, records)
+    os.replace(temp_filename, filename)
+    return filename
+
+
+def load_packed_dataset(filename, mmap_mode='r'):
+    """ Opens a packed dataset. The returned structured array is memory-mapped by default;
+    its 'image', 'label', 'tf_outputs' and 'filename' fields are views into the file.
+    """
+    return np.load(filename, mmap_mode=mmap_mode)
+
+
+def read_packed_dataset_index(filename):
+    """ Same as read_dataset_index, for a packed dataset. Returns (filenames, labels, tf_outputs). """
+    records = load_packed_dataset(filename)
+    filenames = [img.decode('ascii') for img in records['filename']]
+    return filenames, np.array(records['label'], dtype=np.int64), np.array(records['tf_outputs'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack the simulation datasets into one memory-mappable file per configuration.')
+    parser.add_argument('--datatype', nargs='+', default=['bin', '3bit'], choices=['bin', '3bit'])
+    parser.add_argument('--imgsize', nargs='+', type=int, default=[8, 12, 16, 28])
+    parser.add_argument('--num-classes', nargs='+', type=int, default=[2, 3])
+    parser.add_argument('--data-path', default=os.path.join(os.path.dirname(__file__), './datasets'))
+    args = parser.parse_args(argv)
+
+    for datatype, imgsize, num_classes in itertools.product(args.datatype, args.imgsize, args.num_classes):
+        paths = get_dataset_paths(args.data_path, datatype, imgsize, num_classes)
+        if not (os.path.isdir(paths['images']) and os.path.isfile(paths['neurons'])):
+            continue
+        print('Packed', pack_dataset(args.data_path, datatype, imgsize, num_classes))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@description: forecasts how much every source well gives over a run of many images, when each
+              well reaches its dead volume, and how many refills and source plates the run needs
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+from acidbase_cache import AcidBaseRunCache
+from acidbase_dataset import get_dataset_paths, read_dataset_index, load_dataset_images, load_packed_dataset
+from acidbase_sweep import default_data_path, vol1536_data
+
+dirname = os.path.dirname(__file__)
+
+default_platesheet = os.path.join(dirname, 'platesheet.csv')
+
+
+def _round_robin_counts(num_transfers, num_wells):
+    """ Number of transfers that every well gives when transfer k uses well k % num_wells """
+    return num_transfers // num_wells + (np.arange(num_wells) < num_transfers % num_wells)
+
+
+def count_source_draws(network, images, num_acid, num_base, num_water, transfer_unit_vol=vol1536_data, weighted=False, grayscale=None):
+    """ Computes the volume that every source well gives to every image of the data plate, with
+    the sources assigned like AcidBaseNetwork.generate_weighted_data_plate does: the k-th
+    (neuron, pixel) pair with a non-zero weight takes its acid from acid well k % num_acid and
+    its base from base well k % num_base. Every transfer is transfer_unit_vol, as in the Echo picklists of
+    acidbase_writer_acc.py. With weighted set, the transfers are the volumes that the network
+    accumulates instead: grayscale 'on' pixels transfer abs(val)/4.0 of a unit and get one unit
+    of water per level on both wells of every neuron, taken from the water wells in turn.
+    Returns (images x wells) arrays of nL for the 'acid', 'base' and 'water' wells.
+    """
+    images = np.atleast_2d(np.asarray(images))
+    if grayscale is None:
+        grayscale = network.grayscale
+    num_images, num_pixels = images.shape
+    active = network.get_active_pairs(num_pixels)
+    num_pairs = int(active.sum())
+    is_on = images > 0
+    if weighted and grayscale:
+        quarters = np.where(is_on, np.abs(images), 4).astype(np.float64)
+    else:
+        quarters = np.full(images.shape, 4.0)
+
+    # a well's draw is a matrix product of the pixel volumes with the number of neurons that
+    # send each pixel to the well
+    pair_pixel = np.nonzero(active)[1]
+    pair_index = np.arange(num_pairs)
+    draws = {}
+    for compound_type, num_wells in (('acid', num_acid), ('base', num_base)):
+        pixel_wells = np.zeros((num_pixels, num_wells))
+        if num_wells > 0:
+            np.add.at(pixel_wells, (pair_pixel, pair_index % num_wells), 1.0)
+        elif num_pairs > 0:
+            raise Exception('The source plate has no %s wells' % (compound_type,))
+        draws[compound_type] = (quarters @ pixel_wells) * (transfer_unit_vol / 4.0)
+
+    draws['water'] = np.zeros((num_images, num_water))
+    if weighted and grayscale:
+        num_water_units = np.where(is_on, images, 0) @ active.sum(axis=0) * 2
+        if num_water > 0:
+            for i, num_transfers in enumerate(num_water_units.tolist()):
+                draws['water'][i] = _round_robin_counts(int(num_transfers), num_water) * transfer_unit_vol
+        elif np.any(num_water_units > 0):
+            raise Exception('The source plate has no water wells')
+    return draws
+
+
+def forecast_refills(source_plate, network, images, transfer_unit_vol=vol1536_data, weighted=False, grayscale=None, grid='letter'):
+    """ Forecasts the source wells of a run that evaluates images in order on one data plate
+    layout. The cumulative draw of every well is a prefix sum over the images, so the image
+    during which a well goes below the plate's volume_min is found with a binary search.
+    Refilling a well restores its initial volume. The number of source plates assumes that
+    the whole plate is replaced between images as soon as any well would run dry (and within
+    an image only when a single image needs more than a full plate).
+    Returns a dict with one entry per well and the totals of the run.
+    """
+    volume_min = source_plate.get_param('volume_min')
+    positions = {compound_type: source_plate.get_positions_by_compound_type(compound_type, grid=grid) for compound_type in ('acid', 'base', 'water')}
+    draws = count_source_draws(network, images, len(positions['acid']), len(positions['base']), len(positions['water']),
+                               transfer_unit_vol=transfer_unit_vol, weighted=weighted, grayscale=grayscale)
+
+    well_positions = []
+    well_types = []
+    for compound_type in ('acid', 'base', 'water'):
+        well_positions += positions[compound_type]
+        well_types += [compound_type] * len(positions[compound_type])
+    draw = np.concatenate([draws['acid'], draws['base'], draws['water']], axis=1)
+    num_images = draw.shape[0]
+    initial = np.array(source_plate.get_contents(locations=well_positions, properties=['type'], grid=grid)['well_volume'], dtype=np.float64) \
+        if well_positions else np.zeros(0)
+    usable = np.maximum(initial - volume_min, 0.0)
+
+    # cumulative[i] is the draw of images [0, i), so a plate started before image s runs dry
+    # during the first image t with cumulative[t + 1] - cumulative[s] > usable
+    cumulative = np.vstack([np.zeros((1, draw.shape[1])), np.cumsum(draw, axis=0)])
+    total = cumulative[-1]
+    wells = []
+    for w, (position, compound_type) in enumerate(zip(well_positions, well_types)):
+        depletion = int(np.searchsorted(cumulative[1:, w], usable[w], side='right'))
+        if usable[w] > 0:
+            refills = max(0, math.ceil(total[w] / usable[w]) - 1)
+        else:
+            refills = 0 if total[w] == 0 else None
+        wells.append({
+            'position': position,
+            'type': compound_type,
+            'initial_nL': float(initial[w]),
+            'draw_per_image_nL': round(float(total[w] / num_images), 2) if num_images > 0 else 0.0,
+            'total_nL': round(float(total[w]), 2),
+            'depletion_image': depletion if depletion < num_images else None,
+            'refills': refills,
+        })
+
+    drawn = total > 0
+    if np.any(drawn & (usable <= 0)):
+        num_plates = None
+    else:
+        num_plates = 0
+        start = 0
+        while start < num_images:
+            limit = cumulative[start] + usable
+            ends = [np.searchsorted(cumulative[start + 1:, w], limit[w], side='right') for w in np.flatnonzero(drawn)]
+            end = start + int(min(ends)) if ends else num_images
+            if end == start:
+                # a single image needs more than one plate
+                num_plates += int(np.max(np.ceil(draw[start][drawn] / usable[drawn])))
+                start += 1
+            else:
+                num_plates += 1
+                start = end
+
+    report = {
+        'num_images': num_images,
+        'transfer_unit_vol': transfer_unit_vol,
+        'weighted': weighted,
+        'volume_min': volume_min,
+        'wells': wells,
+        'total_nL': {compound_type: round(float(draws[compound_type].sum()), 2) for compound_type in ('acid', 'base', 'water')},
+        'first_depletion_image': min([well['depletion_image'] for well in wells if well['depletion_image'] is not None], default=None),
+        'refills': None if any(well['refills'] is None for well in wells) else sum(well['refills'] for well in wells),
+        'source_plates': num_plates,
+    }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Forecast the source well draws, refills and source plates of a run.')
+    parser.add_argument('--datatype', default='bin', choices=['bin', '3bit'])
+    parser.add_argument('--imgsize', type=int, default=8, choices=[8, 12, 16, 28])
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--platesheet', default=default_platesheet)
+    parser.add_argument('--vol-data', type=float, default=vol1536_data, help='volume transferred to every data well [nL]')
+    parser.add_argument('--weighted', action='store_true', help='transfer the volumes accumulated by the network model (grayscale levels and water)')
+    parser.add_argument('--repeat', type=int, default=1, help='number of passes over the dataset')
+    parser.add_argument('--data-path', default=default_data_path)
+    parser.add_argument('--output', default=None, help='write the forecast to this JSON file')
+    args = parser.parse_args(argv)
+
+    paths = get_dataset_paths(args.data_path, args.datatype, args.imgsize, args.num_classes)
+    if os.path.isfile(paths['packed']):
+        images = np.asarray(load_packed_dataset(paths['packed'])['image'])
+    else:
+        filenames, labels, tf_outputs = read_dataset_index(args.data_path, args.datatype, args.imgsize, args.num_classes)
+        images = load_dataset_images(args.data_path, args.datatype, args.imgsize, filenames)
+    images = np.tile(images, (args.repeat, 1))
+
+    run_cache = AcidBaseRunCache(args.platesheet, paths['kernel'], num_neurons=args.num_classes, img_width=args.imgsize, img_height=args.imgsize)
+    network = run_cache.new_network()
+    network.grayscale = (args.datatype == '3bit')
+    report = forecast_refills(run_cache.new_source_plate(), network, images, transfer_unit_vol=args.vol_data, weighted=args.weighted)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print('Images', report['num_images'])
+    for compound_type, volume in report['total_nL'].items():
+        print('Total', compound_type, round(volume * 1e-3, 2), 'uL')
+    for well in report['wells']:
+        if well['total_nL'] > 0:
+            depletion = 'never' if well['depletion_image'] is None else well['depletion_image']
+            print('{:>4s} {:6s} {:10.1f} nL/image, runs dry during image {}, {} refill(s)'.format(
+                  well['position'], well['type'], well['draw_per_image_nL'], depletion, well['refills']))
+    print('First depletion at image', report['first_depletion_image'])
+    print('Refills', report['refills'])
+    print('Source plates', report['source_plates'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
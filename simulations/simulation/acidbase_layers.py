@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@description: multi-layer acid/base networks. The dual-rail outputs of every layer are thresholded
+              into acid/base sources that are the inputs of the next layer
+"""
+
+import argparse
+import math
+import os
+import sys
+
+import numpy as np
+
+from ph_calculator import calculate_acid_ph, calculate_base_ph
+from acidbase_network import AcidBaseNetwork, decode_neuron_outputs, score_neuron_outputs
+from acidbase_layout import compile_blocks_layout
+from acidbase_dataset import read_dataset_index, load_dataset_images, get_dataset_paths, \
+                             load_packed_dataset, read_packed_dataset_index
+from acidbase_cache import load_source_concentrations
+from acidbase_sweep import default_data_path, default_platesheet, vol1536_data
+
+plate1536_rows = 32
+plate1536_cols = 48
+plate384_rows = 16
+
+
+class AcidBaseLayeredNetwork:
+    """ A stack of dense acid/base layers. layer_sizes gives the number of neurons of every
+    layer; the first layer reads the image and every other layer reads the neurons of the
+    layer before it. A neuron that reads 1 (acidic left rail, basic right rail) is an 'on'
+    input of the next layer, any other neuron (including an invalid one) an 'off' input.
+    """
+    def __init__(self, layer_sizes, img_width=8, img_height=8):
+        self.img_width = img_width
+        self.img_height = img_height
+        self.layers = []
+        num_inputs = img_width * img_height
+        for num_neurons in layer_sizes:
+            self.layers.append(AcidBaseNetwork(num_neurons=num_neurons, weights_per_neuron=num_inputs,
+                                               img_width=img_width, img_height=img_height))
+            num_inputs = num_neurons
+
+    @property
+    def num_neurons(self):
+        return self.layers[-1].num_neurons
+
+    def load_weights(self, filenames):
+        """ Loads the weights of every layer, one kernel file per layer (same format as
+        AcidBaseNetwork.load_weights)
+        """
+        if len(filenames) != len(self.layers):
+            raise Exception('Expected %d kernel files, got %d' % (len(self.layers), len(filenames)))
+        for layer, filename in zip(self.layers, filenames):
+            layer.load_weights(filename)
+
+    def get_weight_matrices(self):
+        """ Returns the (inputs x neurons) weight matrix of every layer """
+        return [layer.get_weight_matrix() for layer in self.layers]
+
+    def evaluate_batch(self, images, weights=None, transfer_unit_vol=1.0, acid_ph=1, base_ph=13, grayscale=False, fast=False):
+        """ Simulates the whole stack for a batch of images. Every layer is evaluated with
+        AcidBaseNetwork.evaluate_batch (or classify_batch when fast is set) and its states
+        become the binary inputs of the next layer.
+        Returns a dict with the final 'states' and 'invalid' arrays (as decode_neuron_outputs),
+        and 'layers', a list with the 'states', 'invalid' (and 'ph' unless fast) of every layer.
+        """
+        if weights is None:
+            weights = self.get_weight_matrices()
+        inputs = np.atleast_2d(np.asarray(images))
+        layer_outputs = []
+        for k, (layer, layer_weights) in enumerate(zip(self.layers, weights)):
+            # only the image can be grayscale, the hidden inputs are on or off
+            layer_grayscale = grayscale if k == 0 else False
+            if fast:
+                outputs = layer.classify_batch(inputs, weights=layer_weights, transfer_unit_vol=transfer_unit_vol,
+                                               acid_ph=acid_ph, base_ph=base_ph, grayscale=layer_grayscale)
+                states, invalid = outputs['states'], outputs['invalid']
+                layer_outputs.append({'states': states, 'invalid': invalid, 'num_fallback': outputs['num_fallback']})
+            else:
+                ph = layer.evaluate_batch(inputs, weights=layer_weights, transfer_unit_vol=transfer_unit_vol,
+                                          acid_ph=acid_ph, base_ph=base_ph, grayscale=layer_grayscale)['ph']
+                states, invalid = decode_neuron_outputs(ph)
+                layer_outputs.append({'states': states, 'invalid': invalid, 'ph': ph})
+            inputs = (states == 1).astype(np.int8)
+        return {'states': layer_outputs[-1]['states'], 'invalid': layer_outputs[-1]['invalid'], 'layers': layer_outputs}
+
+    def get_layer_resources(self, starting_letter='A', starting_index=1):
+        """ Counts the wells, plates and transfers that every layer needs for one image.
+        The data wells of a layer are laid out on 1536-well plates like
+        AcidBaseNetwork.generate_weighted_data_plate does, and every neuron is pooled into
+        two wells of a 384-well plate. Zero weights get no wells and no transfers. The water
+        of grayscale images is not counted.
+        """
+        resources = []
+        for k, layer in enumerate(self.layers):
+            num_inputs = layer.weights_per_neuron
+            block_sizes = tuple(layer.get_active_pairs(num_inputs).sum(axis=1).tolist())
+            num_pairs = sum(block_sizes)
+            layout = compile_blocks_layout(block_sizes, starting_letter, starting_index, plate1536_cols)
+            rows_used = int(layout.rows.max()) - ord(starting_letter) + 1 if len(layout) > 0 else 0
+            resources.append({
+                'layer': k,
+                'inputs': num_inputs,
+                'neurons': layer.num_neurons,
+                'data_wells': len(layout),
+                'data_plates': math.ceil(rows_used / plate1536_rows),
+                # one acid and one base transfer per (neuron, input) with a non-zero weight
+                'data_transfers': 2 * num_pairs,
+                'pool_wells': 2 * layer.num_neurons,
+                'pool_plates': math.ceil(layer.num_neurons / plate384_rows),
+                # every data well is pooled into the left or right well of its neuron
+                'pool_transfers': 2 * num_pairs,
+            })
+        return resources
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluate a multi-layer acid/base network on a dataset.')
+    parser.add_argument('--datatype', default='bin', choices=['bin', '3bit'])
+    parser.add_argument('--imgsize', type=int, default=8, choices=[8, 12, 16, 28])
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--layer-sizes', nargs='+', type=int, required=True, help='neurons per layer, the last one is num_classes')
+    parser.add_argument('--kernels', nargs='+', required=True, help='one kernel file per layer')
+    parser.add_argument('--data-path', default=default_data_path)
+    parser.add_argument('--platesheet', default=default_platesheet, help='source plate, for the acid and base concentrations')
+    parser.add_argument('--fast', action='store_true', help='classify every layer with the integer fast path')
+    args = parser.parse_args(argv)
+
+    if args.layer_sizes[-1] != args.num_classes:
+        raise Exception('The last layer must have num_classes neurons')
+    network = AcidBaseLayeredNetwork(args.layer_sizes, img_width=args.imgsize, img_height=args.imgsize)
+    network.load_weights(args.kernels)
+
+    packed_file = get_dataset_paths(args.data_path, args.datatype, args.imgsize, args.num_classes)['packed']
+    if os.path.isfile(packed_file):
+        filenames, labels, tf_outputs = read_packed_dataset_index(packed_file)
+        images = np.asarray(load_packed_dataset(packed_file)['image'])
+    else:
+        filenames, labels, tf_outputs = read_dataset_index(args.data_path, args.datatype, args.imgsize, args.num_classes)
+        images = load_dataset_images(args.data_path, args.datatype, args.imgsize, filenames)
+
+    acid_conc, base_conc = load_source_concentrations(args.platesheet)
+    outputs = network.evaluate_batch(images, transfer_unit_vol=(vol1536_data * 1e-9),
+                                     acid_ph=calculate_acid_ph(acid_conc * 1e-3), base_ph=calculate_base_ph(base_conc * 1e-3),
+                                     grayscale=(args.datatype == '3bit'), fast=args.fast)
+    is_correct = score_neuron_outputs(outputs['states'], outputs['invalid'], tf_outputs)
+
+    for layer, resources in zip(outputs['layers'], network.get_layer_resources()):
+        print('Layer', resources['layer'], ':', resources['inputs'], 'inputs,', resources['neurons'], 'neurons,',
+              resources['data_plates'], 'data plate(s),', resources['pool_plates'], 'pool plate(s),',
+              resources['data_transfers'] + resources['pool_transfers'], 'transfers per image,',
+              int(np.sum(layer['invalid'])), 'invalid outputs')
+    print('Accuracy', round(100 * np.mean(is_correct), 2) if len(filenames) > 0 else None)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,111 @@
+import functools
+import math
+
+import numpy as np
+
+
+class PlateLayout:
+    """ Destination wells of a plate plan as integer arrays.
+    rows holds the code point of the row letter and cols the 1-based column, one entry
+    per well, in transfer order. Letter-grid positions ('A1', 'A2', ...) are only built
+    when the layout is exported.
+    """
+    def __init__(self, rows, cols):
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.rows.setflags(write=False)
+        self.cols.setflags(write=False)
+        self._positions = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def positions(self):
+        """ Returns the wells as a list of letter-grid positions """
+        if self._positions is None:
+            self._positions = tuple(chr(row) + str(col) for row, col in zip(self.rows.tolist(), self.cols.tolist()))
+        return list(self._positions)
+
+
+@functools.lru_cache(maxsize=64)
+def compile_block_layout(num_blocks, block_size, starting_letter, starting_index, max_col):
+    """ Layout of num_blocks blocks of block_size well pairs, as written by the data and
+    weights plates. Wells are filled along a row and wrap to column 1 of the next row after
+    max_col (no wrapping if max_col is infinite). Every block after the first skips two
+    rows past the row the previous block ended on and starts at column 1.
+    Layouts are cached, so the wells of a given image size and neuron count are only
+    computed once.
+    """
+    return compile_blocks_layout((block_size,) * num_blocks, starting_letter, starting_index, max_col)
+
+
+@functools.lru_cache(maxsize=64)
+def compile_blocks_layout(block_sizes, starting_letter, starting_index, max_col):
+    """ Like compile_block_layout, with block_sizes[b] well pairs in block b (e.g. the
+    non-zero weights of every neuron of a sparse network). Empty blocks take no rows.
+    """
+    block_layouts = []
+    block_row = ord(starting_letter)
+    block_col = starting_index
+    for block_size in block_sizes:
+        if block_size == 0:
+            continue
+        wells_per_block = 2 * block_size
+        offsets = np.arange(wells_per_block, dtype=np.int64)
+        if math.isinf(max_col):
+            rows = np.full(wells_per_block, block_row, dtype=np.int64)
+            cols = block_col + offsets
+            next_row = block_row
+        else:
+            linear = (block_col - 1) + offsets
+            rows = block_row + linear // int(max_col)
+            cols = linear % int(max_col) + 1
+            # the well after the last one of the block
+            next_row = block_row + ((block_col - 1) + wells_per_block) // int(max_col)
+        block_layouts.append((rows, cols))
+        block_row = next_row + 2
+        block_col = 1
+    if not block_layouts:
+        return PlateLayout([], [])
+    return PlateLayout(np.concatenate([rows for rows, _ in block_layouts]), np.concatenate([cols for _, cols in block_layouts]))
+
+
+@functools.lru_cache(maxsize=64)
+def compile_row_layout(num_rows, row_size, starting_letter, starting_index):
+    """ Layout of the summation plate: the row_size well pairs of row r all go to the two
+    wells starting_index and starting_index + 1 of row starting_letter + r.
+    """
+    return compile_rows_layout((row_size,) * num_rows, starting_letter, starting_index)
+
+
+@functools.lru_cache(maxsize=64)
+def compile_rows_layout(row_sizes, starting_letter, starting_index):
+    """ Like compile_row_layout, with row_sizes[r] well pairs in row r """
+    row_sizes = np.array(row_sizes, dtype=np.int64).reshape(-1)
+    rows = np.repeat(ord(starting_letter) + np.arange(len(row_sizes), dtype=np.int64), 2 * row_sizes)
+    cols = np.tile(np.array([starting_index, starting_index + 1], dtype=np.int64), int(row_sizes.sum()))
+    return PlateLayout(rows, cols)
+
+
+def object_array(values):
+    """ Puts positions (strings or tuples) into a 1-D object array """
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+def select_pairs(first_is_a, a, b):
+    """ Picks the sources of the two wells of every pair: (a, b) where first_is_a is set and
+    (b, a) otherwise. a and b are object arrays (or single positions) that broadcast with
+    first_is_a. Returns the interleaved list of sources.
+    """
+    if not isinstance(a, np.ndarray):
+        a = object_array([a])
+    if not isinstance(b, np.ndarray):
+        b = object_array([b])
+    first_is_a = np.asarray(first_is_a, dtype=bool)
+    pairs = np.empty(2 * len(first_is_a), dtype=object)
+    pairs[0::2] = np.where(first_is_a, a, b)
+    pairs[1::2] = np.where(first_is_a, b, a)
+    return pairs.tolist()
@@ -1,11 +1,46 @@
 import numpy as np
 
 from ph_calculator import *
+import ph_calculator_array
+from acidbase_layout import compile_block_layout, compile_blocks_layout, compile_row_layout, compile_rows_layout, object_array, select_pairs
 
 def read_file(filepath):
     with open(filepath, "r") as f:
         return f.read()
 
+def load_image_batch(filenames):
+    """ Loads a list of image files into an (images x pixels) array """
+    return np.array([[int(float(val)) for val in read_file(filename).splitlines()] for filename in filenames], dtype=np.int64)
+
+def _accumulate(total, values):
+    """ Adds values to total one at a time, in order, like a running sum over transfers """
+    if len(values) == 0:
+        return total
+    return float(np.cumsum(np.concatenate(([total], values)))[-1])
+
+def decode_neuron_outputs(expected_ph):
+    """ Thresholds an (images x neurons x 2) array of left/right pH into neuron states.
+    A neuron is 1 when its left rail is acidic and its right rail is basic, 0 when it is
+    the other way around (or both rails are neutral) and -1 otherwise. An image is invalid
+    if any neuron is -1 or if more than one neuron is 1. Returns (states, invalid).
+    """
+    left = expected_ph[..., 0]
+    right = expected_ph[..., 1]
+    states = np.full(left.shape, -1, dtype=np.int8)
+    states[((left > 7.0) & (right < 7.0)) | ((left == 7.0) & (right == 7.0))] = 0
+    states[(left < 7.0) & (right > 7.0)] = 1
+    invalid = np.any(states == -1, axis=-1) | (np.sum(states == 1, axis=-1) > 1)
+    return states, invalid
+
+def score_neuron_outputs(states, invalid, tf_outputs):
+    """ Compares decoded neuron states with the (images x neurons) TF neuron outputs.
+    An image is correct when it is valid and every neuron that is 1 has a positive
+    TF output while every neuron that is 0 has a non-positive one.
+    """
+    tf_outputs = np.asarray(tf_outputs)
+    mismatch = ((states == 1) & (tf_outputs <= 0)) | ((states == 0) & (tf_outputs > 0))
+    return ~invalid & ~np.any(mismatch, axis=-1)
+
 class AcidBaseNetwork:
     """" Describes the structure of an acid base network """ 
     def __init__(self, num_neurons=2, weights_per_neuron=64, img_width=8, img_height=8):
@@ -33,7 +68,21 @@ class AcidBaseNetwork:
             self.neurons[i] = weights[i * self.weights_per_neuron: (i + 1) * self.weights_per_neuron]
         self.weights_loaded = True
 
-    
+    def get_weight_matrix(self):
+        """ Returns the loaded weights as a (pixels x neurons) array """
+        return np.array(self.neurons, dtype=np.int64).T
+
+    def get_active_pairs(self, num_pixels):
+        """ Returns a (neurons x pixels) mask of the (neuron, pixel) pairs whose weight is not
+        zero. Pair (n, p) uses weight (n * num_pixels + p) % weights_per_neuron of neuron n.
+        Zero weights get no wells and no transfers.
+        """
+        if not self.weights_loaded:
+            return np.ones((self.num_neurons, num_pixels), dtype=bool)
+        pair_index = np.arange(self.num_neurons * num_pixels).reshape(self.num_neurons, num_pixels)
+        weights = np.array(self.neurons)
+        return weights[np.arange(self.num_neurons)[:, None], pair_index % self.weights_per_neuron] != 0
+
     def load_image(self, filename, img_levels=None):
         """ load an image file into the network """
         self.img = [int(float(val)) for val in read_file(filename).splitlines()]
@@ -43,154 +92,171 @@ class AcidBaseNetwork:
         self.image_loaded = True
 
     def generate_data_plate(self, acid_source, base_source, starting_letter, starting_index, max_row, max_col):
-        pos_list_data_source = [];
-        pos_list_data_destin = [];
-        letter_counter = ord(starting_letter)
-        index_counter = starting_index
-        get_next_counter = lambda letter, index: (letter, index + 1) if index + 1 <= max_col else (letter + 1, 1)
-        for _ in range(0, self.num_neurons):
-            for val in self.img:
-                is_acid = val == 1
-                first_dest_pos = chr(letter_counter) + str(index_counter)
-                letter_counter, index_counter = get_next_counter(letter_counter, index_counter)
-                second_dest_pos = chr(letter_counter) + str(index_counter)
-                letter_counter, index_counter = get_next_counter(letter_counter, index_counter)
-                if is_acid:
-                    pos_list_data_source.append(acid_source)
-                    pos_list_data_source.append(base_source)
-                else:
-                    pos_list_data_source.append(base_source)
-                    pos_list_data_source.append(acid_source)
-                pos_list_data_destin.append(first_dest_pos)
-                pos_list_data_destin.append(second_dest_pos)
-            letter_counter = letter_counter + 2
-            index_counter = 1
+        active = self.get_active_pairs(len(self.img))
+        layout = compile_blocks_layout(tuple(active.sum(axis=1).tolist()), starting_letter, starting_index, max_col)
+        is_acid = np.broadcast_to(np.array(self.img) == 1, active.shape)[active]
+        pos_list_data_source = select_pairs(is_acid, acid_source, base_source)
+        pos_list_data_destin = layout.positions()
         return pos_list_data_source, pos_list_data_destin
 
-    def generate_weighted_data_plate(self, acid_positions, base_positions, water_positions, source_max_transfers, starting_letter, starting_index, max_row, max_col, transfer_unit_vol, acid_conc, base_conc):
-        pos_list_data_source = [];
-        pos_list_data_destin = [];
-        letter_counter = ord(starting_letter)
-        index_counter = starting_index
-        get_next_counter = lambda letter, index: (letter, index + 1) if index + 1 <= max_col else (letter + 1, 1)
-        weight_index = 0
-
-        current_acid_index = 0
-        current_base_index = 0
-        current_water_index = 0
-        base_ph = calculate_base_ph(base_conc)
-        acid_ph = calculate_acid_ph(acid_conc)
-        water_pos_list_data_source = []
-        water_pos_list_data_destin = []
-        for neuron_index in range(0, self.num_neurons):
-            for val in self.img:
-                flip = self.neurons[neuron_index][weight_index] == -1
-                # flip = False
-                weight_index = (weight_index + 1) % self.weights_per_neuron
-                is_on = val > 0
-                first_dest_pos = chr(letter_counter) + str(index_counter)
-                letter_counter, index_counter = get_next_counter(letter_counter, index_counter)
-                second_dest_pos = chr(letter_counter) + str(index_counter)
-                letter_counter, index_counter = get_next_counter(letter_counter, index_counter)
-
-                added_vol = transfer_unit_vol
-                
-                if self.grayscale and is_on:
-                    added_vol = transfer_unit_vol * (abs(val)/4.0)
-
-
-                if (is_on and not flip) or (not is_on and flip):
-                    pos_list_data_source.append(acid_positions[current_acid_index])
-                    pos_list_data_source.append(base_positions[current_base_index])
-                    self.neurons_outputs_acid_vol[neuron_index][0] = self.neurons_outputs_acid_vol[neuron_index][0] + added_vol #left
-                    self.neurons_outputs_base_vol[neuron_index][1] = self.neurons_outputs_base_vol[neuron_index][1] + added_vol #right
-                else:
-                    pos_list_data_source.append(base_positions[current_base_index])
-                    pos_list_data_source.append(acid_positions[current_acid_index])
-                    self.neurons_outputs_base_vol[neuron_index][0] = self.neurons_outputs_base_vol[neuron_index][0] + added_vol #left
-                    self.neurons_outputs_acid_vol[neuron_index][1] = self.neurons_outputs_acid_vol[neuron_index][1] + added_vol #right
-                
-
-
-                pos_list_data_destin.append(first_dest_pos)
-                pos_list_data_destin.append(second_dest_pos)
-
-                if self.grayscale and is_on:
-                    for _ in range(0, val):
-                        water_pos_list_data_source.append(water_positions[current_water_index])
-                        water_pos_list_data_destin.append(first_dest_pos)
-                        
-                        current_water_index = (current_water_index + 1) % len(water_positions)
-                        
-                        water_pos_list_data_source.append(water_positions[current_water_index])
-                        water_pos_list_data_destin.append(second_dest_pos)
+    def get_pixel_transfers(self, img, grayscale=None):
+        """ Returns, for every pixel of an image (or of an array of images), whether it is 'on',
+        the share of a transfer unit that its data wells get and the units of water that each
+        of them also gets. Grayscale 'on' pixels transfer abs(val)/4.0 of a unit and get one
+        unit of water per level.
+        """
+        if grayscale is None:
+            grayscale = self.grayscale
+        img = np.asarray(img, dtype=np.int64)
+        is_on = img > 0
+        if grayscale:
+            return is_on, np.where(is_on, np.abs(img) / 4.0, 1.0), np.where(is_on, img, 0)
+        return is_on, np.ones(img.shape), np.zeros(img.shape, dtype=np.int64)
 
-                        current_water_index = (current_water_index + 1) % len(water_positions)
+    def _weighted_transfers(self, acid_positions, base_positions, water_positions, starting_letter, starting_index, max_col, transfer_unit_vol):
+        """ Plans the data plate of the loaded image and accumulates the volumes of every rail.
+        Returns the sources of the data wells, the data plate layout, and the sources and
+        data well indices of the water transfers (one per unit, alternating between the two
+        wells of a pair, with the water wells taken in turn).
+        """
+        num_pixels = len(self.img)
+        active = self.get_active_pairs(num_pixels)
+        layout = compile_blocks_layout(tuple(active.sum(axis=1).tolist()), starting_letter, starting_index, max_col)
+        # running index of every written (neuron, pixel) pair, in transfer order
+        pair_index = np.cumsum(active.ravel()).reshape(active.shape) - 1
+        weights = np.array(self.neurons)
+        flip = weights[np.arange(self.num_neurons)[:, None], np.arange(active.size).reshape(active.shape) % self.weights_per_neuron] == -1
+        is_on, scale, water_units = self.get_pixel_transfers(self.img)
+        is_on = np.broadcast_to(is_on, flip.shape)
+        acid_first = is_on ^ flip
+        added_vol = np.broadcast_to(transfer_unit_vol * scale, flip.shape)
 
-                        self.neurons_outputs_water_vol[neuron_index][0] = self.neurons_outputs_water_vol[neuron_index][0] + transfer_unit_vol
-                        self.neurons_outputs_water_vol[neuron_index][1] = self.neurons_outputs_water_vol[neuron_index][1] + transfer_unit_vol
+        acid_sources = object_array(acid_positions)[pair_index[active] % len(acid_positions)]
+        base_sources = object_array(base_positions)[pair_index[active] % len(base_positions)]
+        sources = select_pairs(acid_first[active], acid_sources, base_sources)
 
+        pair_water = np.broadcast_to(water_units, flip.shape)[active]
+        water_pair = np.repeat(np.arange(len(pair_water)), pair_water)
+        water_wells = np.stack([2 * water_pair, 2 * water_pair + 1], axis=1).ravel()
+        water_sources = object_array(water_positions)[np.arange(len(water_wells)) % len(water_positions)].tolist() if len(water_wells) > 0 else []
 
-                current_acid_index = (current_acid_index + 1) % len(acid_positions)
-                current_base_index = (current_base_index + 1) % len(base_positions)
+        for neuron_index in range(0, self.num_neurons):
+            acid_vol = self.neurons_outputs_acid_vol[neuron_index]
+            base_vol = self.neurons_outputs_base_vol[neuron_index]
+            water_vol = self.neurons_outputs_water_vol[neuron_index]
+            is_acid = acid_first[neuron_index] & active[neuron_index]
+            is_base = ~acid_first[neuron_index] & active[neuron_index]
+            num_water_units = int(np.sum(np.broadcast_to(water_units, active[neuron_index].shape)[active[neuron_index]]))
+            acid_vol[0] = _accumulate(acid_vol[0], added_vol[neuron_index][is_acid]) #left
+            base_vol[1] = _accumulate(base_vol[1], added_vol[neuron_index][is_acid]) #right
+            base_vol[0] = _accumulate(base_vol[0], added_vol[neuron_index][is_base]) #left
+            acid_vol[1] = _accumulate(acid_vol[1], added_vol[neuron_index][is_base]) #right
+            water_vol[0] = _accumulate(water_vol[0], np.full(num_water_units, transfer_unit_vol))
+            water_vol[1] = _accumulate(water_vol[1], np.full(num_water_units, transfer_unit_vol))
+        return sources, layout, water_sources, water_wells
 
+    def generate_weighted_data_plate(self, acid_positions, base_positions, water_positions, source_max_transfers, starting_letter, starting_index, max_row, max_col, transfer_unit_vol, acid_conc, base_conc, water_transfers=False):
+        """ Writes the data plate of the loaded image and accumulates the volumes of every rail.
+        With water_transfers set, also returns the sources and destinations of the water
+        transfers of grayscale images.
+        """
+        pos_list_data_source, layout, water_sources, water_wells = self._weighted_transfers(
+            acid_positions, base_positions, water_positions, starting_letter, starting_index, max_col, transfer_unit_vol)
+        pos_list_data_destin = layout.positions()
+        if water_transfers:
+            water_destin = object_array(pos_list_data_destin)[water_wells].tolist() if len(water_wells) > 0 else []
+            return pos_list_data_source, pos_list_data_destin, water_sources, water_destin
+        return pos_list_data_source, pos_list_data_destin
 
+    def generate_direct_transfer_plate(self, acid_positions, base_positions, water_positions, source_max_transfers, starting_letter, starting_index, max_row, max_col, transfer_unit_vol, acid_conc, base_conc):
+        """ Transfers the reagents straight from the source wells to the pool wells, without a
+        data plate. The transfers are those of generate_weighted_data_plate (followed by the
+        water of grayscale images), each going to the pool well that generate_summation_plate
+        would pool its data well into; starting_letter and starting_index place the pool wells.
+        Accumulates the same volumes as generate_weighted_data_plate.
+        Returns (sources, pool wells).
+        """
+        sources, layout, water_sources, water_wells = self._weighted_transfers(
+            acid_positions, base_positions, water_positions, 'A', 1, max_col, transfer_unit_vol)
+        active = self.get_active_pairs(len(self.img))
+        pool_layout = compile_rows_layout(tuple(active.sum(axis=1).tolist()), starting_letter, starting_index)
+        # data well i is pooled into pool well i
+        wells = np.concatenate([np.arange(len(layout)), water_wells]).astype(np.int64)
+        pool_rows = pool_layout.rows[wells]
+        pool_cols = pool_layout.cols[wells]
+        pos_list_destin = [chr(row) + str(col) for row, col in zip(pool_rows.tolist(), pool_cols.tolist())]
+        return sources + water_sources, pos_list_destin
 
-            letter_counter = letter_counter + 2
-            index_counter = 1
-        return pos_list_data_source, pos_list_data_destin
-            
     def generate_weights_plate(self, source_image, starting_letter, starting_index, max_row, max_col):
-        pos_list_data_source = [];
-        pos_list_data_destin = [];
-        letter_counter = ord(starting_letter)
-        index_counter = starting_index
-        get_next_counter = lambda letter, index: (letter, index + 1) if index + 1 <= max_col else (letter + 1, 1)
-        i = 0
-        weight_index = 0
-        while i < len(source_image):
-            neuron_index = int(i / (2 * self.weights_per_neuron))
-            flip = self.neurons[neuron_index][weight_index] == -1
-            weight_index = (weight_index + 1) % self.weights_per_neuron
-
-            first_dest_pos = chr(letter_counter) + str(index_counter)
-            letter_counter, index_counter = get_next_counter(letter_counter, index_counter)
-            second_dest_pos = chr(letter_counter) + str(index_counter)
-            letter_counter, index_counter = get_next_counter(letter_counter, index_counter)
-            if flip:
-                pos_list_data_source.append(source_image[i + 1])
-                pos_list_data_source.append(source_image[i])
-            else:
-                pos_list_data_source.append(source_image[i])
-                pos_list_data_source.append(source_image[i + 1])
-            pos_list_data_destin.append(first_dest_pos)
-            pos_list_data_destin.append(second_dest_pos)
-            
-            if i > 0 and ((i + 2) % (self.img_width * self.img_height * 2) == 0):
-                letter_counter = letter_counter + 2
-                index_counter = 1
-            i = i + 2
+        num_pairs = len(source_image) // 2
+        block_size = self.img_width * self.img_height
+        active = self.get_active_pairs(block_size)
+        if np.all(active):
+            layout = compile_block_layout(-(-num_pairs // block_size), block_size, starting_letter, starting_index, max_col)
+            pair_index = np.arange(num_pairs)
+        else:
+            # the pairs of a sparse data plate are the (neuron, pixel) pairs with a non-zero weight
+            layout = compile_blocks_layout(tuple(active.sum(axis=1).tolist()), starting_letter, starting_index, max_col)
+            pair_index = np.flatnonzero(active.ravel())[:num_pairs]
+        flip = np.array(self.neurons)[pair_index // self.weights_per_neuron, pair_index % self.weights_per_neuron] == -1
+        sources = object_array(source_image)
+        pos_list_data_source = select_pairs(~flip, sources[0:2 * num_pairs:2], sources[1:2 * num_pairs:2])
+        pos_list_data_destin = layout.positions()[:2 * num_pairs]
         return pos_list_data_source, pos_list_data_destin
 
     def generate_summation_plate(self, source_image, starting_letter, starting_index, max_row, max_col):
-        pos_list_data_source = [];
-        pos_list_data_destin = [];
-        mixed = {}
-        get_next_counter = lambda letter, index: (letter, index + 1) if index + 1 <= max_col else (letter + 1, 1)
-        i = 0
-        while i < len(source_image):
-            neuron_index = int(i / (2 * self.weights_per_neuron))
-            first_dest_pos = chr(ord(starting_letter) + neuron_index) + str(starting_index)
-            second_dest_pos = chr(ord(starting_letter) + neuron_index) + str(starting_index + 1)
-            pos_list_data_source.append(source_image[i])
-            pos_list_data_source.append(source_image[i + 1])
-            pos_list_data_destin.append(first_dest_pos)
-            pos_list_data_destin.append(second_dest_pos)
-            
-            i = i + 2
+        num_pairs = len(source_image) // 2
+        active = self.get_active_pairs(self.img_width * self.img_height)
+        if np.all(active):
+            layout = compile_row_layout(-(-num_pairs // self.weights_per_neuron), self.weights_per_neuron, starting_letter, starting_index)
+        else:
+            # every neuron keeps its row, with one pair per non-zero weight
+            layout = compile_rows_layout(tuple(active.sum(axis=1).tolist()), starting_letter, starting_index)
+        pos_list_data_source = list(source_image[:2 * num_pairs])
+        pos_list_data_destin = layout.positions()[:2 * num_pairs]
         return pos_list_data_source, pos_list_data_destin
 
-    def get_expected_outputs(self, acid_ph=1, base_ph=13):
+    def count_transfers(self, images, grayscale=None, max_row=32, max_col=48):
+        """ Counts the transfers of a batch of images in the two-stage mode (source plate to
+        a data plate, then data plate to the pool wells) and in the direct mode
+        (generate_direct_transfer_plate). Data plates are max_row x max_col 1536-well plates
+        laid out like generate_weighted_data_plate. Returns a dict with a dict per mode of
+        (images,) arrays of 'data_transfers' (acid and base), 'water_transfers' and
+        'pool_transfers', their sum 'transfers', and the number of 'data_plates'.
+        """
+        images = np.atleast_2d(np.asarray(images))
+        _, _, water_units = self.get_pixel_transfers(images, grayscale=grayscale)
+        active = self.get_active_pairs(images.shape[1])
+        num_pairs = int(active.sum())
+        layout = compile_blocks_layout(tuple(active.sum(axis=1).tolist()), 'A', 1, max_col)
+        rows_used = int(layout.rows.max()) - ord('A') + 1 if len(layout) > 0 else 0
+        data_transfers = np.full(images.shape[0], 2 * num_pairs, dtype=np.int64)
+        # every unit of water goes to both wells of a pair
+        water_transfers = 2 * (water_units @ active.sum(axis=0))
+        modes = {
+            'two_stage': {'data_transfers': data_transfers,
+                          'water_transfers': water_transfers,
+                          'pool_transfers': data_transfers.copy(),
+                          'data_plates': -(-rows_used // max_row)},
+            'direct': {'data_transfers': data_transfers.copy(),
+                       'water_transfers': water_transfers.copy(),
+                       'pool_transfers': np.zeros(images.shape[0], dtype=np.int64),
+                       'data_plates': 0},
+        }
+        for counts in modes.values():
+            counts['transfers'] = counts['data_transfers'] + counts['water_transfers'] + counts['pool_transfers']
+        return modes
+
+    def get_expected_outputs(self, acid_ph=1, base_ph=13, model=None):
+        """ Expected [left, right] pH of every neuron. By default the rails are computed as a
+        strong neutralization of reagents of acid_ph and base_ph; model (a
+        ph_equilibrium.EquilibriumModel) solves the charge balance of the acid and base of
+        every rail instead, e.g. for weak acid reagents. Like the strong model, it leaves out
+        the water, which the pooling does not transfer.
+        """
+        if model is not None:
+            ph = np.round(model.calculate_ph(self.neurons_outputs_acid_vol, self.neurons_outputs_base_vol), 2)
+            return ph.tolist()
         result = []
         for i in range(0, self.num_neurons):
             left = round(calculate_resulting_ph_vol_ph(self.neurons_outputs_acid_vol[i][0], acid_ph, self.neurons_outputs_base_vol[i][0], base_ph), 2)
@@ -198,6 +264,96 @@ class AcidBaseNetwork:
             result.append([left, right])
         return result
 
+    def count_quarters(self, images, weights=None, grayscale=None):
+        """ Counts the acid and base that a batch of images pools into every rail, in quarters
+        of a transfer unit, so that the grayscale levels (abs(val)/4.0 of a unit) stay integers
+        and the matrix products are exact. The counts do not depend on the volumes or the
+        concentrations. Returns two (images x neurons x 2) float arrays of integer values.
+        """
+        images = np.atleast_2d(np.asarray(images))
+        if weights is None:
+            weights = self.get_weight_matrix()
+        weights = np.asarray(weights)
+        is_on, scale = self.get_pixel_transfers(images, grayscale=grayscale)[:2]
+        # zero weights transfer nothing
+        active = (weights != 0).astype(np.float64)
+        flip = (weights == -1).astype(np.float64)
+        # the left rail gets acid when the pixel is on and the weight is not flipped (or vice
+        # versa), so it gets on @ (active - flip) + off @ flip = on @ (active - 2 * flip) + all @ flip
+        if np.all(scale == 1.0):
+            # every pixel transfers a full unit, so the sums over all pixels need no product
+            on_units = is_on.astype(np.float64)
+            flip_total, active_total = flip.sum(axis=0), active.sum(axis=0)
+        else:
+            on_units = scale * is_on
+            flip_total, active_total = np.split(scale @ np.concatenate([flip, active], axis=1), 2, axis=1)
+        acid_left = 4.0 * (on_units @ (active - 2.0 * flip) + flip_total)
+        base_left = 4.0 * active_total - acid_left
+        return np.stack([acid_left, base_left], axis=-1), np.stack([base_left, acid_left], axis=-1)
+
+    def evaluate_batch(self, images, weights=None, transfer_unit_vol=1.0, acid_ph=1, base_ph=13, grayscale=None, model=None):
+        """ Computes the volumes and the expected pH of every neuron for a batch of images.
+        images is an (images x pixels) array and weights a (pixels x neurons) array (defaults
+        to the loaded weights). The volumes match what generate_weighted_data_plate accumulates
+        for each image, and the pH matches get_expected_outputs (with the same model, if any).
+        Returns a dict of (images x neurons x 2) arrays, where [..., 0] is the left rail and
+        [..., 1] the right one.
+        """
+        images = np.atleast_2d(np.asarray(images))
+        if weights is None:
+            weights = self.get_weight_matrix()
+        weights = np.asarray(weights)
+        # both wells of a pair get the water of the pixel, and zero weights get none
+        _, _, water_units = self.get_pixel_transfers(images, grayscale=grayscale)
+        if np.any(water_units):
+            water = (water_units @ (weights != 0).astype(np.float64)) * transfer_unit_vol
+        else:
+            water = np.zeros((images.shape[0], weights.shape[1]))
+        del water_units
+        water_vol = np.repeat(water[:, :, None], 2, axis=2)
+        acid_quarters, base_quarters = self.count_quarters(images, weights=weights, grayscale=grayscale)
+        scale = transfer_unit_vol / 4.0
+        acid_vol = acid_quarters * scale
+        base_vol = base_quarters * scale
+
+        if model is not None:
+            ph = np.round(model.calculate_ph(acid_vol, base_vol), 2)
+        else:
+            ph = np.round(ph_calculator_array.calculate_resulting_ph_vol_ph(acid_vol, acid_ph, base_vol, base_ph), 2)
+        return {'acid_vol': acid_vol, 'base_vol': base_vol, 'water_vol': water_vol, 'ph': ph}
+
+    def classify_batch(self, images, weights=None, transfer_unit_vol=1.0, acid_ph=1, base_ph=13, grayscale=None, tolerance=0.01):
+        """ Fast equivalent of decode_neuron_outputs(evaluate_batch(...)['ph']).
+        The acid and base volumes of every rail are counted in quarters of a unit with
+        count_quarters, and a rail is read as acidic or basic from the sign of its excess of
+        acid over base.
+        Only rails whose pH may lie within tolerance of 7 are computed with the full pH model.
+        The tolerance must be at least 0.005 (the expected pH is rounded to 2 decimals) for
+        the states to match the chemistry exactly.
+        Returns a dict with the 'states' and 'invalid' arrays, the (images x neurons x 2)
+        'fallback' mask of the rails that were computed with the pH model, and 'num_fallback'.
+        """
+        acid_quarters, base_quarters = self.count_quarters(images, weights=weights, grayscale=grayscale)
+        # the counts are small integers, so the float matrix products are exact
+        acid_vol = np.rint(acid_quarters).astype(np.int64)
+        base_vol = np.rint(base_quarters).astype(np.int64)
+
+        # same concentrations as calculate_resulting_ph_vol_ph
+        acid_h_conc = 10**-acid_ph
+        oh_conc = 1e-14/(10**-base_ph)
+        excess = acid_vol * acid_h_conc - base_vol * oh_conc
+        with np.errstate(divide='ignore', invalid='ignore'):
+            excess_conc = np.abs(excess) / (acid_vol + base_vol)
+        fallback = ~(excess_conc > 1e-7 * 10**tolerance)
+
+        ph = 7.0 - np.sign(excess)
+        if np.any(fallback):
+            scale = transfer_unit_vol / 4.0
+            ph[fallback] = np.round(ph_calculator_array.calculate_resulting_ph_vol_ph(acid_vol[fallback] * scale, acid_ph,
+                                                                                      base_vol[fallback] * scale, base_ph), 2)
+        states, invalid = decode_neuron_outputs(ph)
+        return {'states': states, 'invalid': invalid, 'fallback': fallback, 'num_fallback': int(np.sum(fallback))}
+
     def generate_pool_plate(self, source_image, indicator_source, max_row, max_col):
         pos_list_data_source = [];
         pos_list_data_destin = [];
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@description: Monte Carlo simulation of pipetting noise. Every transfer of every image gets an
+              independent volume error, and the accuracy is estimated over many trials
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ph_calculator_array
+from ph_calculator import calculate_acid_ph, calculate_base_ph
+from acidbase_network import decode_neuron_outputs, score_neuron_outputs
+from acidbase_dataset import get_dataset_paths, read_dataset_index, load_dataset_images, \
+                             load_packed_dataset, read_packed_dataset_index
+from acidbase_cache import load_source_concentrations
+from acidbase_sweep import load_weight_matrix, default_data_path, default_platesheet, vol1536_data
+
+default_block_size = 256 # images per random stream and per worker task
+default_trials_per_task = 32
+max_batch_elements = 2**22 # trials x images x neurons x pixels evaluated in one array operation
+
+
+class PipettingNoise:
+    """ Relative volume error of a single transfer.
+    'gaussian': normal errors with a standard deviation of uncertainty (the CV of a transfer)
+    'uniform': errors uniformly distributed in [-uncertainty, uncertainty]
+    'empirical': errors resampled from samples (see load_echo_errors) and multiplied by
+                 uncertainty, so that 1.0 reproduces the measured errors
+    """
+    def __init__(self, uncertainty_type='gaussian', uncertainty=0.0, samples=None):
+        if uncertainty_type not in ('gaussian', 'uniform', 'empirical'):
+            raise Exception('Unknown distribution: %s' % (uncertainty_type,))
+        if uncertainty_type == 'empirical' and (samples is None or len(samples) == 0):
+            raise Exception('Empirical noise needs error samples')
+        self.uncertainty_type = uncertainty_type
+        self.uncertainty = uncertainty
+        self.samples = None if samples is None else np.asarray(samples, dtype=np.float64)
+
+    def factors(self, rng, shape):
+        """ Draws the ratio of actual to requested volume for an array of transfers """
+        if self.uncertainty_type == 'gaussian':
+            errors = rng.standard_normal(shape) * self.uncertainty
+        elif self.uncertainty_type == 'uniform':
+            errors = rng.uniform(-self.uncertainty, self.uncertainty, shape)
+        else:
+            errors = rng.choice(self.samples, size=shape) * self.uncertainty
+        # a transfer cannot remove liquid from its destination
+        return np.maximum(1.0 + errors, 0.0)
+
+
+def load_echo_errors(filenames):
+    """ Reads the relative volume errors (actual / requested - 1) of the transfers in Echo
+    transfer reports
+    """
+    from chemcpupy.automation.Echo import Echo
+    errors = []
+    for filename in filenames:
+        for row in Echo.read_Echo_transfer_report(filename):
+            requested = row.get('Transfer Volume', '')
+            actual = row.get('Actual Volume', '')
+            if requested == '' or actual == '' or float(requested) <= 0:
+                continue
+            errors.append(float(actual) / float(requested) - 1.0)
+    return np.array(errors, dtype=np.float64)
+
+
+def trial_generator(seed, trial, block):
+    """ Random stream of one trial on one block of images. The streams only depend on
+    (seed, trial, block), so the results do not depend on how the work is split.
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(trial, block)))
+
+
+def simulate_noisy_batch(images, weights, noise, trials, seed=0, block=0, transfer_unit_vol=1.0, acid_ph=1, base_ph=13, grayscale=False):
+    """ Computes the expected pH of every neuron of a block of images in every trial, with
+    an independent volume error on both transfers of every pixel (the water added to
+    grayscale pixels does not change the pH). trials is a list of trial numbers.
+    Returns a (trials x images x neurons x 2) array, like evaluate_batch's 'ph'.
+    """
+    images = np.atleast_2d(np.asarray(images))
+    weights = np.asarray(weights)
+    is_on = images > 0
+    # transfer volumes in quarters of a unit, as in AcidBaseNetwork.evaluate_batch
+    if grayscale:
+        quarters = np.where(is_on, np.abs(images), 4).astype(np.float64)
+    else:
+        quarters = np.full(images.shape, 4.0)
+    # (images x neurons x pixels): the left well gets acid, the right one base, and zero
+    # weights have no wells
+    acid_first = is_on[:, None, :] ^ (weights == -1).T[None, :, :]
+    active = (weights != 0).T[None, :, :]
+    acid_quarters = quarters[:, None, :] * (acid_first & active)
+    base_quarters = quarters[:, None, :] * (~acid_first & active)
+    scale = transfer_unit_vol / 4.0
+
+    trials = list(trials)
+    ph = np.empty((len(trials),) + acid_first.shape[:2] + (2,))
+    chunk = max(1, max_batch_elements // acid_first.size)
+    for start in range(0, len(trials), chunk):
+        chunk_trials = trials[start:start + chunk]
+        # (trials x 2 x images x neurons x pixels): factors of the left and the right transfer
+        factors = np.stack([noise.factors(trial_generator(seed, trial, block), (2,) + acid_first.shape) for trial in chunk_trials])
+        left = factors[:, 0]
+        right = factors[:, 1]
+        acid_vol = np.stack([(acid_quarters * left).sum(axis=-1), (base_quarters * right).sum(axis=-1)], axis=-1) * scale
+        base_vol = np.stack([(base_quarters * left).sum(axis=-1), (acid_quarters * right).sum(axis=-1)], axis=-1) * scale
+        # noisy volumes are all distinct, so the exact (per unique value) logarithms do not pay off
+        ph[start:start + len(chunk_trials)] = np.round(ph_calculator_array.calculate_resulting_ph_vol_ph(acid_vol, acid_ph, base_vol, base_ph, exact=False), 2)
+    return ph
+
+
+def evaluate_noise_block(config, packed_file, start, stop, block, filenames, tf_outputs, noise, trials, seed, source_conc):
+    """ Runs the given trials on images [start, stop) of a configuration, with the source
+    acid and base concentrations [mM] of source_conc.
+    Returns the number of correct and of invalid images in every trial.
+    """
+    datatype, imgsize, num_classes, data_path = config
+    paths = get_dataset_paths(data_path, datatype, imgsize, num_classes)
+    weights = load_weight_matrix(paths['kernel'], num_classes, imgsize * imgsize)
+    if packed_file is not None:
+        images = np.asarray(load_packed_dataset(packed_file)['image'][start:stop])
+    else:
+        images = load_dataset_images(data_path, datatype, imgsize, filenames)
+    ph = simulate_noisy_batch(images, weights, noise, trials, seed=seed, block=block,
+                              transfer_unit_vol=(vol1536_data * 1e-9),
+                              acid_ph=calculate_acid_ph(source_conc[0] * 1e-3),
+                              base_ph=calculate_base_ph(source_conc[1] * 1e-3),
+                              grayscale=(datatype == '3bit'))
+    states, invalid = decode_neuron_outputs(ph)
+    is_correct = score_neuron_outputs(states, invalid, np.asarray(tf_outputs)[None])
+    return is_correct.sum(axis=1), invalid.sum(axis=1)
+
+
+def _evaluate_noise_block_task(task):
+    return evaluate_noise_block(*task)
+
+
+def run_noise_sweep(datatype, imgsize, num_classes, uncertainties, uncertainty_type='gaussian', samples=None, num_trials=100, seed=0,
+                    data_path=default_data_path, workers=None, block_size=default_block_size, trials_per_task=default_trials_per_task,
+                    output_dir='.', silent=False, use_packed=True, platesheet=default_platesheet):
+    """ Estimates the accuracy of a configuration for every uncertainty over num_trials trials.
+    The images are split into fixed-size blocks with their own random streams, and every
+    (uncertainty, block, group of trials) is a task of the process pool, so the results are
+    the same for any number of workers. All uncertainties use the same random streams,
+    which makes the accuracy curve smoother than independent draws would. The source acid
+    and base concentrations are read from the platesheet.
+    Writes noise_<datatype>_<num_classes>class_<imgsize>.json and returns the report.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    config = (datatype, imgsize, num_classes, data_path)
+    packed_file = get_dataset_paths(data_path, datatype, imgsize, num_classes)['packed']
+    if use_packed and os.path.isfile(packed_file):
+        filenames, labels, tf_outputs = read_packed_dataset_index(packed_file)
+    else:
+        packed_file = None
+        filenames, labels, tf_outputs = read_dataset_index(data_path, datatype, imgsize, num_classes)
+    source_conc = load_source_concentrations(platesheet)
+
+    tasks = []
+    for uncertainty in uncertainties:
+        noise = PipettingNoise(uncertainty_type, uncertainty, samples)
+        for block, start in enumerate(range(0, len(filenames), block_size)):
+            stop = start + block_size
+            for first_trial in range(0, num_trials, trials_per_task):
+                trials = list(range(first_trial, min(first_trial + trials_per_task, num_trials)))
+                tasks.append((config, packed_file, start, stop, block, filenames[start:stop], tf_outputs[start:stop], noise, trials, seed, source_conc))
+
+    if workers == 1:
+        results = [_evaluate_noise_block_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_evaluate_noise_block_task, tasks))
+
+    correct = {u: np.zeros(num_trials, dtype=np.int64) for u in range(len(uncertainties))}
+    invalid = {u: np.zeros(num_trials, dtype=np.int64) for u in range(len(uncertainties))}
+    tasks_per_uncertainty = len(tasks) // len(uncertainties) if uncertainties else 0
+    for i, (task, (num_correct, num_invalid)) in enumerate(zip(tasks, results)):
+        u = i // tasks_per_uncertainty
+        trials = task[8]
+        correct[u][trials] += num_correct
+        invalid[u][trials] += num_invalid
+
+    num_images = len(filenames)
+    curve = []
+    for u, uncertainty in enumerate(uncertainties):
+        accuracy = 100 * correct[u] / num_images if num_images > 0 else np.zeros(num_trials)
+        curve.append({
+            'uncertainty': uncertainty,
+            'accuracy_mean': round(float(np.mean(accuracy)), 2),
+            'accuracy_std': round(float(np.std(accuracy)), 2),
+            'accuracy_p5': round(float(np.percentile(accuracy, 5)), 2),
+            'accuracy_p50': round(float(np.percentile(accuracy, 50)), 2),
+            'accuracy_p95': round(float(np.percentile(accuracy, 95)), 2),
+            'invalid_mean': round(float(np.mean(invalid[u])), 2),
+        })
+    report = {
+        'datatype': datatype,
+        'imgsize': imgsize,
+        'num_classes': num_classes,
+        'num_images': num_images,
+        'num_trials': num_trials,
+        'seed': seed,
+        'uncertainty_type': uncertainty_type,
+        'curve': curve,
+    }
+    if output_dir is not None:
+        filename = os.path.join(output_dir, 'noise_{}_{}class_{}.json'.format(datatype, num_classes, imgsize))
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not silent:
+        print('===========', datatype, num_classes, 'classes', '{0}x{0}'.format(imgsize), uncertainty_type, 'noise,', num_trials, 'trials')
+        for point in curve:
+            print('Uncertainty', point['uncertainty'], 'Accuracy', point['accuracy_mean'], '+/-', point['accuracy_std'])
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Estimate the accuracy of the acid/base network under pipetting noise.')
+    parser.add_argument('--datatype', default='bin', choices=['bin', '3bit'])
+    parser.add_argument('--imgsize', type=int, default=8, choices=[8, 12, 16, 28])
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--uncertainty-type', default='gaussian', choices=['gaussian', 'uniform', 'empirical'])
+    parser.add_argument('--uncertainty', nargs='+', type=float, default=[0.0, 0.01, 0.02, 0.05, 0.1],
+                        help='CV (gaussian), half-width (uniform) or scale of the measured errors (empirical)')
+    parser.add_argument('--echo-report', nargs='+', default=[], help='Echo transfer reports for the empirical errors')
+    parser.add_argument('--trials', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-path', default=default_data_path)
+    parser.add_argument('--platesheet', default=default_platesheet, help='source plate, for the acid and base concentrations')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--block-size', type=int, default=default_block_size)
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--no-packed', action='store_true', help='read the per-image text files even if a packed dataset exists')
+    args = parser.parse_args(argv)
+
+    samples = load_echo_errors(args.echo_report) if args.uncertainty_type == 'empirical' else None
+    run_noise_sweep(args.datatype, args.imgsize, args.num_classes, args.uncertainty, uncertainty_type=args.uncertainty_type,
+                    samples=samples, num_trials=args.trials, seed=args.seed, data_path=args.data_path, workers=args.workers,
+                    block_size=args.block_size, output_dir=args.output_dir, use_packed=not args.no_packed,
+                    platesheet=args.platesheet)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
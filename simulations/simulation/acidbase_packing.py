@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@description: packs the data wells and pool wells of a batch of images onto shared plates, and
+              writes one data and one pooling picklist for the whole batch
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import chemcpupy
+from chemcpupy import Containers
+from acidbase_cache import AcidBaseRunCache
+from acidbase_dataset import read_dataset_index, get_dataset_paths
+from acidbase_sweep import default_data_path, vol1536_data
+
+dirname = os.path.dirname(__file__)
+
+default_platesheet = os.path.join(dirname, 'platesheet.csv')
+vol_pool = 200 # volume to transfer to pool from a data well [nL], as in acidbase_writer_acc.py
+
+simulate = lambda x : x.run(verbose=False,
+           volume_increment=2.5,
+           enforce_volume_limits=False,
+           robot='echo')
+
+
+class PlatePacking:
+    """ Places many images on shared plates. The data wells of an image are a contiguous range
+    of a data plate (row by row, in the order generate_weighted_data_plate writes them), and as
+    many images as fit share a plate. The pool wells of an image are num_neurons rows of two
+    columns (left and right rail), laid out like generate_summation_plate; the images fill the
+    row groups of a column pair, then the next column pair.
+    pairs_per_neuron is the number of data well pairs of every neuron (see
+    AcidBaseNetwork.get_active_pairs).
+    """
+    def __init__(self, num_neurons, pairs_per_neuron, data_rows=32, data_cols=48, pool_rows=16, pool_cols=24):
+        self.num_neurons = num_neurons
+        self.pairs_per_neuron = [int(count) for count in pairs_per_neuron]
+        self.data_rows = data_rows
+        self.data_cols = data_cols
+        self.pool_rows = pool_rows
+        self.pool_cols = pool_cols
+        self.wells_per_image = 2 * sum(self.pairs_per_neuron)
+        self.images_per_data_plate = (data_rows * data_cols) // max(self.wells_per_image, 1)
+        if self.images_per_data_plate == 0:
+            raise Exception('The %d data wells of an image do not fit on one %d x %d plate' % (self.wells_per_image, data_rows, data_cols))
+        self.groups_per_column = pool_rows // num_neurons
+        self.images_per_pool_plate = self.groups_per_column * (pool_cols // 2)
+        if self.images_per_pool_plate == 0:
+            raise Exception('The pool wells of %d neurons do not fit on one %d x %d plate' % (num_neurons, pool_rows, pool_cols))
+
+    def num_data_plates(self, num_images):
+        return -(-num_images // self.images_per_data_plate)
+
+    def num_pool_plates(self, num_images):
+        return -(-num_images // self.images_per_pool_plate)
+
+    def data_slot(self, image_index):
+        """ Returns (plate index, data wells) of an image. The wells are zero-indexed
+        (row, col) positions, since a 1536-well plate has more rows than letters.
+        """
+        plate, slot = divmod(image_index, self.images_per_data_plate)
+        linear = slot * self.wells_per_image + np.arange(self.wells_per_image, dtype=np.int64)
+        return plate, list(zip((linear // self.data_cols).tolist(), (linear % self.data_cols).tolist()))
+
+    def pool_slot(self, image_index):
+        """ Returns (plate index, starting letter, starting index) of the pool wells of an image,
+        as passed to generate_summation_plate
+        """
+        plate, slot = divmod(image_index, self.images_per_pool_plate)
+        column_pair, group = divmod(slot, self.groups_per_column)
+        return plate, chr(ord('A') + group * self.num_neurons), 2 * column_pair + 1
+
+
+def plan_packed_batch(run_cache, image_files, grayscale=False, vol_data=vol1536_data, vol_pool=vol_pool, packing=None):
+    """ Plans the data and pooling transfers of a batch of images on shared plates.
+    Every image is planned like acidbase_writer_acc.py does (source wells to the data plate,
+    then every data well to the pool well of its neuron), but its wells are placed by a
+    PlatePacking instead of starting at A1 of new plates. The transfers between the same pair
+    of plates are merged into one TransferTask.
+    Returns a dict with the 'source_plate', the 'data_plates' and 'pool_plates', the
+    'tasklist_data' and 'tasklist_pool' TaskLists, and 'images', a list with the data plate,
+    data well range, pool plate, pool wells (per neuron, [left, right]) and expected outputs of
+    every image.
+    """
+    pairs_per_neuron = run_cache.new_network().get_active_pairs(run_cache.img_width * run_cache.img_height).sum(axis=1).tolist()
+    if packing is None:
+        packing = PlatePacking(run_cache.num_neurons, pairs_per_neuron)
+    num_images = len(image_files)
+    source_plate = run_cache.new_source_plate()
+    data_plates = [chemcpupy.WellPlate1536LDV(description='data %d' % (k + 1,)) for k in range(packing.num_data_plates(num_images))]
+    pool_plates = [chemcpupy.WellPlate384PP(description='pooling %d' % (k + 1,)) for k in range(packing.num_pool_plates(num_images))]
+    pool_volume_max = pool_plates[0].get_param('volume_max') if pool_plates else 0
+    if pool_plates and max(pairs_per_neuron) * vol_pool > pool_volume_max:
+        raise Exception('A rail of %d x %g nL does not fit into one pool well, plan it with acidbase_pooling.PoolingPlan' % (max(pairs_per_neuron), vol_pool))
+
+    data_transfers = {}
+    pool_transfers = {}
+    images = []
+    for i, image_file in enumerate(image_files):
+        network = run_cache.new_network()
+        if grayscale:
+            network.load_image(image_file, img_levels=[-4, -3, -2, -1, 1, 2, 3, 4])
+        else:
+            network.load_image(image_file)
+        data_plate, pos_list_data_destin = packing.data_slot(i)
+        pool_plate, pool_letter, pool_index = packing.pool_slot(i)
+        pos_list_data_source, _ = network.generate_weighted_data_plate(
+                                        acid_positions=run_cache.acid_positions,
+                                        base_positions=run_cache.base_positions,
+                                        water_positions=run_cache.water_positions,
+                                        source_max_transfers=None,
+                                        starting_letter='A',
+                                        starting_index=1,
+                                        max_row=packing.data_rows,
+                                        max_col=packing.data_cols,
+                                        transfer_unit_vol=(vol_data * 1e-9),
+                                        acid_conc=(run_cache.acid_conc * 1e-3),
+                                        base_conc=(run_cache.base_conc * 1e-3))
+        pos_list_pool_source, pos_list_pool_destin = network.generate_summation_plate(source_image=pos_list_data_destin, starting_letter=pool_letter,
+                                                                                      starting_index=pool_index, max_row=packing.pool_rows, max_col=packing.pool_cols)
+
+        transfers = data_transfers.setdefault(data_plate, ([], []))
+        transfers[0].extend(pos_list_data_source)
+        transfers[1].extend(pos_list_data_destin)
+        transfers = pool_transfers.setdefault((data_plate, pool_plate), ([], []))
+        transfers[0].extend(pos_list_pool_source)
+        transfers[1].extend(pos_list_pool_destin)
+        images.append({
+            'image': os.path.basename(image_file),
+            'data_plate': data_plates[data_plate]._description,
+            'data_wells': Containers.position_to_lettergrid([pos_list_data_destin[0], pos_list_data_destin[-1]]) if pos_list_data_destin else [],
+            'pool_plate': pool_plates[pool_plate]._description,
+            'pool_wells': [[chr(ord(pool_letter) + n) + str(pool_index), chr(ord(pool_letter) + n) + str(pool_index + 1)] for n in range(run_cache.num_neurons)],
+            'expected_output': network.get_expected_outputs(),
+        })
+
+    tasklist_data = chemcpupy.TaskList(description='Write Data')
+    for data_plate, (sources, destinations) in data_transfers.items():
+        tasklist_data.add(chemcpupy.TransferTask(from_plate=source_plate,
+                                                 from_positions=sources,
+                                                 to_plate=data_plates[data_plate],
+                                                 to_positions=destinations,
+                                                 transfer_volumes=[vol_data] * len(destinations),
+                                                 transfer_group_label='write'))
+    tasklist_pool = chemcpupy.TaskList(description='Apply pooling')
+    for (data_plate, pool_plate), (sources, destinations) in pool_transfers.items():
+        tasklist_pool.add(chemcpupy.TransferTask(from_plate=data_plates[data_plate],
+                                                 from_positions=sources,
+                                                 to_plate=pool_plates[pool_plate],
+                                                 to_positions=destinations,
+                                                 transfer_volumes=[vol_pool] * len(destinations),
+                                                 transfer_group_label='pooling'))
+    return {'source_plate': source_plate, 'data_plates': data_plates, 'pool_plates': pool_plates,
+            'tasklist_data': tasklist_data, 'tasklist_pool': tasklist_pool, 'images': images}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack a batch of images onto shared data and pooling plates.')
+    parser.add_argument('--datatype', default='bin', choices=['bin', '3bit'])
+    parser.add_argument('--imgsize', type=int, default=8, choices=[8, 12, 16, 28])
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--platesheet', default=default_platesheet)
+    parser.add_argument('--limit', type=int, default=None, help='only pack the first images of the dataset')
+    parser.add_argument('--simulate', action='store_true', help='simulate the transfers on the plates')
+    parser.add_argument('--data-path', default=default_data_path)
+    parser.add_argument('--output-dir', default=None, help='directory of the picklists and the image map (default: __temporary__)')
+    args = parser.parse_args(argv)
+
+    output_dir = args.output_dir if args.output_dir is not None else chemcpupy.Path.make_temp_dir()
+    paths = get_dataset_paths(args.data_path, args.datatype, args.imgsize, args.num_classes)
+    filenames, labels, tf_outputs = read_dataset_index(args.data_path, args.datatype, args.imgsize, args.num_classes)
+    if args.limit is not None:
+        filenames = filenames[:args.limit]
+    image_files = [os.path.join(paths['images'], filename) for filename in filenames]
+
+    run_cache = AcidBaseRunCache(args.platesheet, paths['kernel'], num_neurons=args.num_classes, img_width=args.imgsize, img_height=args.imgsize)
+    plan = plan_packed_batch(run_cache, image_files, grayscale=(args.datatype == '3bit'))
+    if args.simulate:
+        simulate(plan['tasklist_data'])
+        simulate(plan['tasklist_pool'])
+    plan['tasklist_data'].summarize()
+    plan['tasklist_pool'].summarize()
+
+    name = '{}_{}class_{}'.format(args.datatype, args.num_classes, args.imgsize)
+    chemcpupy.Echo.write_Echo_csv_picklist(plan['tasklist_data'], os.path.join(output_dir, 'packing_' + name + '-1_write_data-Echo_picklist.csv'))
+    chemcpupy.Echo.write_Echo_csv_picklist(plan['tasklist_pool'], os.path.join(output_dir, 'packing_' + name + '-2_write_pooling-Echo_picklist.csv'))
+    with open(os.path.join(output_dir, 'packing_' + name + '.json'), 'w') as f:
+        json.dump(plan['images'], f, indent=2)
+
+    print('Images', len(image_files))
+    print('Data plates', len(plan['data_plates']), 'Pooling plates', len(plan['pool_plates']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@description: sensitivity of the accuracy to the source concentrations and the transfer volumes.
+              The acid and base of every image are tallied once and reused for every point of
+              the parameter grid
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ph_calculator_array
+from ph_equilibrium import solve_charge_balance
+from acidbase_network import AcidBaseNetwork, decode_neuron_outputs, score_neuron_outputs
+from acidbase_dataset import get_dataset_paths, read_dataset_index, load_dataset_images, \
+                             load_packed_dataset, read_packed_dataset_index
+from acidbase_cache import load_source_concentrations
+from acidbase_sweep import load_weight_matrix, default_data_path, default_platesheet, vol1536_data
+
+default_block_size = 256 # images per worker task
+default_margin = 0.5 # pH distance from 7 below which a rail is counted as marginal
+vol_pool = 200 # volume to transfer to pool from a data well [nL], as in acidbase_writer_acc.py
+plate1536_volume_max = 5500 # nL, WellPlate1536LDV (data plate)
+plate384_volume_max = 65000 # nL, WellPlate384PP (pool plate)
+max_batch_elements = 2**22 # points x images x neurons x rails evaluated in one array operation
+
+
+def parameter_grid(acid_concs, base_concs, data_vols, pool_vols):
+    """ Cartesian product of the parameter ranges. Concentrations are in mM and volumes in nL.
+    Returns a dict of 1-D arrays with one entry per point.
+    """
+    points = np.array(list(itertools.product(acid_concs, base_concs, data_vols, pool_vols)), dtype=np.float64).reshape(-1, 4)
+    return {
+        'acid_conc': points[:, 0],
+        'base_conc': points[:, 1],
+        'vol_data': points[:, 2],
+        'vol_pool': points[:, 3],
+    }
+
+
+def simulate_parameter_grid(acid_quarters, base_quarters, acid_concs, base_concs, data_vols, acid_pka=None, base_pka=None):
+    """ Computes the expected pH of every rail for every (acid_conc, base_conc, vol_data) point
+    from the rail tallies of AcidBaseNetwork.count_quarters. The tallies are only scaled and
+    broadcast along the point axis, so the matrix products are not repeated.
+    With an acid_pka or a base_pka (pKa of the conjugate acid) the rails are solved with the
+    charge balance of ph_equilibrium instead of the strong neutralization.
+    Returns a (points x images x neurons x 2) array, like evaluate_batch's 'ph' per point.
+    """
+    acid_concs = np.asarray(acid_concs, dtype=np.float64)
+    base_concs = np.asarray(base_concs, dtype=np.float64)
+    data_vols = np.asarray(data_vols, dtype=np.float64)
+    acid_ph = ph_calculator_array.calculate_acid_ph(acid_concs * 1e-3)
+    base_ph = ph_calculator_array.calculate_base_ph(base_concs * 1e-3)
+    # the data wells are pooled completely in the pH model, as in evaluate_batch
+    scale = data_vols * 1e-9 / 4.0
+
+    ph = np.empty((len(acid_concs),) + acid_quarters.shape)
+    chunk = max(1, max_batch_elements // max(acid_quarters.size, 1))
+    expand = (slice(None),) + (None,) * acid_quarters.ndim
+    for start in range(0, len(acid_concs), chunk):
+        points = slice(start, start + chunk)
+        acid_vol = acid_quarters[None] * scale[points][expand]
+        base_vol = base_quarters[None] * scale[points][expand]
+        if acid_pka is None and base_pka is None:
+            ph[points] = np.round(ph_calculator_array.calculate_resulting_ph_vol_ph(acid_vol, acid_ph[points][expand],
+                                                                                    base_vol, base_ph[points][expand]), 2)
+            continue
+        total_vol = acid_vol + base_vol
+        with np.errstate(divide='ignore', invalid='ignore'):
+            acid_well = np.where(total_vol > 0, acid_vol / total_vol, 0.0) * acid_concs[points][expand] * 1e-3
+            base_well = np.where(total_vol > 0, base_vol / total_vol, 0.0) * base_concs[points][expand] * 1e-3
+        ph[points] = np.round(solve_charge_balance(acid_well[..., None], -math.inf if acid_pka is None else acid_pka,
+                                                   base_well[..., None], math.inf if base_pka is None else base_pka), 2)
+    return ph
+
+
+def evaluate_parameter_block(config, packed_file, start, stop, filenames, tf_outputs, grid, margin=default_margin, acid_pka=None, base_pka=None):
+    """ Evaluates images [start, stop) of a configuration at every point of the grid.
+    Returns a dict of per-point counts ('correct', 'invalid', 'marginal' rails and the
+    smallest 'min_margin'), and the acid and base quarters of the block, which do not
+    depend on the parameters.
+    """
+    datatype, imgsize, num_classes, data_path = config
+    paths = get_dataset_paths(data_path, datatype, imgsize, num_classes)
+    weights = load_weight_matrix(paths['kernel'], num_classes, imgsize * imgsize)
+    if packed_file is not None:
+        images = np.asarray(load_packed_dataset(packed_file)['image'][start:stop])
+    else:
+        images = load_dataset_images(data_path, datatype, imgsize, filenames)
+    network = AcidBaseNetwork(num_neurons=num_classes, weights_per_neuron=imgsize * imgsize, img_width=imgsize, img_height=imgsize)
+    acid_quarters, base_quarters = network.count_quarters(images, weights=weights, grayscale=(datatype == '3bit'))
+
+    # the pH only depends on the concentrations and the data volume, so points that only
+    # differ in the pool volume share their simulation
+    chemistry = np.stack([grid['acid_conc'], grid['base_conc'], grid['vol_data']], axis=1)
+    unique_chemistry, point_index = np.unique(chemistry, axis=0, return_inverse=True)
+    ph = simulate_parameter_grid(acid_quarters, base_quarters, unique_chemistry[:, 0], unique_chemistry[:, 1], unique_chemistry[:, 2],
+                                 acid_pka=acid_pka, base_pka=base_pka)
+    states, invalid = decode_neuron_outputs(ph)
+    is_correct = score_neuron_outputs(states, invalid, np.asarray(tf_outputs)[None])
+    distance = np.abs(ph - 7.0).reshape(len(unique_chemistry), -1)
+    point_index = point_index.ravel()
+    return {
+        'correct': is_correct.sum(axis=1)[point_index],
+        'invalid': invalid.sum(axis=1)[point_index],
+        'marginal': (distance < margin).sum(axis=1)[point_index],
+        'min_margin': (distance.min(axis=1) if distance.shape[1] > 0 else np.full(len(unique_chemistry), np.inf))[point_index],
+        'acid_quarters': float(acid_quarters.sum()),
+        'base_quarters': float(base_quarters.sum()),
+    }
+
+
+def _evaluate_parameter_block_task(task):
+    return evaluate_parameter_block(*task)
+
+
+def run_parameter_sweep(datatype, imgsize, num_classes, acid_concs=None, base_concs=None, data_vols=(vol1536_data,),
+                        pool_vols=(vol_pool,), margin=default_margin, data_path=default_data_path, workers=None,
+                        block_size=default_block_size, output_dir='.', silent=False, use_packed=True, acid_pka=None, base_pka=None,
+                        platesheet=default_platesheet):
+    """ Evaluates a configuration over the Cartesian grid of the parameter ranges.
+    Concentrations are in mM and volumes in nL. For every point the report gives the accuracy,
+    the invalid images, the rails within margin of neutral and the smallest distance of any
+    rail from neutral, the reagent used per image, and whether the data and pool wells stay
+    within the plate capacities. acid_pka and base_pka select weak reagents (see
+    simulate_parameter_grid). The concentrations default to those of the platesheet.
+    Writes params_<datatype>_<num_classes>class_<imgsize>.json and returns the report.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    config = (datatype, imgsize, num_classes, data_path)
+    packed_file = get_dataset_paths(data_path, datatype, imgsize, num_classes)['packed']
+    if use_packed and os.path.isfile(packed_file):
+        filenames, labels, tf_outputs = read_packed_dataset_index(packed_file)
+    else:
+        packed_file = None
+        filenames, labels, tf_outputs = read_dataset_index(data_path, datatype, imgsize, num_classes)
+
+    if acid_concs is None or base_concs is None:
+        source_conc = load_source_concentrations(platesheet)
+        if acid_concs is None:
+            acid_concs = (source_conc[0],)
+        if base_concs is None:
+            base_concs = (source_conc[1],)
+    grid = parameter_grid(acid_concs, base_concs, data_vols, pool_vols)
+    tasks = []
+    for start in range(0, len(filenames), block_size):
+        stop = start + block_size
+        tasks.append((config, packed_file, start, stop, filenames[start:stop], tf_outputs[start:stop], grid, margin, acid_pka, base_pka))
+
+    if workers == 1:
+        results = [_evaluate_parameter_block_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_evaluate_parameter_block_task, tasks))
+
+    num_points = len(grid['acid_conc'])
+    correct = np.zeros(num_points, dtype=np.int64)
+    invalid = np.zeros(num_points, dtype=np.int64)
+    marginal = np.zeros(num_points, dtype=np.int64)
+    min_margin = np.full(num_points, np.inf)
+    acid_quarters = 0.0
+    base_quarters = 0.0
+    for result in results:
+        correct += result['correct']
+        invalid += result['invalid']
+        marginal += result['marginal']
+        min_margin = np.minimum(min_margin, result['min_margin'])
+        acid_quarters += result['acid_quarters']
+        base_quarters += result['base_quarters']
+
+    # every data well of a rail is pooled with vol_pool, whatever its grayscale level
+    network = AcidBaseNetwork(num_neurons=num_classes, weights_per_neuron=imgsize * imgsize, img_width=imgsize, img_height=imgsize)
+    network.load_weights(get_dataset_paths(data_path, datatype, imgsize, num_classes)['kernel'])
+    wells_per_rail = int(network.get_active_pairs(imgsize * imgsize).sum(axis=1).max())
+
+    num_images = len(filenames)
+    points = []
+    for p in range(num_points):
+        vol_data = grid['vol_data'][p]
+        pool = grid['vol_pool'][p]
+        # every data well gets one transfer of at most vol_data, and every pool well gets
+        # vol_pool from each data well of its rail
+        acid_nL = acid_quarters / 4.0 * vol_data / num_images if num_images > 0 else 0.0
+        base_nL = base_quarters / 4.0 * vol_data / num_images if num_images > 0 else 0.0
+        max_pool_nL = wells_per_rail * pool
+        points.append({
+            'acid_conc': float(grid['acid_conc'][p]),
+            'base_conc': float(grid['base_conc'][p]),
+            'vol_data': float(vol_data),
+            'vol_pool': float(pool),
+            'accuracy': round(100 * int(correct[p]) / num_images, 2) if num_images > 0 else None,
+            'invalid': int(invalid[p]),
+            'marginal': int(marginal[p]),
+            'min_margin': round(float(min_margin[p]), 2) if np.isfinite(min_margin[p]) else None,
+            'acid_nL': round(acid_nL, 2),
+            'base_nL': round(base_nL, 2),
+            # mM x nL = pmol
+            'acid_nmol': round(acid_nL * grid['acid_conc'][p] * 1e-3, 4),
+            'base_nmol': round(base_nL * grid['base_conc'][p] * 1e-3, 4),
+            'max_pool_nL': round(max_pool_nL, 2),
+            'fits': bool(vol_data <= plate1536_volume_max and pool <= vol_data and max_pool_nL <= plate384_volume_max),
+        })
+    report = {
+        'datatype': datatype,
+        'imgsize': imgsize,
+        'num_classes': num_classes,
+        'num_images': num_images,
+        'margin': margin,
+        'points': points,
+    }
+    if acid_pka is not None:
+        report['acid_pka'] = acid_pka
+    if base_pka is not None:
+        report['base_pka'] = base_pka
+    if output_dir is not None:
+        filename = os.path.join(output_dir, 'params_{}_{}class_{}.json'.format(datatype, num_classes, imgsize))
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not silent:
+        print('===========', datatype, num_classes, 'classes', '{0}x{0}'.format(imgsize), len(points), 'parameter points')
+        print('{:>10s} {:>10s} {:>9s} {:>9s} {:>9s} {:>8s} {:>9s} {:>11s} {:>5s}'.format(
+              'acid [mM]', 'base [mM]', 'data [nL]', 'pool [nL]', 'accuracy', 'invalid', 'marginal', 'min margin', 'fits'))
+        for point in points:
+            print('{:10g} {:10g} {:9g} {:9g} {:>9} {:8d} {:9d} {:>11} {:>5}'.format(
+                  point['acid_conc'], point['base_conc'], point['vol_data'], point['vol_pool'], str(point['accuracy']),
+                  point['invalid'], point['marginal'], str(point['min_margin']), 'yes' if point['fits'] else 'no'))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluate the accuracy over a grid of concentrations and volumes.')
+    parser.add_argument('--datatype', default='bin', choices=['bin', '3bit'])
+    parser.add_argument('--imgsize', type=int, default=8, choices=[8, 12, 16, 28])
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--acid-conc', nargs='+', type=float, default=None, help='source acid concentrations [mM] (default: that of --platesheet)')
+    parser.add_argument('--base-conc', nargs='+', type=float, default=None, help='source base concentrations [mM] (default: that of --platesheet)')
+    parser.add_argument('--vol-data', nargs='+', type=float, default=[vol1536_data], help='volumes transferred to the data plate [nL]')
+    parser.add_argument('--vol-pool', nargs='+', type=float, default=[vol_pool], help='volumes pooled from every data well [nL]')
+    parser.add_argument('--acid-pka', type=float, default=None, help='pKa of a weak acid (default: strong acid)')
+    parser.add_argument('--base-pka', type=float, default=None, help='pKa of the conjugate acid of a weak base (default: strong base)')
+    parser.add_argument('--margin', type=float, default=default_margin, help='pH distance from 7 below which a rail is marginal')
+    parser.add_argument('--data-path', default=default_data_path)
+    parser.add_argument('--platesheet', default=default_platesheet, help='source plate, for the default acid and base concentrations')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--block-size', type=int, default=default_block_size)
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--no-packed', action='store_true', help='read the per-image text files even if a packed dataset exists')
+    args = parser.parse_args(argv)
+
+    run_parameter_sweep(args.datatype, args.imgsize, args.num_classes, acid_concs=args.acid_conc, base_concs=args.base_conc,
+                        data_vols=args.vol_data, pool_vols=args.vol_pool, margin=args.margin, data_path=args.data_path,
+                        workers=args.workers, block_size=args.block_size, output_dir=args.output_dir, use_packed=not args.no_packed,
+                        acid_pka=args.acid_pka, base_pka=args.base_pka, platesheet=args.platesheet)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,201 @@
+import functools
+import math
+
+import numpy as np
+
+import chemcpupy
+from ph_calculator import calculate_resulting_ph_vol_ph
+from acidbase_layout import compile_row_layout
+
+pool_volume_max = 65000 # nL, WellPlate384PP
+pool_volume_min = 15000 # nL, WellPlate384PP
+echo_volume_increment = 2.5 # nL
+echo_max_transfer_volume = 10000 # largest single transfer [nL]
+
+
+@functools.lru_cache(maxsize=64)
+def plan_rail_tree(num_leaves, vol_pool, volume_max=pool_volume_max, volume_min=pool_volume_min, volume_increment=echo_volume_increment):
+    """ Plans the reduction tree of one rail: num_leaves data wells give vol_pool each.
+    If they fit into one pool well they are pooled directly. Otherwise they are split into
+    the fewest balanced groups that fit into a well each, and every partial pool forwards
+    unit nL per data well it holds to the pool well, keeping volume_min behind. Forwarding
+    in proportion to the number of data wells gives every data well the same share of the
+    final pool, so the pH is the same as for a direct pool.
+    Returns (bounds, unit): the data wells of group g are [bounds[g], bounds[g + 1]), and
+    bounds is None when the rail is pooled directly (unit is then vol_pool).
+    """
+    if num_leaves * vol_pool <= volume_max:
+        return None, vol_pool
+    max_group = int(volume_max // vol_pool)
+    if max_group == 0:
+        raise Exception('A pool volume of %g nL does not fit into a %g nL well' % (vol_pool, volume_max))
+    num_groups = -(-num_leaves // max_group)
+    bounds = (np.arange(num_groups + 1) * num_leaves) // num_groups
+    smallest = num_leaves // num_groups
+    # the pool well must hold every forward, and every partial pool must keep its dead volume
+    unit = min(volume_max / num_leaves, vol_pool - volume_min / smallest)
+    unit = math.floor(unit / volume_increment) * volume_increment
+    if unit < volume_increment:
+        raise Exception('Partial pools of %d wells cannot forward %g nL above their dead volume' % (smallest, volume_increment))
+    bounds.setflags(write=False)
+    return bounds, unit
+
+
+def _split_transfer(volume, max_transfer, volume_increment):
+    # full transfers first, then the remainder, all in whole volume increments
+    max_increments = int(math.floor(max_transfer / volume_increment + 1e-9))
+    num_increments = int(round(volume / volume_increment))
+    volumes = [max_increments * volume_increment] * (num_increments // max_increments)
+    if num_increments % max_increments > 0:
+        volumes.append((num_increments % max_increments) * volume_increment)
+    return volumes
+
+
+def _lettergrid(index, num_cols):
+    return chr(ord('A') + index // num_cols) + str(index % num_cols + 1)
+
+
+class PoolingPlan:
+    """ Pools the data wells of every rail into the two pool wells of its neuron, with
+    intermediate partial pools when a rail does not fit into one well.
+    weights_per_neuron is the number of data well pairs of every neuron, or a list with one
+    count per neuron when some weights are zero (see AcidBaseNetwork.get_active_pairs).
+    The pool wells are laid out like generate_summation_plate (neuron n in row
+    starting_letter + n, left and right rails in columns starting_index and
+    starting_index + 1). The partial pools fill a separate plate row by row. A forward from a
+    partial pool above max_transfer is split into several transfers.
+    """
+    def __init__(self, num_neurons, weights_per_neuron, vol_pool, data_volume, starting_letter='O', starting_index=1,
+                 volume_max=pool_volume_max, volume_min=pool_volume_min, volume_increment=echo_volume_increment, partial_cols=24, partial_wells=384,
+                 max_transfer=echo_max_transfer_volume):
+        self.num_neurons = num_neurons
+        if np.ndim(weights_per_neuron) == 0:
+            weights_per_neuron = [weights_per_neuron] * num_neurons
+        self.leaf_counts = [int(count) for count in weights_per_neuron]
+        if len(self.leaf_counts) != num_neurons:
+            raise Exception('Expected %d data well counts, got %d' % (num_neurons, len(self.leaf_counts)))
+        self.vol_pool = vol_pool
+        self.data_volume = data_volume
+        if vol_pool > data_volume:
+            raise Exception('Cannot pool %g nL out of a %g nL data well' % (vol_pool, data_volume))
+        if max_transfer < volume_increment or vol_pool > max_transfer:
+            raise Exception('Cannot pool %g nL with transfers of at most %g nL' % (vol_pool, max_transfer))
+        self.max_transfer = max_transfer
+        self.volume_increment = volume_increment
+        # trees[n] is (bounds, unit) of both rails of neuron n
+        self.trees = [plan_rail_tree(count, vol_pool, volume_max, volume_min, volume_increment) for count in self.leaf_counts]
+        layout = compile_row_layout(num_neurons, 1, starting_letter, starting_index)
+        # pool_positions[n][r] is the pool well of rail r of neuron n
+        positions = layout.positions()
+        self.pool_positions = [positions[2 * n:2 * n + 2] for n in range(num_neurons)]
+        num_groups = [0 if bounds is None else len(bounds) - 1 for bounds, _ in self.trees]
+        if 2 * sum(num_groups) > partial_wells:
+            raise Exception('%d partial pools do not fit on one plate' % (2 * sum(num_groups),))
+        # partial_positions[n][r][g] is partial pool g of rail r of neuron n
+        self.partial_positions = []
+        index = 0
+        for n in range(num_neurons):
+            rails = []
+            for r in range(2):
+                rails.append([_lettergrid(index + g, partial_cols) for g in range(num_groups[n])])
+                index += num_groups[n]
+            self.partial_positions.append(rails)
+
+    @property
+    def num_stages(self):
+        return 1 if all(bounds is None for bounds, _ in self.trees) else 2
+
+    def _forwards(self, num_leaves, unit):
+        # transfers that forward a partial pool of num_leaves data wells to the pool well
+        return _split_transfer(num_leaves * unit, self.max_transfer, self.volume_increment)
+
+    @property
+    def num_transfers(self):
+        total = 0
+        for count, (bounds, unit) in zip(self.leaf_counts, self.trees):
+            total += 2 * count
+            if bounds is not None:
+                total += 2 * sum(len(self._forwards(int(stop - start), unit)) for start, stop in zip(bounds[:-1], bounds[1:]))
+        return total
+
+    @property
+    def pool_volumes(self):
+        """ Volume of the pool wells of every neuron [nL] """
+        return [count * unit for count, (_, unit) in zip(self.leaf_counts, self.trees)]
+
+    @property
+    def fractions(self):
+        """ Share of the contents of every data well of a neuron that ends up in its pool well """
+        return [unit / self.data_volume for _, unit in self.trees]
+
+    def get_transfers(self, data_positions):
+        """ Lists the transfers of every stage. data_positions are the data wells in the order
+        generate_weighted_data_plate writes them (both wells of a pixel pair, pixel by pixel,
+        neuron by neuron); the first well of a pair belongs to the left rail.
+        Returns a list of stages, each a list of (from, to, from_positions, to_positions,
+        volumes) where from and to are 'data', 'partial' or 'pool'.
+        """
+        num_wells = 2 * sum(self.leaf_counts)
+        if len(data_positions) < num_wells:
+            raise Exception('Expected %d data wells, got %d' % (num_wells, len(data_positions)))
+        direct = ([], [], [])
+        first = ([], [], [])
+        second = ([], [], [])
+        offset = 0
+        for n, (count, (bounds, unit)) in enumerate(zip(self.leaf_counts, self.trees)):
+            for r in range(2):
+                leaves = list(data_positions[offset + r:offset + 2 * count:2])
+                if bounds is None:
+                    direct[0].extend(leaves)
+                    direct[1].extend([self.pool_positions[n][r]] * count)
+                    direct[2].extend([self.vol_pool] * count)
+                    continue
+                for g in range(len(bounds) - 1):
+                    start, stop = int(bounds[g]), int(bounds[g + 1])
+                    first[0].extend(leaves[start:stop])
+                    first[1].extend([self.partial_positions[n][r][g]] * (stop - start))
+                    first[2].extend([self.vol_pool] * (stop - start))
+                    forwards = self._forwards(stop - start, unit)
+                    second[0].extend([self.partial_positions[n][r][g]] * len(forwards))
+                    second[1].extend([self.pool_positions[n][r]] * len(forwards))
+                    second[2].extend(forwards)
+            offset += 2 * count
+        stages = [[], []]
+        if direct[0]:
+            stages[0].append(('data', 'pool') + direct)
+        if first[0]:
+            stages[0].append(('data', 'partial') + first)
+            stages[1].append(('partial', 'pool') + second)
+        return [stage for stage in stages if stage]
+
+    def transfer_tasks(self, data_plate, data_positions, pool_plate, partial_plate=None, transfer_group_label='pooling'):
+        """ Builds the TransferTasks of every stage, in the order they must run. partial_plate
+        defaults to a new WellPlate384PP.
+        """
+        if partial_plate is None and self.num_stages > 1:
+            partial_plate = chemcpupy.WellPlate384PP(description='partial pooling')
+        plates = {'data': data_plate, 'partial': partial_plate, 'pool': pool_plate}
+        tasks = []
+        for stage in self.get_transfers(data_positions):
+            for from_key, to_key, from_positions, to_positions, volumes in stage:
+                tasks.append(chemcpupy.TransferTask(from_plate=plates[from_key],
+                                                    from_positions=from_positions,
+                                                    to_plate=plates[to_key],
+                                                    to_positions=to_positions,
+                                                    transfer_volumes=volumes,
+                                                    transfer_group_label=transfer_group_label))
+        return tasks
+
+    def get_expected_outputs(self, network, acid_ph=1, base_ph=13):
+        """ Expected pH of every neuron from what actually reaches the pool wells: fraction of
+        the acid and base that the network accumulated on every rail. Like get_expected_outputs
+        of the network, but for the pooled volumes.
+        """
+        result = []
+        for i, fraction in enumerate(self.fractions):
+            acid_vol = network.neurons_outputs_acid_vol[i]
+            base_vol = network.neurons_outputs_base_vol[i]
+            left = round(calculate_resulting_ph_vol_ph(acid_vol[0] * fraction, acid_ph, base_vol[0] * fraction, base_ph), 2)
+            right = round(calculate_resulting_ph_vol_ph(acid_vol[1] * fraction, acid_ph, base_vol[1] * fraction, base_ph), 2)
+            result.append([left, right])
+        return result
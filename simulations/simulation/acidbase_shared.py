@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+class SharedArrays:
+    """ Named NumPy arrays in memory-mapped files of a temporary directory. The process that
+    creates them owns the files and removes them with close(); other processes get views of
+    the same pages with attach_shared_arrays(shared.descriptor), without copying them.
+    """
+    def __init__(self):
+        self._directory = None
+        self.arrays = {}
+        self.descriptor = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def create(self, name, shape, dtype):
+        """ Allocates a zero-filled shared array and returns it """
+        dtype = np.dtype(dtype)
+        shape = tuple(shape)
+        if int(np.prod(shape, dtype=np.int64)) == 0:
+            # a file cannot map zero bytes, and there is nothing to share
+            array = np.zeros(shape, dtype=dtype)
+            filename = None
+        else:
+            if self._directory is None:
+                self._directory = tempfile.mkdtemp(prefix='acidbase_shared_')
+            filename = os.path.join(self._directory, name + '.dat')
+            array = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+            _owned_arrays[filename] = array
+        self.arrays[name] = array
+        self.descriptor[name] = (filename, shape, dtype.str)
+        return array
+
+    def publish(self, name, values):
+        """ Copies an array into a shared file and returns the shared copy """
+        values = np.asarray(values)
+        array = self.create(name, values.shape, values.dtype)
+        array[...] = values
+        return array
+
+    def close(self):
+        for filename, _, _ in self.descriptor.values():
+            _owned_arrays.pop(filename, None)
+        self.arrays = {}
+        self.descriptor = {}
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+
+# arrays created by this process (and still open), and arrays attached by it, which are
+# kept open for as long as the process runs
+_owned_arrays = {}
+_attached_arrays = {}
+
+
+def attach_shared_arrays(descriptor, mode='r'):
+    """ Returns views of the arrays of a SharedArrays descriptor, without copying them.
+    The views are read-only unless mode is 'r+'.
+    """
+    arrays = {}
+    for name, (filename, shape, dtype) in descriptor.items():
+        if filename is None:
+            arrays[name] = np.zeros(shape, dtype=np.dtype(dtype))
+        elif filename in _owned_arrays:
+            arrays[name] = _owned_arrays[filename]
+        else:
+            if (filename, mode) not in _attached_arrays:
+                _attached_arrays[(filename, mode)] = np.memmap(filename, dtype=np.dtype(dtype), mode=mode, shape=shape)
+            arrays[name] = _attached_arrays[(filename, mode)]
+    return arrays
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+
+def digest_array(values, dtype=np.int64):
+    """ Hashes the contents and the shape of an array. Values are cast to dtype first, so
+    the digest does not depend on how the array was loaded (text files or packed dataset).
+    """
+    values = np.ascontiguousarray(values, dtype=dtype)
+    h = hashlib.sha256()
+    h.update(str(values.shape).encode('ascii'))
+    h.update(values.tobytes())
+    return h.hexdigest()
+
+
+def digest_params(params):
+    """ Hashes a dict of simulation parameters """
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def result_key(image, tf_output, weights_digest, params_digest):
+    """ Content address of the result of one image: a hash of the image, its TF outputs,
+    the weights and the simulation parameters.
+    """
+    h = hashlib.sha256()
+    h.update(weights_digest.encode('ascii'))
+    h.update(params_digest.encode('ascii'))
+    h.update(digest_array(image).encode('ascii'))
+    h.update(digest_array(tf_output, dtype=np.float64).encode('ascii'))
+    return h.hexdigest()
+
+
+class ResultStore:
+    """ Local store of per-image simulation results, keyed by result_key.
+    Results are committed as they are added, so an interrupted run keeps everything that
+    was finished and a re-run only evaluates the missing images.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename, timeout=60)
+        # WAL lets worker processes read while the main process writes
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                           'key TEXT PRIMARY KEY, '
+                           'filename TEXT, '
+                           'ph TEXT, '
+                           'states TEXT, '
+                           'invalid INTEGER, '
+                           'correct INTEGER, '
+                           'fallback INTEGER DEFAULT 0)')
+        # stores written before the fallback count was kept
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(results)')]
+        if 'fallback' not in columns:
+            self._conn.execute('ALTER TABLE results ADD COLUMN fallback INTEGER DEFAULT 0')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def get_many(self, keys):
+        """ Returns a dict of the stored results among the given keys """
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._conn.execute('SELECT key, filename, ph, states, invalid, correct, fallback FROM results WHERE key IN (%s)'
+                                      % ','.join('?' * len(chunk)), chunk)
+            for key, filename, ph, states, invalid, correct, fallback in rows:
+                found[key] = {'filename': filename,
+                              'ph': json.loads(ph),
+                              'states': json.loads(states),
+                              'invalid': bool(invalid),
+                              'correct': bool(correct),
+                              'fallback': int(fallback or 0)}
+        return found
+
+    def put_many(self, records):
+        """ Stores a dict of key -> {'filename', 'ph', 'states', 'invalid', 'correct', 'fallback'}
+        and commits. 'fallback', the number of rails that the fast path computed with the pH
+        model, is optional.
+        """
+        self._conn.executemany('INSERT OR REPLACE INTO results (key, filename, ph, states, invalid, correct, fallback) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               [(key,
+                                 r['filename'],
+                                 json.dumps(r['ph']),
+                                 json.dumps(r['states']),
+                                 int(r['invalid']),
+                                 int(r['correct']),
+                                 int(r.get('fallback', 0))) for key, r in records.items()])
+        self._conn.commit()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@description: runs the accuracy simulation over a grid of (datatype, imgsize, num_classes)
+              configurations, sharding the images of every configuration across a process pool
+"""
+
+import argparse
+import csv
+import functools
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from acidbase_network import AcidBaseNetwork, decode_neuron_outputs, score_neuron_outputs
+from acidbase_cache import AcidBaseRunCache
+from acidbase_dataset import num_map, get_dataset_paths, read_dataset_index, load_dataset_images, \
+                             load_packed_dataset, read_packed_dataset_index
+from acidbase_store import ResultStore, digest_array, digest_params, result_key
+from acidbase_shared import SharedArrays, attach_shared_arrays
+from ph_calculator import calculate_acid_ph, calculate_base_ph
+
+dirname = os.path.dirname(__file__)
+
+default_data_path = os.path.join(dirname, './datasets')
+default_platesheet = os.path.join(dirname, 'platesheet.csv')
+default_shard_size = 256 # images per worker task
+default_tolerance = 0.01 # pH distance from neutral below which --fast uses the pH model
+vol1536_data = 2000 # volume to transfer from source to data plate [nL]
+
+
+@functools.lru_cache(maxsize=None)
+def load_weight_matrix(kernel_file, num_classes, weights_per_neuron):
+    """ Reads a kernel file once per worker process """
+    network = AcidBaseNetwork(num_neurons=num_classes, weights_per_neuron=weights_per_neuron)
+    network.load_weights(kernel_file)
+    return network.get_weight_matrix()
+
+
+def new_counters(num_classes):
+    return {
+        'count': [0] * num_classes,
+        'correct': [0] * num_classes,
+        'invalid': [0] * num_classes,
+        'wrong': [0] * num_classes,
+        'fallback': [0] * num_classes,
+    }
+
+
+def merge_counters(counters_list, num_classes):
+    """ Sums per-shard counters. Integer sums do not depend on the order, so the merged
+    result is the same for any number of workers.
+    """
+    merged = new_counters(num_classes)
+    for counters in counters_list:
+        for key in merged:
+            merged[key] = [a + b for a, b in zip(merged[key], counters[key])]
+    return merged
+
+
+def get_simulation_params(datatype, source_conc, tolerance=None):
+    """ Parameters that the result of an image depends on, besides the image and the weights.
+    source_conc is the (acid, base) concentration [mM] of the source plate.
+    """
+    params = {
+        'datatype': datatype,
+        'vol1536_data': vol1536_data,
+        'acid_conc': source_conc[0],
+        'base_conc': source_conc[1],
+    }
+    if tolerance is not None:
+        # the fast path does not compute the pH of every rail, and its results depend on
+        # which rails fall back to the pH model
+        params['fast'] = True
+        params['tolerance'] = tolerance
+    return params
+
+
+def load_shard_images(config, descriptor, start, stop, filenames):
+    """ Reads the text files of images [start, stop) into the shared image array """
+    datatype, imgsize, num_classes, data_path = config
+    images = attach_shared_arrays(descriptor, mode='r+')['images']
+    images[start:stop] = load_dataset_images(data_path, datatype, imgsize, filenames)
+
+
+def _load_shard_images_task(task):
+    return load_shard_images(*task)
+
+
+def evaluate_shard(config, dataset, start, stop, filenames, source_conc, store_file=None, tolerance=None):
+    """ Evaluates images [start, stop) of a configuration, for the (acid, base) source
+    concentrations source_conc [mM].
+    dataset is (packed_file, descriptor): the weights, labels and TF outputs are views of
+    the shared arrays of the descriptor (see acidbase_shared), and so are the images unless
+    they are sliced out of the memory-mapped packed dataset. With a result store, images
+    whose results are already stored are not simulated again. With a tolerance, the neurons
+    are classified with AcidBaseNetwork.classify_batch and only near-neutral rails go through
+    the pH model.
+    Returns (counters, records), where records holds the new results to be stored.
+    """
+    datatype, imgsize, num_classes, data_path = config
+    packed_file, descriptor = dataset
+    shared = attach_shared_arrays(descriptor)
+    weights = shared['weights']
+    network = AcidBaseNetwork(num_neurons=num_classes, weights_per_neuron=imgsize * imgsize, img_width=imgsize, img_height=imgsize)
+    if packed_file is not None:
+        images = load_packed_dataset(packed_file)['image'][start:stop]
+    else:
+        images = shared['images'][start:stop]
+    labels = shared['labels'][start:stop]
+    tf_outputs = shared['tf_outputs'][start:stop]
+
+    keys = []
+    stored = {}
+    if store_file is not None:
+        weights_digest = digest_array(weights)
+        params_digest = digest_params(get_simulation_params(datatype, source_conc, tolerance))
+        keys = [result_key(images[i], tf_outputs[i], weights_digest, params_digest) for i in range(len(images))]
+        with ResultStore(store_file) as store:
+            stored = store.get_many(keys)
+    todo = [i for i in range(len(images)) if store_file is None or keys[i] not in stored]
+
+    states = np.zeros((len(images), num_classes), dtype=np.int8)
+    invalid = np.zeros(len(images), dtype=bool)
+    is_correct = np.zeros(len(images), dtype=bool)
+    num_fallback = np.zeros(len(images), dtype=np.int64)
+    records = {}
+    if todo:
+        simulation_args = dict(weights=weights,
+                               transfer_unit_vol=(vol1536_data * 1e-9),
+                               acid_ph=calculate_acid_ph(source_conc[0] * 1e-3),
+                               base_ph=calculate_base_ph(source_conc[1] * 1e-3),
+                               grayscale=(datatype == '3bit'))
+        if tolerance is None:
+            ph = network.evaluate_batch(np.asarray(images)[todo], **simulation_args)['ph']
+            states[todo], invalid[todo] = decode_neuron_outputs(ph)
+        else:
+            outputs = network.classify_batch(np.asarray(images)[todo], tolerance=tolerance, **simulation_args)
+            states[todo], invalid[todo] = outputs['states'], outputs['invalid']
+            num_fallback[todo] = outputs['fallback'].sum(axis=(1, 2))
+        is_correct[todo] = score_neuron_outputs(states[todo], invalid[todo], tf_outputs[todo])
+        if store_file is not None:
+            for j, i in enumerate(todo):
+                records[keys[i]] = {'filename': filenames[i],
+                                    'ph': ph[j].tolist() if tolerance is None else None,
+                                    'states': states[i].tolist(),
+                                    'invalid': bool(invalid[i]),
+                                    'correct': bool(is_correct[i]),
+                                    'fallback': int(num_fallback[i])}
+    for i, key in enumerate(keys):
+        if key in stored:
+            states[i] = stored[key]['states']
+            invalid[i] = stored[key]['invalid']
+            is_correct[i] = stored[key]['correct']
+            num_fallback[i] = stored[key]['fallback']
+
+    counters = new_counters(num_classes)
+    for digit in range(num_classes):
+        in_class = labels == digit
+        counters['count'][digit] = int(np.sum(in_class))
+        counters['correct'][digit] = int(np.sum(in_class & is_correct))
+        counters['invalid'][digit] = int(np.sum(in_class & invalid))
+        counters['wrong'][digit] = int(np.sum(in_class & ~is_correct))
+        counters['fallback'][digit] = int(np.sum(num_fallback[in_class]))
+    return counters, records
+
+
+def _evaluate_shard_task(task):
+    return evaluate_shard(*task)
+
+
+def build_report(config, counters, num_shards, fast=False, weights=None):
+    """ Builds the accuracy report of a configuration. Sparse kernels (with zero weights)
+    also report the number of zero weights and the transfers that one image needs.
+    """
+    datatype, imgsize, num_classes, data_path = config
+    classes = []
+    for digit in range(num_classes):
+        count = counters['count'][digit]
+        classes.append({
+            'label': digit,
+            'name': num_map[digit],
+            'count': count,
+            'correct': counters['correct'][digit],
+            'invalid': counters['invalid'][digit],
+            'wrong': counters['wrong'][digit],
+            'accuracy': round(100 * (counters['correct'][digit] / count), 2) if count > 0 else None,
+        })
+    sum_data = sum(counters['count'])
+    sum_correct = sum(counters['correct'])
+    report = {
+        'datatype': datatype,
+        'imgsize': imgsize,
+        'num_classes': num_classes,
+        'num_images': sum_data,
+        'num_shards': num_shards,
+        'classes': classes,
+        'correct': sum_correct,
+        'invalid': sum(counters['invalid']),
+        'wrong': sum(counters['wrong']),
+        'accuracy': round(100 * (sum_correct / sum_data), 2) if sum_data > 0 else None,
+    }
+    if fast:
+        report['fallback'] = sum(counters['fallback'])
+    if weights is not None and np.any(np.asarray(weights) == 0):
+        num_active = int(np.count_nonzero(weights))
+        report['zero_weights'] = int(np.size(weights)) - num_active
+        # an acid and a base transfer to the data plate and two pooling transfers per weight
+        report['transfers_per_image'] = 4 * num_active
+    return report
+
+
+def write_report(report, output_dir, fmt='json'):
+    """ Writes acc_<datatype>_<num_classes>class_<imgsize>.<fmt> and returns its path """
+    filename = os.path.join(output_dir, 'acc_{}_{}class_{}.{}'.format(report['datatype'], report['num_classes'], report['imgsize'], fmt))
+    if fmt == 'json':
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+    elif fmt == 'csv':
+        fields = ['label', 'name', 'count', 'correct', 'invalid', 'wrong', 'accuracy']
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fields)
+            writer.writeheader()
+            for row in report['classes']:
+                writer.writerow(row)
+            writer.writerow({'label': 'all', 'name': 'all', 'count': report['num_images'], 'correct': report['correct'],
+                             'invalid': report['invalid'], 'wrong': report['wrong'], 'accuracy': report['accuracy']})
+    else:
+        raise Exception('Unknown report format: %s' % (fmt,))
+    return filename
+
+
+def print_summary(report):
+    print('===========', report['datatype'], report['num_classes'], 'classes', '{0}x{0}'.format(report['imgsize']))
+    for c in report['classes']:
+        print("Correct", c['name'], ':', c['correct'], 'Accuracy:', c['accuracy'] if c['accuracy'] is not None else 'N/A')
+    print("Invalid Output", report['invalid'])
+    print("Accuracy", report['accuracy'])
+    if 'fallback' in report:
+        print("Rails computed with the pH model", report['fallback'])
+    if 'zero_weights' in report:
+        print("Zero weights", report['zero_weights'], "Transfers per image", report['transfers_per_image'])
+
+
+def run_sweep(grid, data_path=default_data_path, workers=None, shard_size=default_shard_size, output_dir='.', fmt='json', silent=False, use_packed=True,
+              store_file=None, tolerance=None, platesheet=default_platesheet):
+    """ Runs every (datatype, imgsize, num_classes) configuration of the grid.
+    The images of every configuration are split into fixed-size shards (independent of
+    the number of workers) and all shards of all configurations share one process pool.
+    Packed datasets (see acidbase_dataset.pack_dataset) are memory-mapped when present and
+    use_packed is set; otherwise the workers decode the image files once into a shared
+    int8 array. The weights, labels and TF outputs are decoded once by this process and
+    shared with the workers, which attach to all of them without copying. With store_file,
+    per-image results are saved to a ResultStore as shards finish, and a re-run (e.g. after
+    a crash) only simulates the missing images.
+    With a tolerance, images are evaluated with the fast path of evaluate_shard and the
+    reports include the number of rails that fell back to the pH model. The source acid and
+    base concentrations are read from the platesheet.
+    Returns the list of reports in grid order.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    configs = []
+    load_tasks = []
+    tasks = []
+    shared_datasets = []
+    store = None
+    results = []
+    num_simulated = 0
+    executor = None
+    pending = []
+    try:
+        for datatype, imgsize, num_classes in grid:
+            config = (datatype, imgsize, num_classes, data_path)
+            paths = get_dataset_paths(data_path, datatype, imgsize, num_classes)
+            packed_file = paths['packed']
+            if use_packed and os.path.isfile(packed_file):
+                filenames, labels, tf_outputs = read_packed_dataset_index(packed_file)
+            else:
+                packed_file = None
+                filenames, labels, tf_outputs = read_dataset_index(data_path, datatype, imgsize, num_classes)
+
+            run_cache = AcidBaseRunCache(platesheet, paths['kernel'], num_neurons=num_classes, img_width=imgsize, img_height=imgsize)
+            source_conc = (run_cache.acid_conc, run_cache.base_conc)
+
+            shared = SharedArrays()
+            shared_datasets.append(shared)
+            shared.publish('weights', load_weight_matrix(paths['kernel'], num_classes, imgsize * imgsize))
+            shared.publish('labels', np.asarray(labels, dtype=np.int64))
+            shared.publish('tf_outputs', np.asarray(tf_outputs, dtype=np.float64).reshape(len(filenames), num_classes))
+            if packed_file is None:
+                shared.create('images', (len(filenames), imgsize * imgsize), np.int8)
+
+            shards = []
+            for start in range(0, len(filenames), shard_size):
+                stop = start + shard_size
+                shards.append(len(tasks))
+                if packed_file is None:
+                    load_tasks.append((config, shared.descriptor, start, stop, filenames[start:stop]))
+                tasks.append((config, (packed_file, shared.descriptor), start, stop, filenames[start:stop], source_conc, store_file, tolerance))
+            configs.append((config, shards))
+
+        # only this process writes to the store, the workers just read from it
+        store = ResultStore(store_file) if store_file is not None else None
+        if workers == 1:
+            run_tasks = map
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+
+            def run_tasks(fn, items):
+                # keep the futures, so that an error cancels the tasks that did not start
+                futures = [executor.submit(fn, item) for item in items]
+                pending.extend(futures)
+                return (future.result() for future in futures)
+        for _ in run_tasks(_load_shard_images_task, load_tasks):
+            pass
+        for counters, records in run_tasks(_evaluate_shard_task, tasks):
+            if store is not None and records:
+                store.put_many(records)
+            num_simulated += len(records)
+            results.append(counters)
+    finally:
+        if executor is not None:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+        if store is not None:
+            store.close()
+        for shared in shared_datasets:
+            shared.close()
+    if store is not None and not silent:
+        num_images = sum(sum(counters['count']) for counters in results)
+        print('Simulated', num_simulated, 'images,', num_images - num_simulated, 'results reused from', store_file)
+
+    reports = []
+    for config, shards in configs:
+        datatype, imgsize, num_classes, _ = config
+        counters = merge_counters([results[i] for i in shards], num_classes)
+        weights = load_weight_matrix(get_dataset_paths(data_path, datatype, imgsize, num_classes)['kernel'], num_classes, imgsize * imgsize)
+        report = build_report(config, counters, len(shards), fast=tolerance is not None, weights=weights)
+        if output_dir is not None:
+            write_report(report, output_dir, fmt=fmt)
+        if not silent:
+            print_summary(report)
+        reports.append(report)
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the acid/base network accuracy simulation over a grid of configurations.')
+    parser.add_argument('--datatype', nargs='+', default=['bin'], choices=['bin', '3bit'])
+    parser.add_argument('--imgsize', nargs='+', type=int, default=[8, 12, 16, 28], choices=[8, 12, 16, 28])
+    parser.add_argument('--num-classes', nargs='+', type=int, default=[2])
+    parser.add_argument('--data-path', default=default_data_path)
+    parser.add_argument('--platesheet', default=default_platesheet, help='source plate, for the acid and base concentrations')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--shard-size', type=int, default=default_shard_size)
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--format', default='json', choices=['json', 'csv'])
+    parser.add_argument('--no-packed', action='store_true', help='read the per-image text files even if a packed dataset exists')
+    parser.add_argument('--store', default=None, help='result store file; finished images are skipped when the sweep is re-run')
+    parser.add_argument('--fast', action='store_true', help='classify with an integer matrix product and only compute the pH of near-neutral rails')
+    parser.add_argument('--tolerance', type=float, default=default_tolerance, help='pH distance from 7 below which --fast falls back to the pH model (>= 0.005)')
+    args = parser.parse_args(argv)
+
+    grid = list(itertools.product(args.datatype, args.imgsize, args.num_classes))
+    run_sweep(grid, data_path=args.data_path, workers=args.workers, shard_size=args.shard_size,
+              output_dir=args.output_dir, fmt=args.format, use_packed=not args.no_packed, store_file=args.store,
+              tolerance=args.tolerance if args.fast else None, platesheet=args.platesheet)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
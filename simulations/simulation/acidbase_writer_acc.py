@@ -10,7 +10,9 @@
 import numpy
 import chemcpupy
 from chemcpupy import Plating, Containers
-from acidbase_network import AcidBaseNetwork
+from acidbase_network import load_image_batch, decode_neuron_outputs
+from acidbase_cache import AcidBaseRunCache
+from acidbase_pooling import PoolingPlan
 import os
 import sys
 
@@ -29,6 +31,13 @@ num_classes = 2
 if len(sys.argv) >= 3:
 	num_classes = int(sys.argv[3])
 
+# 'two_stage' writes a data plate and pools it, 'direct' transfers from the sources straight to the pool wells
+transfer_mode = 'two_stage'
+if len(sys.argv) >= 5:
+	transfer_mode = sys.argv[4]
+
+assert transfer_mode in ['two_stage', 'direct']
+
 
 # Set paths
 path_script = chemcpupy.Path.get_dir(__file__) # get current script's directory
@@ -181,6 +190,21 @@ def print_summary():
     print("Accuracy", round(100 *((sum_correct) / (sum_data)), 2))
 
 
+def record_result(img, lbl, neurons, invalid):
+    global invalid_cnt, wrong_cnt
+    is_correct = True
+    for n, neur in enumerate(neurons):
+        if (neur == 1 and tf_outputs[img][n] <= 0) or (neur == 0 and tf_outputs[img][n] > 0):
+            is_correct = False
+            break
+    if not invalid and is_correct:
+        correct[lbl] = correct[lbl] + 1
+    else:
+        if invalid:
+            invalid_cnt = invalid_cnt + 1
+        wrong_cnt = wrong_cnt + 1
+
+
 data_cnt = 1
 
 
@@ -188,6 +212,27 @@ wrong_cnt = 0
 
 use_tf_label = True
 
+# When nothing is printed or plotted, the transfer lists are not needed and the
+# expected outputs of the whole dataset are computed at once
+use_batch = silent and not show_plates
+
+# Parse the source plate and the kernel once per run; every image gets its own copy
+run_cache = AcidBaseRunCache(os.path.join(path_script, demo_source_platesheet), kernel_file,
+                             num_neurons=num_classes, img_width=img_width, img_height=img_height)
+
+# The pooling transfers only depend on the network size and on the non-zero weights
+pooling_plan = PoolingPlan(num_classes, run_cache.new_network().get_active_pairs(img_width * img_height).sum(axis=1).tolist(),
+                           vol_pool, vol1536_data, starting_letter='O', starting_index=1, max_transfer=max_vol_transfer)
+
+if use_batch:
+    batch_imgs = list(dataset_labels.keys())
+    batch_index = {img: i for i, img in enumerate(batch_imgs)}
+    network = run_cache.new_network()
+    batch_outputs = network.evaluate_batch(load_image_batch([os.path.join(dataset_path, img) for img in batch_imgs]),
+                                           transfer_unit_vol=(vol1536_data * 1e-9),
+                                           grayscale=(datatype == '3bit'))
+    batch_states, batch_invalid = decode_neuron_outputs(batch_outputs['ph'])
+
 for img, lbl in dataset_labels.items():
     # print('evaluating', img, '(', (data_cnt + 1), '/', len(dataset_labels), ')')
 
@@ -201,6 +246,10 @@ for img, lbl in dataset_labels.items():
     
     counters[lbl] = counters[lbl] + 1
 
+    if use_batch:
+        record_result(img, lbl, batch_states[batch_index[img]], batch_invalid[batch_index[img]])
+        continue
+
     sample_image1 = os.path.join(dataset_path, img)
 
     if not silent:
@@ -209,8 +258,7 @@ for img, lbl in dataset_labels.items():
         ###############################################################################    
                     
     # Load source plate
-    source_plate = chemcpupy.WellPlate384PP(description='source')    
-    source_plate.load_platesheet(os.path.join(path_script,demo_source_platesheet),fill_from_csv=True,grid='letter')
+    source_plate = run_cache.new_source_plate()
 
     # Visualize the plate 
     if show_plates:    
@@ -222,18 +270,16 @@ for img, lbl in dataset_labels.items():
 
 
     # Get info about the source compounds
-    acid_positions = source_plate.get_positions_by_compound_type('acid',grid='letter')
-    base_positions = source_plate.get_positions_by_compound_type('base',grid='letter')
-    water_positions = source_plate.get_positions_by_compound_type('water',grid='letter')
-    indicator_positions = source_plate.get_positions_by_compound_type('indicator',grid='letter')
-    acid_info = source_plate.get_contents(locations=acid_positions,properties=['mass','name','cid','concentration','type','volume'])
-    acid_conc = acid_info['concentration'][0]
-    acid_volume = acid_info['volume'][0]
-    acid_cids = acid_info['cid'][0]
-    base_info = source_plate.get_contents(locations=base_positions,properties=['mass','name','cid','concentration','type','volume'])
-    base_conc = base_info['concentration'][0]
-    base_volume = base_info['volume'][0]
-    base_cids = base_info['cid'][0]
+    acid_positions = run_cache.acid_positions
+    base_positions = run_cache.base_positions
+    water_positions = run_cache.water_positions
+    indicator_positions = run_cache.indicator_positions
+    acid_conc = run_cache.acid_conc
+    acid_volume = run_cache.acid_volume
+    acid_cids = run_cache.acid_cids
+    base_conc = run_cache.base_conc
+    base_volume = run_cache.base_volume
+    base_cids = run_cache.base_cids
     if not silent:
         print('\n'+'Source acid concentration: ' + num2str(acid_conc) + 'M, well count: ' + str(len(acid_positions)) + ', volume per well: ' + num2str(acid_volume*1e-3) + 'uL')     
         print('\n'+'Source base concentration: ' + num2str(base_conc) + 'M, well count: ' + str(len(base_positions)) + ', volume per well: ' + num2str(acid_volume*1e-3) + 'uL')     
@@ -243,14 +289,59 @@ for img, lbl in dataset_labels.items():
         ###############################################################################  
 
         
+    if transfer_mode == 'direct':
+        # same volumes as the two-stage plan, without the data plate
+        network = run_cache.new_network()
+        if datatype == '3bit':
+            network.load_image(sample_image1, img_levels=[-4, -3, -2, -1, 1, 2, 3, 4])
+        else:
+            network.load_image(sample_image1)
+        pos_list_direct_source, pos_list_direct_destin = network.generate_direct_transfer_plate(
+                                            acid_positions=acid_positions,
+                                            base_positions=base_positions,
+                                            water_positions=water_positions,
+                                            source_max_transfers=source_max_transfers,
+                                            starting_letter='O',
+                                            starting_index=1,
+                                            max_row=grid384_height,
+                                            max_col=grid384_width,
+                                            transfer_unit_vol=(vol1536_data * 1e-9),
+                                            acid_conc=(acid_conc * 1e-3),
+                                            base_conc=(base_conc * 1e-3))
+        expected_output = network.get_expected_outputs()
+        states, invalid = decode_neuron_outputs(numpy.array(expected_output))
+        record_result(img, lbl, states.tolist(), bool(invalid))
+        if not silent:
+            # every transfer gives what a data well would forward to its pool well
+            direct_volumes = {}
+            for n, (_, unit) in enumerate(pooling_plan.trees):
+                for position in pooling_plan.pool_positions[n]:
+                    direct_volumes[position] = unit
+            tasklist_data = chemcpupy.TaskList(description='Direct transfers')
+            tasklist_data.add(chemcpupy.TransferTask(from_plate=source_plate,
+                                    from_positions=pos_list_direct_source,
+                                    to_plate=source_plate,
+                                    to_positions=pos_list_direct_destin,
+                                    transfer_volumes=[direct_volumes[position] for position in pos_list_direct_destin],
+                                    transfer_group_label='direct'))
+            print('\n'+'Simulating transfers')
+            print("Expected outputs", expected_output)
+            simulate(tasklist_data)
+            tasklist_data.summarize()
+            chemcpupy.Echo.write_Echo_csv_picklist(tasklist_data, path_temp + '/' + demo_name + '-1_write_direct-Echo_picklist.csv')
+        if show_plates:
+            print('\n\t'+'pooling plate:')
+            source_plate.graphical_print_by_mass()
+            source_plate.graphical_print_volumes(units='uL')
+        continue
+
     # Initialize plate positions
     data_plate = chemcpupy.WellPlate1536LDV(description='data')
     available_positions = data_plate.list_empty_positions()
     used_positions = []
 
     # Initialize AcidBaseNetwork
-    network = AcidBaseNetwork(num_neurons=num_classes, weights_per_neuron=img_width*img_height, img_width=img_width, img_height=img_height)
-    network.load_weights(kernel_file)
+    network = run_cache.new_network()
     if datatype == '3bit':
         network.load_image(sample_image1, img_levels=[-4, -3, -2, -1, 1, 2, 3, 4])
     else:
@@ -342,32 +433,17 @@ for img, lbl in dataset_labels.items():
             neurons.append(-1)
             invalid = True
 
-    is_correct = True
-    for n, neur in enumerate(neurons):
-        if (neur == 1 and tf_outputs[img][n] <= 0) or (neur == 0 and tf_outputs[img][n] > 0):
-            is_correct = False
-            break
-    if not invalid and is_correct:
-        correct[lbl] = correct[lbl] + 1
-    else:
-        if invalid:
-            invalid_cnt = invalid_cnt + 1
-        wrong_cnt = wrong_cnt + 1
+    record_result(img, lbl, neurons, invalid)
 
 
     used_positions = used_positions + pos_list_data_destin     
     Plating.update_free_positions(available_positions,used_positions)                                                        
     #    create the transfer task
     if not silent:
-        task = chemcpupy.TransferTask(from_plate=data_plate,
-                                from_positions=pos_list_data_source,
-                                to_plate=source_plate,
-                                to_positions=pos_list_data_destin,
-                                transfer_volumes=[vol_pool]*len(pos_list_data_destin),
-                                transfer_group_label='pooling')
-
+        # large rails go through partial pools so that no pool well overflows
         tasklist_data = chemcpupy.TaskList(description='Apply pooling')
-        tasklist_data.add(task)
+        for task in pooling_plan.transfer_tasks(data_plate, pos_list_data_source, source_plate):
+            tasklist_data.add(task)
         # run the transfer task
         print('\n'+'Simulating transfers')
         print("Expected outputs", expected_output)
@@ -384,4 +460,11 @@ for img, lbl in dataset_labels.items():
 
 print("===========")
 
-print_summary()
\ No newline at end of file
+print_summary()
+
+if transfer_mode == 'direct':
+    transfer_counts = run_cache.new_network().count_transfers(load_image_batch([os.path.join(dataset_path, img) for img in dataset_labels]),
+                                                              grayscale=(datatype == '3bit'))
+    for mode, counts in transfer_counts.items():
+        print(mode, 'transfers per image', round(float(numpy.mean(counts['transfers'])), 2) if len(dataset_labels) > 0 else None,
+              'data plates', counts['data_plates'])
\ No newline at end of file
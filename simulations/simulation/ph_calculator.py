@@ -13,7 +13,7 @@ def calculate_resulting_ph_vol_conc(acid_vol, acid_conc, base_vol, base_conc): #
             h_conc = 1e-14 / oh_conc
     else:
         remaining_acid_moles = acid_num_moles - base_num_moles
-        if remaining_base_moles == 0:
+        if remaining_acid_moles == 0:
             h_conc = 1e-7
         else:
             h_conc = remaining_acid_moles / (acid_vol + base_vol)
@@ -73,6 +73,9 @@ def calculate_resulting_ph_vol_ph(acid_vol, acid_ph, base_vol, base_ph): #L, ph
     oh_conc = 1e-14/(base_h_conc)
     base_num_moles = oh_conc * base_vol
     acid_is_limiting_agent = base_num_moles > acid_num_moles
+    # an empty mixture (e.g. a neuron whose weights are all zero) is neutral
+    if max(base_num_moles, acid_num_moles) == 0:
+        return 7.00
     if (abs(base_num_moles - acid_num_moles)/max(base_num_moles, acid_num_moles) < 1e-8):
         return 7.00
     if acid_is_limiting_agent:
@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+
+# Array versions of the functions in ph_calculator.py. Every function accepts
+# NumPy arrays (or scalars) and broadcasts over them.
+#
+# NumPy's vectorized log10/power may differ from math.log10/** in the last bit.
+# With exact=True the transcendental functions are evaluated with the math
+# module over the unique input values, so the results are bit-identical to the
+# scalar functions. Dataset-scale inputs only contain a handful of distinct
+# volumes, so this stays cheap.
+
+def _apply_unique(func, values):
+    values = np.asarray(values, dtype=float)
+    uniq, inverse = np.unique(values, return_inverse=True)
+    result = np.array([func(v) for v in uniq.tolist()], dtype=float)
+    return result[inverse].reshape(values.shape)
+
+def _log10(values, exact):
+    if exact:
+        return _apply_unique(math.log10, values)
+    return np.log10(values)
+
+def _pow10(values, exact):
+    if exact:
+        return _apply_unique(lambda v: 10**v, values)
+    return np.power(10.0, values)
+
+def _as_arrays(*values):
+    return np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in values])
+
+def calculate_resulting_ph_vol_conc(acid_vol, acid_conc, base_vol, base_conc, exact=True): #L, molar
+    acid_vol, acid_conc, base_vol, base_conc = _as_arrays(acid_vol, acid_conc, base_vol, base_conc)
+    acid_num_moles = acid_conc * acid_vol # moles
+    base_num_moles = base_conc * base_vol # moles
+    acid_is_limiting_agent = base_num_moles >= acid_num_moles
+    remaining_moles = np.abs(base_num_moles - acid_num_moles)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        remaining_conc = remaining_moles / (acid_vol + base_vol)
+        h_conc = np.where(acid_is_limiting_agent, 1e-14 / remaining_conc, remaining_conc)
+    h_conc = np.where(remaining_moles == 0, 1e-7, h_conc)
+    result_ph = -_log10(h_conc, exact)
+    return result_ph
+
+def calculate_acid_ph(acid_conc, exact=True):
+    return -_log10(acid_conc, exact)
+
+def calculate_base_ph(base_conc, exact=True):
+    return 14.0 + _log10(base_conc, exact)
+
+def calculate_similar_solutions_ph(first_sol_vol, first_sol_ph, second_sol_vol, second_sol_ph, exact=True):
+    first_sol_vol, first_sol_ph, second_sol_vol, second_sol_ph = _as_arrays(first_sol_vol, first_sol_ph, second_sol_vol, second_sol_ph)
+    first_is_water = np.abs(first_sol_ph - 7.0) < 0.9
+    second_is_water = np.abs(second_sol_ph - 7.0) < 0.9
+    both_water = first_is_water & second_is_water
+    # make sure that water, if any, is always the second solution
+    swapped = first_is_water & ~second_is_water
+    first_sol_vol, second_sol_vol = np.where(swapped, second_sol_vol, first_sol_vol), np.where(swapped, first_sol_vol, second_sol_vol)
+    first_sol_ph, second_sol_ph = np.where(swapped, second_sol_ph, first_sol_ph), np.where(swapped, first_sol_ph, second_sol_ph)
+    diluted = (first_is_water | second_is_water) & ~both_water
+
+    first_h_conc = _pow10(-first_sol_ph, exact)
+    second_h_conc = _pow10(-second_sol_ph, exact)
+    total_vol = first_sol_vol + second_sol_vol
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # acid diluted with water
+        diluted_acid_h_conc = (first_h_conc * first_sol_vol) / total_vol
+        # base diluted with water
+        diluted_oh_conc = ((1e-14/first_h_conc) * first_sol_vol) / total_vol
+        diluted_base_h_conc = 1e-14/diluted_oh_conc
+        # two acids or two bases
+        mixed_h_conc = (first_h_conc * first_sol_vol + second_h_conc * second_sol_vol) / total_vol
+    h_conc = np.where(diluted, np.where(first_sol_ph < 7, diluted_acid_h_conc, diluted_base_h_conc), mixed_h_conc)
+    h_conc = np.where(both_water, 1e-7, h_conc)
+    ph = np.where(both_water, 7.0, -_log10(h_conc, exact))
+    return ph
+
+def calculate_resulting_ph_vol_ph(acid_vol, acid_ph, base_vol, base_ph, exact=True): #L, ph
+    acid_vol, acid_ph, base_vol, base_ph = _as_arrays(acid_vol, acid_ph, base_vol, base_ph)
+    # swap the arguments where the acid and the base were given in reverse order
+    swapped = (acid_ph > 7.0) & (base_ph < 7.0)
+    acid_vol, base_vol = np.where(swapped, base_vol, acid_vol), np.where(swapped, acid_vol, base_vol)
+    acid_ph, base_ph = np.where(swapped, base_ph, acid_ph), np.where(swapped, acid_ph, base_ph)
+
+    acid_h_conc = _pow10(-acid_ph, exact)
+    acid_num_moles = acid_h_conc * acid_vol
+    base_h_conc = _pow10(-base_ph, exact)
+    oh_conc = 1e-14/(base_h_conc)
+    base_num_moles = oh_conc * base_vol
+    acid_is_limiting_agent = base_num_moles > acid_num_moles
+
+    total_vol = acid_vol + base_vol
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # an empty mixture has no excess of either reagent and is reported as neutral
+        neutral = ~(np.abs(base_num_moles - acid_num_moles)/np.maximum(base_num_moles, acid_num_moles) >= 1e-8)
+        remaining_moles = np.abs(base_num_moles - acid_num_moles)
+        remaining_conc = remaining_moles / total_vol
+        h_conc = np.where(acid_is_limiting_agent, 1e-14 / remaining_conc, remaining_conc)
+    h_conc = np.where(neutral, 1e-7, h_conc)
+    result_ph = np.where(neutral, 7.00, -_log10(h_conc, exact))
+    return result_ph
+
+
+def calculate_buffer_ph(ka, acid_conc, base_conc, exact=True):
+    ka, acid_conc, base_conc = _as_arrays(ka, acid_conc, base_conc)
+    pka = -_log10(ka, exact)
+    return (pka + _log10(base_conc / acid_conc, exact)), acid_conc, base_conc
+
+
+def calculate_buffer_with_base(ka, buffer_acid_conc, buffer_base_conc, base_conc, exact=True):
+    new_acid_conc = np.subtract(buffer_acid_conc, base_conc)
+    new_base_conc = np.add(buffer_base_conc, base_conc)
+    return calculate_buffer_ph(ka, new_acid_conc, new_base_conc, exact=exact)
+
+def calculate_buffer_with_acid(ka, buffer_acid_conc, buffer_base_conc, acid_conc, exact=True):
+    new_acid_conc = np.add(buffer_acid_conc, acid_conc)
+    new_base_conc = np.subtract(buffer_base_conc, acid_conc)
+    return calculate_buffer_ph(ka, new_acid_conc, new_base_conc, exact=exact)
+
+def calculate_buffer_with_buffer(ka, first_buffer_acid_conc, first_buffer_base_conc, second_buffer_acid_conc, second_buffer_base_conc, exact=True):
+    new_acid_conc = np.add(first_buffer_acid_conc, second_buffer_acid_conc)
+    new_base_conc = np.add(first_buffer_base_conc, second_buffer_base_conc)
+    return calculate_buffer_ph(ka, new_acid_conc, new_base_conc, exact=exact)
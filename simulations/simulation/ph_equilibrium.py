@@ -0,0 +1,94 @@
+import math
+
+import numpy as np
+
+# pH of mixtures of strong and weak monoprotic acids and bases from the charge balance
+#
+#   [H+] + sum(base_conc * protonated) = [OH-] + sum(acid_conc * deprotonated)
+#
+# instead of the strong neutralization of ph_calculator.py. Unlike the Henderson-Hasselbalch
+# helpers (calculate_buffer_ph and co.), the charge balance holds at any ratio of acid to base,
+# including past the buffer limits and for a single species. Strong acids have a pKa of -inf,
+# and bases are given by the pKa of their conjugate acid (inf for a strong base).
+
+water_kw = 1e-14 # ion product of water at 25 C
+default_tolerance = 1e-9 # pH
+default_max_iterations = 200
+ph_min = -2.0 # [H+] of 100 M, beyond any mixture of the reagents
+ph_max = 16.0
+
+_ln10 = math.log(10)
+
+
+def _deprotonated(ph, pka):
+    # share of an acid that has given up its proton
+    with np.errstate(over='ignore'):
+        return 1.0 / (1.0 + np.power(10.0, pka - ph))
+
+def _protonated(ph, pka):
+    # share of a base that has taken a proton
+    with np.errstate(over='ignore'):
+        return 1.0 / (1.0 + np.power(10.0, ph - pka))
+
+def solve_charge_balance(acid_conc, acid_pka, base_conc, base_pka, kw=water_kw, tolerance=default_tolerance, max_iterations=default_max_iterations):
+    """ Solves the charge balance of many wells at once. acid_conc is an (... x acids) array
+    of the total concentration [M] of every acid in every well and acid_pka the pKa of every
+    acid; base_conc and base_pka are the same for the bases. The excess charge is strictly
+    decreasing in the pH, so every well is solved with Newton iterations on the pH that
+    fall back to bisection whenever a step leaves the bracket of the root.
+    Returns the pH of every well (an array of the broadcast well shape).
+    """
+    acid_conc = np.asarray(acid_conc, dtype=float)
+    base_conc = np.asarray(base_conc, dtype=float)
+    acid_pka = np.asarray(acid_pka, dtype=float)
+    base_pka = np.asarray(base_pka, dtype=float)
+    shape = np.broadcast_shapes(acid_conc.shape[:-1], base_conc.shape[:-1])
+    low = np.full(shape, ph_min)
+    high = np.full(shape, ph_max)
+    # start from the pH of a complete neutralization of all the species
+    net_acid = np.sum(acid_conc, axis=-1) - np.sum(base_conc, axis=-1)
+    with np.errstate(divide='ignore'):
+        ph = np.where(net_acid > 1e-7, -np.log10(np.abs(net_acid)), np.where(net_acid < -1e-7, 14.0 + np.log10(np.abs(net_acid)), 7.0))
+    ph = np.clip(ph, ph_min, ph_max) * np.ones(shape)
+    for _ in range(max_iterations):
+        h_conc = np.power(10.0, -ph)
+        oh_conc = kw / h_conc
+        alpha = _deprotonated(ph[..., None], acid_pka)
+        beta = _protonated(ph[..., None], base_pka)
+        excess = h_conc - oh_conc + np.sum(base_conc * beta, axis=-1) - np.sum(acid_conc * alpha, axis=-1)
+        slope = -_ln10 * (h_conc + oh_conc + np.sum(acid_conc * alpha * (1 - alpha), axis=-1) + np.sum(base_conc * beta * (1 - beta), axis=-1))
+        # a positive excess of cations means that the pH is still too low
+        low = np.where(excess > 0, ph, low)
+        high = np.where(excess < 0, ph, high)
+        newton = ph - excess / slope
+        next_ph = np.where((newton > low) & (newton < high), newton, (low + high) / 2)
+        next_ph = np.where(excess == 0, ph, next_ph)
+        converged = np.all(np.abs(next_ph - ph) < tolerance)
+        ph = next_ph
+        if converged:
+            break
+    return ph
+
+
+class EquilibriumModel:
+    """ Acid and base reagents for the charge balance pH model. acid_conc and base_conc are
+    the concentrations [M] of the source reagents, acid_pka the pKa of the acid (-inf for a
+    strong acid) and base_pka the pKa of the conjugate acid of the base (inf for a strong
+    base). A reagent can also be a mixture, with a concentration and a pKa per species.
+    """
+    def __init__(self, acid_conc, base_conc, acid_pka=-math.inf, base_pka=math.inf, kw=water_kw):
+        self.acid_conc, self.acid_pka = np.broadcast_arrays(np.atleast_1d(np.asarray(acid_conc, dtype=float)), np.atleast_1d(np.asarray(acid_pka, dtype=float)))
+        self.base_conc, self.base_pka = np.broadcast_arrays(np.atleast_1d(np.asarray(base_conc, dtype=float)), np.atleast_1d(np.asarray(base_pka, dtype=float)))
+        self.kw = kw
+
+    def calculate_ph(self, acid_vol, base_vol, water_vol=0):
+        """ pH of wells that hold acid_vol of the acid, base_vol of the base and water_vol of
+        water (arrays of any shape, in the same unit). An empty well is neutral.
+        """
+        acid_vol, base_vol, water_vol = np.broadcast_arrays(np.asarray(acid_vol, dtype=float), np.asarray(base_vol, dtype=float), np.asarray(water_vol, dtype=float))
+        total_vol = acid_vol + base_vol + water_vol
+        with np.errstate(divide='ignore', invalid='ignore'):
+            acid_share = np.where(total_vol > 0, acid_vol / total_vol, 0.0)
+            base_share = np.where(total_vol > 0, base_vol / total_vol, 0.0)
+        return solve_charge_balance(acid_share[..., None] * self.acid_conc, self.acid_pka,
+                                    base_share[..., None] * self.base_conc, self.base_pka, kw=self.kw)
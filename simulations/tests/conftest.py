@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+dirname = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(dirname, '..'))
+sys.path.insert(0, os.path.join(dirname, '..', 'simulation'))
+
+
+@pytest.fixture
+def platesheet():
+    return os.path.join(dirname, '..', 'simulation', 'platesheet.csv')
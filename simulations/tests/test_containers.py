@@ -0,0 +1,149 @@
+"""
+@description: the indexes, snapshots and copy-on-write compounds of Container
+"""
+
+import copy
+import pickle
+
+import numpy as np
+import pytest
+
+import chemcpupy
+from chemcpupy.tools.Containers import position_to_lettergrid
+
+
+@pytest.fixture
+def source_plate(platesheet):
+    plate = chemcpupy.WellPlate384PP(description='source')
+    plate.load_platesheet(platesheet, fill_from_csv=True, grid='letter')
+    return plate
+
+
+def plate_state(plate):
+    """ Everything a restore must bring back: the mixtures, the volumes and the compound index """
+    mixtures = [(m['mixture_name'], m.get('position'), m['volume'],
+                 [dict(c.items()) for c in m['compound_list']._compound_list]) for m in plate._mixture_list]
+    return pickle.dumps(mixtures), plate.volumes.copy(), {k: sorted(v) for k, v in plate._compound_index.items()}
+
+
+def assert_same_state(a, b):
+    assert a[0] == b[0]
+    np.testing.assert_array_equal(a[1], b[1])
+    assert a[2] == b[2]
+
+
+def scan_positions(plate, compound_type):
+    return [position_to_lettergrid((r, c)) for r in range(plate._rows) for c in range(plate._cols)
+            if compound_type in plate[r, c]['compound_list'].list_all('type')]
+
+
+def transfer(source, positions, destination, to_positions, volume=25):
+    chemcpupy.TransferTask(from_plate=source, from_positions=positions, to_plate=destination, to_positions=to_positions,
+                           transfer_volumes=[volume] * len(to_positions)).run(verbose=False, enforce_volume_limits=False)
+
+
+@pytest.mark.parametrize('compound_type', ['acid', 'base', 'water', 'indicator', 'nothing'])
+def test_compound_index_matches_scan(source_plate, compound_type):
+    assert source_plate.get_positions_by_compound_type(compound_type, grid='letter') == scan_positions(source_plate, compound_type)
+
+
+def test_compound_index_follows_transfers(source_plate):
+    acid = source_plate.get_positions_by_compound_type('acid')[0]
+    cid = source_plate[acid]['compound_list'].list_all('cid')[0]
+    plate = chemcpupy.WellPlate1536LDV()
+    transfer(source_plate, [acid] * 3, plate, [(0, 0), (5, 7), (31, 47)])
+    assert plate.get_positions_by_compound_type('acid') == plate.get_positions_by_cid(cid) == [(0, 0), (5, 7), (31, 47)]
+
+    # emptied wells leave the index, of this plate only
+    copied = copy.deepcopy(plate)
+    copied[(0, 0)]['compound_list']._compound_list[0]['volume'] = 0
+    copied[(0, 0)]['compound_list'].remove_if_zero_volume()
+    assert copied.get_positions_by_compound_type('acid') == [(5, 7), (31, 47)]
+    assert plate.get_positions_by_compound_type('acid') == [(0, 0), (5, 7), (31, 47)]
+    unpickled = pickle.loads(pickle.dumps(copied))
+    unpickled[(5, 7)]['compound_list']._compound_list[0]['volume'] = 0
+    unpickled[(5, 7)]['compound_list'].remove_if_zero_volume()
+    assert unpickled.get_positions_by_compound_type('acid') == [(31, 47)]
+    assert copied.get_positions_by_compound_type('acid') == [(5, 7), (31, 47)]
+
+
+def test_name_and_position_lookups():
+    plate = chemcpupy.WellPlate96(autofill=False)
+    plate.add_new_mixture('m', chemcpupy.CompoundList(), position=(1, 3), volume=10)
+    plate.add_new_mixture('m', chemcpupy.CompoundList(), position=(2, 0), volume=20)
+    assert plate['m'] is plate[1, 3]
+    assert plate['B4'] is plate[(1, 3)]
+    assert plate.get_volume('m') == plate[2, 0]['volume']
+    plate.add_volume('m', 1)
+    assert plate.volumes[1, 3] == plate[1, 3]['volume'] and plate.volumes[2, 0] == plate[2, 0]['volume']
+    with pytest.raises(IndexError):
+        plate['missing']
+
+
+def test_restore_brings_back_the_snapshot(source_plate):
+    plate = chemcpupy.WellPlate1536LDV()
+    acid = source_plate.get_positions_by_compound_type('acid')
+    base = source_plate.get_positions_by_compound_type('base')
+    source_start, plate_start = plate_state(source_plate), plate_state(plate)
+    source_snapshot, plate_snapshot = source_plate.snapshot(), plate.snapshot()
+
+    rng = np.random.default_rng(0)
+    for k in range(3):
+        positions = [acid[i % len(acid)] if is_acid else base[i % len(base)] for i, is_acid in enumerate(rng.integers(0, 2, 100))]
+        transfer(source_plate, positions, plate, [tuple(p) for p in rng.integers(0, [32, 48], (100, 2)).tolist()])
+        if k == 1:
+            nested = plate.snapshot()
+            plate_middle = plate_state(plate)
+    plate.add_volumes([(0, 0)], 5)
+    plate.restore(nested)
+    assert_same_state(plate_state(plate), plate_middle)
+
+    plate.restore(plate_snapshot)
+    source_plate.restore(source_snapshot)
+    assert_same_state(plate_state(plate), plate_start)
+    assert_same_state(plate_state(source_plate), source_start)
+    assert plate.get_positions_by_compound_type('acid') == []
+
+    # a snapshot can be restored again, and a released one merges into the one before
+    transfer(source_plate, acid[:5], plate, [(1, 1)] * 5)
+    nested = plate.snapshot()
+    transfer(source_plate, acid[:5], plate, [(2, 2)] * 5)
+    plate.release_snapshot(nested)
+    plate.restore(plate_snapshot)
+    source_plate.restore(source_snapshot)
+    assert_same_state(plate_state(plate), plate_start)
+    assert_same_state(plate_state(source_plate), source_start)
+
+
+def test_restore_removes_new_mixtures(source_plate):
+    plate = chemcpupy.WellPlate96(autofill=False)
+    snapshot = plate.snapshot()
+    acid = source_plate.get_positions_by_compound_type('acid')[0]
+    plate.add_new_mixture('m', source_plate[acid]['compound_list'], volume=10)
+    assert plate.get_positions_by_compound_type('acid') == [(0, 0)]
+    plate.restore(snapshot)
+    assert len(plate._mixture_list) == 0 and plate.volumes.sum() == 0
+    assert plate.get_positions_by_compound_type('acid') == []
+    with pytest.raises(IndexError):
+        plate['m']
+
+
+def test_shared_compounds_are_copy_on_write(source_plate):
+    acid = source_plate.get_positions_by_compound_type('acid')[0]
+    compounds = source_plate[acid]['compound_list']
+    original = [dict(c.items()) for c in compounds._compound_list]
+    shared = compounds.share()
+    assert [dict(c.items()) for c in shared._compound_list] == original
+
+    shared._compound_list[0]['volume'] = 1
+    shared._compound_list[0]['name'] = 'changed'
+    del shared._compound_list[0]['cid']
+    assert [dict(c.items()) for c in compounds._compound_list] == original
+    assert shared._compound_list[0]['name'] == 'changed' and 'cid' not in shared._compound_list[0]
+
+    # wells of other plates share the compounds the same way
+    plate = chemcpupy.WellPlate96(autofill=False)
+    plate.add_new_mixture('m', compounds, volume=10)
+    plate[0, 0]['compound_list']._compound_list[0]['name'] = 'changed'
+    assert [dict(c.items()) for c in compounds._compound_list] == original
+    assert copy.deepcopy(plate[0, 0]['compound_list'])._compound_list[0]['name'] == 'changed'
@@ -0,0 +1,124 @@
+"""
+@description: the batch evaluators of AcidBaseNetwork against the volumes that the data plates
+              accumulate image by image
+"""
+
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+from acidbase_network import AcidBaseNetwork, decode_neuron_outputs
+
+transfer_unit_vol = 2000e-9
+acid_positions = ['A%d' % i for i in range(1, 6)]
+base_positions = ['D%d' % i for i in range(1, 4)]
+
+
+def make_network(cls, weights, img_width, img_height, grayscale):
+    network = cls(num_neurons=len(weights), weights_per_neuron=img_width * img_height, img_width=img_width, img_height=img_height)
+    network.neurons = [list(neuron) for neuron in weights]
+    network.weights_loaded = True
+    network.grayscale = grayscale
+    return network
+
+
+def plate_outputs(cls, weights, img_width, img_height, grayscale, img):
+    """ Plans the data plate of one image and returns the volumes it accumulates and the
+    expected pH
+    """
+    network = make_network(cls, weights, img_width, img_height, grayscale)
+    network.img = list(img)
+    network.generate_weighted_data_plate(acid_positions, base_positions, ['G1'], 5, 'A', 1, 32, float('inf'),
+                                         transfer_unit_vol, 0.1, 0.1)
+    return {'acid_vol': np.array(network.neurons_outputs_acid_vol, dtype=np.float64),
+            'base_vol': np.array(network.neurons_outputs_base_vol, dtype=np.float64),
+            'water_vol': np.array(network.neurons_outputs_water_vol, dtype=np.float64),
+            'ph': np.array(network.get_expected_outputs())}
+
+
+def random_case(rng, grayscale, zero_fraction, img_width=3, img_height=3, num_neurons=3, num_images=6):
+    num_pixels = img_width * img_height
+    weights = np.where(rng.random((num_neurons, num_pixels)) < zero_fraction, 0, rng.choice([-1, 1], (num_neurons, num_pixels)))
+    if grayscale:
+        images = rng.choice([-1, 1, 3, 5], (num_images, num_pixels))
+    else:
+        images = rng.integers(0, 2, (num_images, num_pixels))
+    return weights.tolist(), images
+
+
+@pytest.mark.parametrize('grayscale', [False, True])
+@pytest.mark.parametrize('zero_fraction', [0.0, 0.5, 1.0])
+def test_evaluate_batch_matches_data_plates(grayscale, zero_fraction):
+    rng = np.random.default_rng(1)
+    weights, images = random_case(rng, grayscale, zero_fraction)
+    batch = make_network(AcidBaseNetwork, weights, 3, 3, grayscale).evaluate_batch(images, transfer_unit_vol=transfer_unit_vol)
+    for i, img in enumerate(images):
+        expected = plate_outputs(AcidBaseNetwork, weights, 3, 3, grayscale, img)
+        for key in ('acid_vol', 'base_vol', 'water_vol'):
+            np.testing.assert_allclose(batch[key][i], expected[key], rtol=1e-12, atol=1e-20, err_msg=key)
+        np.testing.assert_array_equal(batch['ph'][i], expected['ph'])
+
+
+def test_evaluate_batch_water_skips_zero_weights():
+    # a pixel only adds water to the neurons that have a non-zero weight for it
+    weights = [[1, 0], [0, -1], [0, 0]]
+    network = make_network(AcidBaseNetwork, weights, 2, 1, True)
+    batch = network.evaluate_batch([[3, 5]], transfer_unit_vol=1.0)
+    np.testing.assert_array_equal(batch['water_vol'][0], [[3, 3], [5, 5], [0, 0]])
+
+
+@pytest.mark.parametrize('grayscale', [False, True])
+@pytest.mark.parametrize('acid_ph,base_ph', [(1, 13), (3, 11), (6.5, 7.5)])
+def test_classify_batch_matches_evaluate_batch(grayscale, acid_ph, base_ph):
+    rng = np.random.default_rng(2)
+    weights, images = random_case(rng, grayscale, 0.3, img_width=4, img_height=4, num_images=200)
+    network = make_network(AcidBaseNetwork, weights, 4, 4, grayscale)
+    ph = network.evaluate_batch(images, transfer_unit_vol=transfer_unit_vol, acid_ph=acid_ph, base_ph=base_ph)['ph']
+    states, invalid = decode_neuron_outputs(ph)
+    fast = network.classify_batch(images, transfer_unit_vol=transfer_unit_vol, acid_ph=acid_ph, base_ph=base_ph)
+    np.testing.assert_array_equal(fast['states'], states)
+    np.testing.assert_array_equal(fast['invalid'], invalid)
+
+
+def test_classify_batch_falls_back_near_neutral():
+    # the left rail of the first neuron gets one unit of acid and one of base, and the
+    # neuron without weights gets nothing; both need the pH model
+    weights = [[1, -1], [1, 1], [0, 0]]
+    network = make_network(AcidBaseNetwork, weights, 2, 1, False)
+    images = [[1, 1], [0, 1]]
+    ph = network.evaluate_batch(images, transfer_unit_vol=transfer_unit_vol)['ph']
+    states, invalid = decode_neuron_outputs(ph)
+    fast = network.classify_batch(images, transfer_unit_vol=transfer_unit_vol)
+    np.testing.assert_array_equal(fast['states'], states)
+    np.testing.assert_array_equal(fast['invalid'], invalid)
+    assert fast['fallback'][0, 0].all()
+    assert fast['fallback'][:, 2].all()
+    assert not fast['fallback'][0, 1].any()
+    assert fast['num_fallback'] == int(fast['fallback'].sum())
+
+
+def load_echo_network():
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'echo_exp', 'acidbase_network.py')
+    spec = importlib.util.spec_from_file_location('echo_acidbase_network', filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.AcidBaseNetwork
+
+
+@pytest.mark.parametrize('grayscale,img', [(False, [0, 0, 0, 1]), (True, [0, 2, -1, 1])])
+def test_batch_paths_follow_get_pixel_transfers(grayscale, img):
+    # the Echo experiments count every pixel but -1 as on
+    cls = load_echo_network()
+    weights = [[1, 1, 1, 1], [1, 0, -1, 1]]
+    expected = plate_outputs(cls, weights, 2, 2, grayscale, img)
+    network = make_network(cls, weights, 2, 2, grayscale)
+    batch = network.evaluate_batch([img], transfer_unit_vol=transfer_unit_vol)
+    for key in ('acid_vol', 'base_vol', 'water_vol'):
+        np.testing.assert_allclose(batch[key][0], expected[key], rtol=1e-12, atol=1e-20, err_msg=key)
+    np.testing.assert_array_equal(batch['ph'][0], expected['ph'])
+    states, invalid = decode_neuron_outputs(expected['ph'][None])
+    fast = network.classify_batch([img], transfer_unit_vol=transfer_unit_vol)
+    np.testing.assert_array_equal(fast['states'], states)
+    np.testing.assert_array_equal(fast['invalid'], invalid)
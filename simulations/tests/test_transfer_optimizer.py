@@ -0,0 +1,63 @@
+"""
+@description: coalesce_transfers must leave every plate as the original TaskList does
+"""
+
+import numpy as np
+import pytest
+
+import chemcpupy
+from chemcpupy import TransferOptimizer
+
+volume_increment = 2.5
+
+
+def make_plates():
+    source = chemcpupy.WellPlate384PP(description='source')
+    data = chemcpupy.WellPlate1536LDV(description='data')
+    pool = chemcpupy.WellPlate384PP(description='pool')
+    for col in range(3):
+        source.add_compounds_to_location((0, col), chemcpupy.CompoundList(), volume=60000)
+    return source, data, pool
+
+
+def plan(source, data, pool):
+    tasklist = chemcpupy.TaskList(description='plan')
+    rng = np.random.default_rng(1)
+    for k in range(5):
+        from_positions = [(0, int(col)) for col in rng.integers(0, 3, 200)]
+        to_positions = [tuple(p) for p in rng.integers(0, [2, 4], (200, 2)).tolist()]
+        # many small transfers to merge, volumes off the increment, and one above the Echo maximum
+        tasklist.add(chemcpupy.TransferTask(from_plate=source, from_positions=from_positions, to_plate=data, to_positions=to_positions,
+                                            transfer_volumes=[2.5] * 150 + [3.0] * 49 + [20000], transfer_group_label='data'))
+    # pooling reads the data plate, so the transfers after it are not merged with those before
+    tasklist.add(chemcpupy.TransferTask(from_plate=data, from_positions=[(0, 0), (0, 1), (0, 0)], to_plate=pool, to_positions=[(0, 0)],
+                                        transfer_volumes=[100.0], transfer_group_label='pool'))
+    tasklist.add(chemcpupy.TransferTask(from_plate=source, from_positions=[(0, 0)] * 4, to_plate=data, to_positions=[(0, 0)] * 4,
+                                        transfer_volumes=[5.0], transfer_group_label='data'))
+    # liquid moved within one plate, reading a well written before
+    tasklist.add(chemcpupy.TransferTask(from_plate=data, from_positions=[(0, 0), (1, 1), (0, 0)], to_plate=data,
+                                        to_positions=[(1, 1), (1, 2), (1, 1)], transfer_volumes=[10.0], transfer_group_label='mix'))
+    return tasklist
+
+
+def run(tasklist):
+    tasklist.run(verbose=False, volume_increment=volume_increment, enforce_volume_limits=False)
+
+
+def test_coalesce_transfers_preserves_plate_state():
+    original = make_plates()
+    run(plan(*original))
+    coalesced = make_plates()
+    tasklist, report = TransferOptimizer.coalesce_transfers(plan(*coalesced), volume_increment=volume_increment, verbose=False)
+    run(tasklist)
+
+    for before, after in zip(original, coalesced):
+        np.testing.assert_allclose(after.volumes, before.volumes, atol=1e-6, err_msg=before._description)
+    assert report['transfers_after'] < report['transfers_before']
+    max_volume = max(v for task in tasklist._task_list for v in task.get_param('transfer_volumes'))
+    assert max_volume <= TransferOptimizer.echo_max_transfer_volume
+
+
+def test_coalesce_transfers_rejects_small_maximum():
+    with pytest.raises(Exception):
+        TransferOptimizer.coalesce_transfers(plan(*make_plates()), max_transfer_volume=1.0, volume_increment=volume_increment, verbose=False)